@@ -0,0 +1,316 @@
+"""
+Stage-by-stage benchmark of the GARDN-M model on synthetic data.
+
+Runs the numbered stages of gardnm() on a data tree from synthetic.py and
+records the wall time and the peak traced memory of each:
+
+    (1) load      load_sources
+    (2) process   process_sources
+    (3) subrank   subrank
+    (4) combine   combine_arrays / combine_pandas
+    (5) save      rankings.to_csv
+
+Times are the best of several repeats, memory comes from one extra run under
+tracemalloc (which slows the code down, so it is never timed). The results
+are saved as JSON together with the commit they were measured on, and two
+result files can be compared stage by stage.
+
+The startup benchmark times the command-line interface instead: every
+command of STARTUP_COMMANDS runs in a fresh interpreter, and the time over
+a bare interpreter is checked against STARTUP_BUDGET, with the modules that
+took longest to import.
+
+Usage:
+    python benchmark.py [--sources 200] [--cities 20000] [--engine array] [--repeats 3]
+    python benchmark.py --compare OLD.json NEW.json
+    python benchmark.py --startup
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import main
+from engine import combine_arrays
+from paths import ROOT, enter_root
+from synthetic import generate
+from writers import output_name, output_path, read_rankings, save_rankings
+
+STAGES = ['1_load', '2_process', '3_subrank', '4_combine', '5_save']
+LAUNCHER = os.path.join(ROOT, 'scripts', 'gardnm')
+STARTUP_COMMANDS = [['--help'], ['lookup', 'Atlanta', '--state', 'GA'], ['lookup', 'Atlanta', '--state', 'GA', '--format', 'sqlite']]
+STARTUP_BUDGET = 0.05 # seconds over a bare interpreter
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    """Temporarily run from another directory, the model reads everything from ./data"""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def synthetic_root(n_sources, n_cities, seed = 0):
+    """Directory of a synthetic data tree, generated on first use
+
+    Returns:
+        root: path under data/cache/synthetic
+    """
+    root = os.path.abspath(f'./data/cache/synthetic/s{n_sources}-c{n_cities}-r{seed}')
+    if not os.path.exists(os.path.join(root, 'data', 'synthetic.json')):
+        generate(root, n_sources, n_cities, seed=seed)
+    return root
+
+
+def run_stages(engine = 'array', normalizeAll = True, ignore_subtypes = True, columnar = True, trace = False, ingested = True):
+    """Run every stage of gardnm() once from the current directory
+
+    Args:
+        engine: 'array' or 'pandas', see gardnm
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        columnar: read through the compiled column files, see load_sources
+        trace: measure the peak memory of each stage with tracemalloc instead of timing it
+        ingested: read the canonical table of ingest.py, see load_sources
+
+    Returns:
+        results: dictionary of stage -> seconds (or peak bytes when tracing)
+    """
+    results = {}
+
+    def measure(stage, function, *args):
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        out = function(*args)
+        results[stage] = time.perf_counter() - start
+        if trace:
+            results[stage] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return out
+
+    source_ratings, source_types, source_subtypes, data = measure('1_load', main.load_sources, False, columnar, ingested)
+    measure('2_process', main.process_sources, data, normalizeAll, source_ratings, source_subtypes, ignore_subtypes)
+    states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+    subrankings = measure('3_subrank', main.subrank, data, source_types, source_subtypes, states, ignore_subtypes, engine)
+    combine = combine_arrays if engine == 'array' else main.combine_pandas
+    rankings = measure('4_combine', combine, subrankings, states, source_types)
+    measure('5_save', rankings.to_csv, 'data/outputs/benchmark.csv')
+    results['locations'] = len(rankings)
+
+    return results
+
+
+def benchmark(n_sources = 200, n_cities = 20000, engine = 'array', repeats = 3, seed = 0, normalizeAll = True, ignore_subtypes = True, columnar = True, ingested = True):
+    """Benchmark every stage of the model on a synthetic data tree
+
+    Args:
+        n_sources: number of synthetic sources
+        n_cities: number of synthetic cities
+        engine: 'array' or 'pandas', see gardnm
+        repeats: number of timed runs, the best one is kept
+        seed: random seed of the synthetic data
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        columnar: read through the compiled column files, see load_sources
+        ingested: read the canonical table of ingest.py, see load_sources
+
+    Returns:
+        results: dictionary of the run configuration, environment and per-stage results
+    """
+    root = synthetic_root(n_sources, n_cities, seed)
+    runs = []
+    with working_directory(root), contextlib.redirect_stdout(io.StringIO()): # the model warns about every odd synthetic source
+        for _ in range(repeats):
+            runs.append(run_stages(engine, normalizeAll, ignore_subtypes, columnar, ingested=ingested))
+        peaks = run_stages(engine, normalizeAll, ignore_subtypes, columnar, trace=True, ingested=ingested)
+
+    stages = {}
+    for stage in STAGES:
+        seconds = [run[stage] for run in runs]
+        stages[stage] = {'seconds': min(seconds), 'first': seconds[0], 'peak_mb': peaks[stage] / 1e6}
+
+    import git # only to record the commit
+
+    repo = git.Repo(ROOT)
+    commit = repo.head.commit
+    return {
+        'commit': commit.hexsha,
+        'summary': commit.summary,
+        'dirty': repo.is_dirty(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'config': {'n_sources': n_sources, 'n_cities': n_cities, 'seed': seed, 'engine': engine, 'repeats': repeats, 'normalizeAll': normalizeAll, 'ignore_subtypes': ignore_subtypes, 'columnar': columnar, 'ingested': ingested},
+        'locations': runs[0]['locations'],
+        'stages': stages,
+        'total': sum(stage['seconds'] for stage in stages.values()),
+    }
+
+
+def save_results(results, directory = './data/benchmarks'):
+    """Save benchmark results as JSON, named by date and commit
+
+    Returns:
+        path: where the results were saved
+    """
+    os.makedirs(directory, exist_ok=True)
+    config = results['config']
+    path = os.path.join(directory, f"{results['date'].replace(':', '')}-{results['commit'][:8]}-{config['engine']}-s{config['n_sources']}-c{config['n_cities']}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    return path
+
+
+def print_results(results):
+    """Print one line per stage"""
+    config = results['config']
+    print(f"{results['commit'][:8]} {results['summary']}")
+    print(f"{config['engine']} engine, {config['n_sources']} sources, {results['locations']} locations")
+    for stage, r in results['stages'].items():
+        print(f"    {stage:<10} {r['seconds']*1000:10.1f} ms (first {r['first']*1000:10.1f} ms) {r['peak_mb']:8.1f} MB peak")
+    print(f"    {'total':<10} {results['total']*1000:10.1f} ms")
+
+
+def compare(old, new):
+    """Print the change of every stage between two result files
+
+    Args:
+        old: path to the baseline results
+        new: path to the results to compare against it
+    """
+    with open(old, 'r') as f:
+        old = json.load(f)
+    with open(new, 'r') as f:
+        new = json.load(f)
+
+    if old['config'] != new['config']:
+        print(f" ---   WARNING: the runs used different configurations: {old['config']} vs {new['config']}")
+    print(f"{old['commit'][:8]} -> {new['commit'][:8]}")
+    for stage in STAGES + ['total']:
+        before = old['total'] if stage == 'total' else old['stages'][stage]['seconds']
+        after = new['total'] if stage == 'total' else new['stages'][stage]['seconds']
+        line = f"    {stage:<10} {before*1000:10.1f} ms -> {after*1000:10.1f} ms ({after/before:5.2f}x)"
+        if stage != 'total':
+            line += f"  {old['stages'][stage]['peak_mb']:8.1f} MB -> {new['stages'][stage]['peak_mb']:8.1f} MB"
+        print(line)
+
+
+def import_times(command):
+    """Cumulative import time of every top-level module of a command, from python -X importtime
+
+    Returns:
+        times: dictionary of module -> seconds, longest first
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', LAUNCHER, *command], capture_output=True, text=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            cumulative, module = line.split('|')[1:]
+            if not module.startswith('  '): # nested imports are counted in their parent
+                times[module.strip()] = int(cumulative) / 1e6
+
+    return dict(sorted(times.items(), key=lambda item: -item[1]))
+
+
+def prepare_lookup(command):
+    """Make sure the saved rankings a lookup command reads exist, exporting them from the csv rankings if needed
+
+    Args:
+        command: argument list for scripts/gardnm
+
+    Returns:
+        ready: False when the command is a lookup in rankings that cannot be found
+    """
+    if command[0] != 'lookup':
+        return True
+    output_format = command[command.index('--format') + 1] if '--format' in command else 'csv'
+    name = output_name('gardnm', '--raw' not in command)
+    if os.path.exists(output_path(name, output_format)):
+        return True
+    if output_format == 'csv' or not os.path.exists(output_path(name, 'csv')):
+        print(f" ---   WARNING: no saved rankings for {' '.join(command)}... skipping!")
+        return False
+    save_rankings(read_rankings(name, 'csv'), name, output_format)
+    return True
+
+
+def startup(commands = STARTUP_COMMANDS, repeats = 5):
+    """Time the command-line interface from a fresh interpreter
+
+    Args:
+        commands: list of argument lists for scripts/gardnm, lookups in a format that was never saved are exported
+            from the csv rankings first
+        repeats: number of timed runs of every command, the best one is kept
+
+    Returns:
+        results: dictionary of ' '.join(command) -> seconds over a bare interpreter, with the baseline under 'python'
+    """
+    def best(arguments):
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *arguments], capture_output=True, check=True)
+            seconds.append(time.perf_counter() - start)
+        return min(seconds)
+
+    baseline = best(['-c', 'pass'])
+    results = {'python': baseline}
+    for command in commands:
+        if not prepare_lookup(command):
+            continue
+        results[' '.join(command)] = best([LAUNCHER, *command]) - baseline
+
+    return results
+
+
+def print_startup(results):
+    """Print the startup time of every command, and the slowest imports of those over STARTUP_BUDGET"""
+    print(f"    {'python':<50} {results['python']*1000:8.1f} ms")
+    for command, seconds in results.items():
+        if command == 'python':
+            continue
+        print(f"    {command:<50} {seconds*1000:+8.1f} ms")
+        if seconds > STARTUP_BUDGET:
+            slowest = list(import_times(command.split()).items())[:5]
+            print(f" ---   WARNING: over the budget of {STARTUP_BUDGET*1000:.0f} ms, slowest imports: " + ', '.join(f'{m} {t*1000:.1f} ms' for m, t in slowest))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the GARDN-M model on synthetic data')
+    parser.add_argument('--sources', type=int, default=200)
+    parser.add_argument('--cities', type=int, default=20000)
+    parser.add_argument('--engine', default='array', choices=['array', 'pandas'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', action='store_true', help='read the processed CSVs instead of the compiled columns')
+    parser.add_argument('--per-source', action='store_true', help='read every source on its own instead of the ingested table')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved results instead of running')
+    parser.add_argument('--startup', action='store_true', help='time the command-line interface instead of the model')
+    args = parser.parse_args()
+    enter_root()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.startup:
+        print_startup(startup(repeats=args.repeats))
+    else:
+        results = benchmark(args.sources, args.cities, args.engine, args.repeats, args.seed, columnar=not args.csv, ingested=not args.per_source)
+        print_results(results)
+        print(f'Results have been saved to {save_results(results)}')
@@ -0,0 +1,261 @@
+"""
+Bootstrap confidence intervals for the GARDN-M coefficients.
+
+For every location and source_type, the sources that have a value for the
+location are resampled with replacement, and the subranking M is recomputed
+as the weighted average sum(c * B * PSW) / sum(c * PSW) over the resampled
+counts c. Cities without any source of a source_type take the draws of
+their state, as in engine.py, and the draws of M average the draws of the
+source_types, so the intervals of M also reflect how many source_types
+cover a location.
+
+Resampling counts are multinomial and drawn once per source_type and number
+of sources, shared by every location with that many sources: each location
+still gets a proper bootstrap distribution, and all draws of a group reduce
+to one (locations x sources) @ (sources x draws) product, or to a product
+with the few distinct resamples when there are only a few sources. Locations
+are processed in chunks, spread over a process pool when there is more than
+one and more than one CPU.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from engine import build_locations, build_matrices, subtype_groups, subtype_weights
+
+
+def prepare_bootstrap(data, source_types, states, source_subtypes = None):
+    """Arrange B*PSW and PSW of every source_type with each location's valid sources first
+
+    Args:
+        data: dictionary of source data, each with State, City, B, W and PSW
+        source_types: dictionary of source_type -> list of sources
+        states: sorted array of every state found in the data
+        source_subtypes: dictionary of source -> subtype, or None to ignore subtypes, see engine.subrank_arrays
+
+    Returns:
+        locations: LocationIndex of every (State, City)
+        types: list of (BP, PSW, n) per source_type, (locations x sources) arrays and the number of valid sources
+    """
+    sources = [s for st_list in source_types.values() for s in st_list if s in data]
+    locations = build_locations(data, source_types, states)
+    B, PSW, present = build_matrices(data, sources, locations)
+    col = {s: j for j, s in enumerate(sources)}
+
+    types = []
+    for st_list in source_types.values():
+        cols = [col[s] for s in st_list if s in data]
+        Bt = B[:, cols]
+        PSWt = PSW[:, cols]
+        if source_subtypes is not None:
+            W = np.array([data[s]['W'].iloc[0] for s in st_list if s in data], dtype=float)
+            PSWt = PSWt * subtype_weights(PSWt, W, subtype_groups([s for s in st_list if s in data], source_subtypes))
+        valid = ~np.isnan(Bt) & ~np.isnan(PSWt)
+        first = np.argsort(~valid, axis=1, kind='stable') # valid sources first, in source order
+        BP = np.take_along_axis(np.where(valid, Bt * PSWt, 0), first, axis=1)
+        PSWt = np.take_along_axis(np.where(valid, PSWt, 0), first, axis=1)
+        types.append((BP, PSWt, valid.sum(axis=1)))
+
+    return locations, types
+
+
+def draw_counts(types, draws, seed = 0):
+    """Multinomial resampling counts for every source_type and number of sources
+
+    With few sources there are only a few distinct resamples (10 for three
+    sources), so the draws are kept as the distinct count vectors, how often
+    each was drawn and which one every draw is.
+
+    Args:
+        types: output of prepare_bootstrap
+        draws: number of bootstrap draws
+        seed: random seed
+
+    Returns:
+        counts: list per source_type of dictionaries n -> (patterns, inverse, weights), the distinct
+            (patterns x n) counts, the pattern of every draw and the number of draws of every pattern;
+            inverse and weights are None when there are too many distinct patterns to be worth it
+    """
+    rng = np.random.default_rng(seed)
+    counts = []
+    for BP, PSW, n in types:
+        type_counts = {}
+        for k in np.unique(n[n > 0]):
+            c = rng.multinomial(k, np.full(k, 1 / k), size=draws)
+            patterns, inverse = np.unique(c, axis=0, return_inverse=True)
+            if 4 * len(patterns) <= draws:
+                type_counts[k] = (patterns.astype(float), inverse.ravel(), np.bincount(inverse.ravel(), minlength=len(patterns)))
+            else:
+                type_counts[k] = (c.astype(float), None, None)
+        counts.append(type_counts)
+    return counts
+
+
+def pattern_quantiles(values, weights, quantiles, draws):
+    """np.quantile of draws given as distinct values and how often each was drawn
+
+    Args:
+        values: (locations x patterns) array of the value of every pattern
+        weights: number of draws of every pattern
+        quantiles: quantiles to compute
+        draws: number of draws, the sum of weights
+
+    Returns:
+        bounds: (quantiles x locations) array
+    """
+    order = np.argsort(values, axis=1)
+    ordered = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(weights[order], axis=1)
+    rows = np.arange(len(values))
+
+    bounds = []
+    for q in quantiles:
+        # linear interpolation between the draws just below and above, as np.quantile
+        h = q * (draws - 1)
+        i = int(np.floor(h))
+        below = ordered[rows, (cumulative <= i).sum(axis=1)]
+        above = ordered[rows, (cumulative <= min(i + 1, draws - 1)).sum(axis=1)]
+        bounds.append(below + (h - i) * (above - below))
+    return np.array(bounds)
+
+
+def chunk_intervals(chunk, counts, draws, quantiles, states = None):
+    """Intervals of M and every M_<source_type> for one chunk of locations
+
+    Args:
+        chunk: list per source_type of (BP, PSW, n) for the chunk, plus the parent state ID of every location (-1 for states)
+        counts: output of draw_counts
+        draws: number of bootstrap draws
+        quantiles: lower and upper quantile
+        states: (intervals, draws) of the states, as returned for them; None while computing the states themselves
+
+    Returns:
+        intervals: (2 x locations x (1 + source_types)) array of lower and upper bounds, M first
+        Mt: list per source_type of (locations x draws) arrays of draws, only for the states
+    """
+    types, parent = chunk
+    intervals = np.full((2, len(parent), 1 + len(types)), np.nan)
+    total = np.zeros((len(parent), draws))
+    count = np.zeros(len(parent))
+    Mt = []
+    for t, (BP, PSW, n) in enumerate(types):
+        if states is None:
+            Mt.append(np.full((len(parent), draws), np.nan))
+        for k, (patterns, inverse, weights) in counts[t].items():
+            rows = np.flatnonzero(n == k)
+            if not len(rows):
+                continue
+            M = (BP[rows, :k] @ patterns.T) / (PSW[rows, :k] @ patterns.T)
+            if inverse is None:
+                intervals[:, rows, 1 + t] = np.quantile(M, quantiles, axis=1)
+            else:
+                intervals[:, rows, 1 + t] = pattern_quantiles(M, weights, quantiles, draws)
+                M = M[:, inverse]
+            total[rows] += M
+            count[rows] += 1
+            if states is None:
+                Mt[t][rows] = M
+
+        if states is not None:
+            # fill data from sets missing cities, with the draws and intervals of their state
+            state_intervals, state_draws = states
+            missing = n == 0
+            intervals[:, missing, 1 + t] = state_intervals[:, parent[missing], 1 + t]
+            fallback = np.flatnonzero(missing & ~np.isnan(state_draws[t][parent, 0]))
+            total[fallback] += state_draws[t][parent[fallback]]
+            count[fallback] += 1
+
+    # M averages the source_types that have a value
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total /= count[:, None]
+    intervals[:, :, 0] = np.quantile(total, quantiles, axis=1)
+
+    return intervals, Mt
+
+
+_shared = {}
+
+
+def _init_worker(counts, draws, quantiles, states):
+    """Keep what every chunk needs in the worker process, so it is only sent once"""
+    _shared.update(counts=counts, draws=draws, quantiles=quantiles, states=states)
+
+
+def _city_intervals(chunk):
+    return chunk_intervals(chunk, _shared['counts'], _shared['draws'], _shared['quantiles'], _shared['states'])[0]
+
+
+def bootstrap_intervals(data, source_types, states, draws = 5000, confidence = 0.95, seed = 0, workers = None, chunk_size = None, source_subtypes = None):
+    """Bootstrap confidence intervals of M and every M_<source_type>
+
+    Args:
+        data: dictionary of source data, each with State, City, B, W and PSW
+        source_types: dictionary of source_type -> list of sources
+        states: sorted array of every state found in the data
+        draws: number of bootstrap draws
+        confidence: coverage of the intervals
+        seed: random seed
+        workers: number of processes, defaults to the number of CPUs (only used for more than one chunk)
+        chunk_size: number of locations per chunk, defaults to about half a million draws per chunk
+        source_subtypes: dictionary of source -> subtype, or None to ignore subtypes, see engine.subrank_arrays
+
+    Returns:
+        locations: LocationIndex of every (State, City)
+        intervals: dictionary of column -> (lower, upper) arrays by location ID, for M and every M_<source_type>
+    """
+    locations, types = prepare_bootstrap(data, source_types, states, source_subtypes)
+    counts = draw_counts(types, draws, seed)
+    quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+    columns = ['M'] + [f'M_{source_type}' for source_type in source_types]
+
+    def take(rows):
+        return [tuple(a[rows] for a in t) for t in types], locations.parent[rows]
+
+    # the states come first (IDs 0..n_states-1), their draws are the fallback of their cities
+    state_rows = np.flatnonzero(locations.parent < 0)
+    state_results = chunk_intervals(take(state_rows), counts, draws, quantiles)
+
+    city_rows = np.flatnonzero(locations.parent >= 0)
+    chunk_size = chunk_size or max(1, 500_000 // draws)
+    chunks = [city_rows[i:i+chunk_size] for i in range(0, len(city_rows), chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(counts, draws, quantiles, state_results)) as pool:
+            results = list(pool.map(_city_intervals, [take(rows) for rows in chunks]))
+    else:
+        results = [chunk_intervals(take(rows), counts, draws, quantiles, state_results)[0] for rows in chunks]
+
+    bounds = np.full((2, len(locations), len(columns)), np.nan)
+    bounds[:, state_rows] = state_results[0]
+    for rows, chunk_bounds in zip(chunks, results):
+        bounds[:, rows] = chunk_bounds
+
+    return locations, {column: (bounds[0, :, j], bounds[1, :, j]) for j, column in enumerate(columns)}
+
+
+def add_intervals(rankings, data, source_types, states, draws = 5000, confidence = 0.95, seed = 0, workers = None, source_subtypes = None):
+    """Add <column>_lo and <column>_hi bootstrap bounds for M and every M_<source_type> to the rankings
+
+    Args:
+        rankings: DataFrame of the final rankings, with State and City
+        data: dictionary of source data, each with State, City, B, W and PSW
+        source_types: dictionary of source_type -> list of sources
+        states: sorted array of every state found in the data
+        draws: number of bootstrap draws
+        confidence: coverage of the intervals
+        seed: random seed
+        workers: number of processes, see bootstrap_intervals
+        source_subtypes: dictionary of source -> subtype, or None to ignore subtypes, see engine.subrank_arrays
+
+    Returns:
+        rankings: the same DataFrame, with the bounds added
+    """
+    locations, intervals = bootstrap_intervals(data, source_types, states, draws, confidence, seed, workers, source_subtypes=source_subtypes)
+    rows = locations.get(rankings['State'].values, rankings['City'].values)
+    for column, (lo, hi) in intervals.items():
+        rankings[f'{column}_lo'] = lo[rows]
+        rankings[f'{column}_hi'] = hi[rows]
+
+    return rankings
@@ -0,0 +1,105 @@
+"""
+Persistent cache for intermediate results of the GARDN-M model.
+
+Entries live under data/cache/ and are addressed by a key that hashes
+everything the result depends on (file contents, the relevant entries of the
+source JSONs, run options), so a stale entry is never read back: it simply
+stops being looked up and is replaced on the next store.
+"""
+
+import hashlib
+import json
+import os
+import glob
+import threading
+
+CACHE_DIR = './data/cache/'
+CACHE_VERSION = 2 # bump when the cached computations change
+HASH_LOCK = threading.Lock()
+
+
+def file_hash(path):
+    """Content hash of a file, remembered by modification time and size
+
+    Args:
+        path: path to the file
+
+    Returns:
+        hash: hex digest of the file contents
+    """
+    with HASH_LOCK: # threads of one run share the index file
+        index_path = os.path.join(CACHE_DIR, 'file_hashes.json')
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+
+        stat = os.stat(path)
+        known = index.get(path)
+        if known is not None and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return known[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        index[path] = [stat.st_mtime_ns, stat.st_size, sha.hexdigest()]
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temporary = f'{index_path}.{os.getpid()}'
+        with open(temporary, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary, index_path) # atomic, so concurrent runs never read a partial index
+
+    return sha.hexdigest()
+
+
+def make_key(*parts):
+    """Hash any JSON-serializable inputs into a cache key
+
+    Args:
+        parts: the inputs a cached result depends on
+
+    Returns:
+        key: hex digest
+    """
+    text = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def load_cached(kind, name, key):
+    """Read back a cached result
+
+    Args:
+        kind: subdirectory of the cache, e.g. 'sources' or 'subrankings'
+        name: name of the entry, e.g. the source name
+        key: cache key from make_key
+
+    Returns:
+        obj: the cached object, or None if there is no entry for this key
+    """
+    import pandas as pd # only when a cached result is read, checking keys stays light
+
+    path = os.path.join(CACHE_DIR, kind, f'{name}-{key[:16]}.pkl')
+    if not os.path.exists(path):
+        return None
+    return pd.read_pickle(path)
+
+
+def store_cached(kind, name, key, obj):
+    """Write a result to the cache, replacing older entries of the same name
+
+    Args:
+        kind: subdirectory of the cache, e.g. 'sources' or 'subrankings'
+        name: name of the entry, e.g. the source name
+        key: cache key from make_key
+        obj: object to store
+    """
+    import pandas as pd
+
+    directory = os.path.join(CACHE_DIR, kind)
+    os.makedirs(directory, exist_ok=True)
+    for stale in glob.glob(os.path.join(directory, f'{glob.escape(name)}-{"?"*16}.pkl')):
+        os.remove(stale)
+    pd.to_pickle(obj, os.path.join(directory, f'{name}-{key[:16]}.pkl'))
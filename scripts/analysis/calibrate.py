@@ -0,0 +1,411 @@
+"""
+Calibration of the source ratings to a target ranking.
+
+Finds the primacy ratings P (the first entry of source_ratings.json) under
+which the model best reproduces a target: expert scores, a ranking, or the M
+column of an earlier output such as gardnm_newWeighting.csv. It works on the
+same vectorized form as sweep.py, where the subranking of a source_type is
+
+    M_t = (nPSW / n) * (B @ PW) / (1_PSW @ PW),   PW = P * W
+
+for every location, and the final M averages the subrankings found for the
+location after the state fallbacks. M_t is a ratio of two linear functions
+of P, so its derivatives are analytic, and the fit is a Levenberg-Marquardt
+least squares on the residuals of M inside the bounds, followed by a greedy
+search over +-1 moves when the ratings must be integers.
+
+Only the locations in the target and the (row, source) entries they draw on
+are kept, so an iteration or an evaluation of every +-1 move costs a few
+passes over those entries and one (sources x sources) system, even with
+hundreds of sources.
+
+The sensitivities S_city and S_state of assign_PSW are not fitted: every
+row of a subranking is either a city or a state, so S scales both the
+numerator and avgPSW of the row and cancels out of M.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from locations import join_keys
+from main import load_config, load_sources, process_sources
+from names import load_name_index, resolve_names
+from paths import enter_root
+from sweep import prepare_sweep
+
+
+def read_target(target, names, column = None):
+    """Read the target scores or ranking
+
+    Args:
+        target: DataFrame or path to a CSV with State, City (empty or missing for state rows) and the target column
+        names: place-name index from names.load_name_index, to match the names of the target to the sources
+        column: column to fit, defaults to the first of M, Score or Rank; ranks are fitted as -Rank
+
+    Returns:
+        target: DataFrame of State, City and y, higher is better
+    """
+    if isinstance(target, str):
+        target = pd.read_csv(target)
+    if column is None:
+        column = next((c for c in ['M', 'Score', 'Rank'] if c in target.columns), None)
+        if column is None:
+            raise ValueError(f'The target needs an M, Score or Rank column, found {list(target.columns)}')
+
+    y = target[column].values.astype(float)
+    state, city, resolved = resolve_names(target['State'].values, target['City'].values if 'City' in target.columns else None, names)
+    if not resolved.all():
+        print(f' ---   WARNING: {(~resolved).sum()} place names of the target could not be resolved, see names.py')
+    return pd.DataFrame({
+        'State': state,
+        'City': city,
+        'y': -y if column == 'Rank' else y,
+    }).dropna(subset=['y'])
+
+
+def calibration_model(prepared, target):
+    """Reduce a prepared sweep to the values that the target locations draw on
+
+    Every source_type is kept as a list of its (row, source) entries, the
+    sources with a weight for the row, since a row only has a few of them.
+
+    Args:
+        prepared: output of sweep.prepare_sweep
+        target: output of read_target
+
+    Returns:
+        model: dictionary of the per-source_type entries and the row of every target location
+        y: target value of every matched location
+    """
+    locations = prepared['locations']
+    keys = pd.Index(join_keys(locations['State'].values, locations['City'].values))
+    found = keys.get_indexer(join_keys(target['State'].values, target['City'].values))
+    if (found < 0).any():
+        missing = target[found < 0]
+        print(f' ---   WARNING: {len(missing)} target locations were not found, e.g. {missing[["State", "City"]].head(3).values.tolist()}... skipping!')
+    target_pos = found[found >= 0]
+
+    count = np.zeros(len(target_pos))
+    types = []
+    for j, t in enumerate(prepared['types']):
+        # row of this source_type that every target location ends up with
+        row_of_position = np.full(len(locations), -1)
+        row_of_position[t['position']] = np.arange(len(t['position']))
+        locs = np.flatnonzero(prepared['found4'][target_pos, j])
+        rows, src = np.unique(t['fill3'][row_of_position[prepared['fill4'][target_pos[locs], j]]], return_inverse=True)
+        count[locs] += 1
+
+        row, col = np.nonzero(t['PSW'][rows])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = t['nPSW'][rows] / t['n'][rows]
+
+        # (entry, location) pairs: every location that draws on the row of an entry
+        by_row = np.argsort(src, kind='stable')
+        per_row = np.bincount(src, minlength=len(rows))
+        starts = np.cumsum(per_row) - per_row
+        pair_entry = np.repeat(np.arange(len(row)), per_row[row])
+        offset = np.arange(len(pair_entry)) - np.repeat(np.cumsum(per_row[row]) - per_row[row], per_row[row])
+        types.append({
+            'rows': len(rows),
+            'row': row,
+            'col': np.asarray(t['cols'])[col],
+            'B': t['B'][rows][row, col],
+            'A': t['PSW'][rows][row, col],
+            'ratio': ratio,
+            'locs': locs,
+            'src': src,
+            'pair_entry': pair_entry,
+            'pair_loc': locs[by_row][starts[row][pair_entry] + offset],
+        })
+
+    keep = count > 0
+    index = np.cumsum(keep) - 1
+    for t in types:
+        t['locs'] = index[t['locs']]
+        t['pair_loc'] = index[t['pair_loc']]
+
+    return {'types': types, 'count': count[keep], 'W': prepared['W']}, target['y'].values[found >= 0][keep]
+
+
+def subrankings(t, PW):
+    """Weighted sums and subranking M of every row of one source_type
+
+    Returns:
+        num: sum of B*PW over the sources of the row
+        den: sum of A*PW over the sources of the row, A is 1 unless subtypes apply
+        Mt: (nPSW / n) * num / den
+    """
+    num = np.bincount(t['row'], weights=t['B'] * PW[t['col']], minlength=t['rows'])
+    den = np.bincount(t['row'], weights=t['A'] * PW[t['col']], minlength=t['rows'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return num, den, t['ratio'] * num / den
+
+
+def forward(model, P):
+    """Final M of the target locations
+
+    Args:
+        model: output of calibration_model
+        P: (sources) array of primacy ratings
+
+    Returns:
+        M: (locations) array
+    """
+    PW = P * model['W']
+    M = np.zeros(len(model['count']))
+    for t in model['types']:
+        M[t['locs']] += subrankings(t, PW)[2][t['src']]
+    return M / model['count']
+
+
+def jacobian(model, P):
+    """Derivatives of the final M of every target location with respect to every rating
+
+    Args:
+        model: output of calibration_model
+        P: (sources) array of primacy ratings
+
+    Returns:
+        J: (locations x sources) array
+    """
+    PW = P * model['W']
+    J = np.zeros((len(model['count']), len(P)))
+    for t in model['types']:
+        num, den, Mt = subrankings(t, PW)
+        # d/dp of (b.p)/(a.p) is (b - (b.p)/(a.p) * a) / (a.p)
+        entry = t['ratio'][t['row']] * (t['B'] - (num / den)[t['row']] * t['A']) / den[t['row']] * model['W'][t['col']]
+        J[t['pair_loc'], t['col'][t['pair_entry']]] = entry[t['pair_entry']] / model['count'][t['pair_loc']]
+    return J
+
+
+def mse(S1, S2, Sy, y):
+    """Mean squared error, for targets on the scale of M, from sum(M), sum(M**2) and sum(M*y)"""
+    return (S2 - 2 * Sy + y @ y) / len(y)
+
+
+def correlation(S1, S2, Sy, y):
+    """1 - Pearson correlation, for rankings or scores on another scale, from sum(M), sum(M**2) and sum(M*y)"""
+    n = len(y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1 - (n * Sy - S1 * y.sum()) / np.sqrt((n * S2 - S1**2) * (n * (y @ y) - y.sum()**2))
+
+
+OBJECTIVES = {'mse': mse, 'correlation': correlation}
+
+
+def evaluate(model, y, P, objective):
+    """Loss of one set of ratings"""
+    M = forward(model, P)
+    return objective(M.sum(), M @ M, M @ y, y)
+
+
+def fit_continuous(model, y, P, lower, upper, affine, iterations = 100, tol = 1e-10):
+    """Levenberg-Marquardt on the residuals of M, with the ratings kept inside the bounds
+
+    With affine, the residuals are those of a * M + b against the target, with
+    a > 0 and b fitted as well; their least squares solution maximizes the
+    correlation of M with the target.
+
+    Returns:
+        P: fitted ratings
+        iterations: number of iterations used
+    """
+    def residuals(P, ab):
+        M = forward(model, P)
+        return M, (ab[0] * M + ab[1] if affine else M) - y
+
+    P = np.clip(P, lower, upper)
+    M, _ = residuals(P, (1, 0))
+    ab = np.polyfit(M, y, 1) if affine else np.array([1.0, 0.0])
+    if ab[0] <= 0: # fit a positive correlation, a negative a would reward reversing the ranking
+        ab = np.array([y.std() / M.std(), y.mean() - y.std() / M.std() * M.mean()])
+    M, r = residuals(P, ab)
+    cost = r @ r
+    damping = 1e-3
+    for i in range(iterations):
+        J = jacobian(model, P) * ab[0]
+        if affine:
+            J = np.column_stack([J, M, np.ones_like(M)])
+        g = J.T @ r
+        H = J.T @ J
+
+        # ratings held at a bound by the gradient stay out of the step
+        free = np.ones(len(g), dtype=bool)
+        free[:len(P)] = ~(((P <= lower) & (g[:len(P)] > 0)) | ((P >= upper) & (g[:len(P)] < 0)))
+        free[:len(P)] &= lower < upper
+        Hf = H[np.ix_(free, free)]
+        while True:
+            step = np.zeros(len(g))
+            step[free] = np.linalg.solve(Hf + damping * (np.diag(np.diag(Hf)) + 1e-12 * np.eye(len(Hf))), -g[free])
+            P_new = np.clip(P + step[:len(P)], lower, upper)
+            ab_new = np.array([max(ab[0] + step[len(P)], 1e-6 * ab[0]), ab[1] + step[len(P) + 1]]) if affine else ab
+            M_new, r_new = residuals(P_new, ab_new)
+            if r_new @ r_new < cost or damping > 1e12:
+                break
+            damping *= 4
+
+        improvement = cost - r_new @ r_new
+        if improvement > 0:
+            P, ab, M, r, cost = P_new, ab_new, M_new, r_new, r_new @ r_new
+            damping = max(damping / 3, 1e-12)
+        if improvement <= tol * max(cost, 1e-300) or np.abs(step[:len(P)]).max() < 1e-9:
+            break
+
+    return P, i + 1
+
+
+def move_losses(model, y, P, step, objective):
+    """Loss after moving each rating by step, one rating at a time
+
+    A rating only changes the rows of its source_type that it has a weight
+    in, so every move is worked out from the change of those rows alone.
+
+    Returns:
+        losses: (sources) array
+    """
+    PW = P * model['W']
+    M = forward(model, P)
+    S = np.zeros((3, len(P))) + np.array([M.sum(), M @ M, M @ y])[:, None]
+    for t in model['types']:
+        num, den, Mt = subrankings(t, PW)
+        dPW = step * model['W'][t['col']]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            change = t['ratio'][t['row']] * (num[t['row']] + dPW * t['B']) / (den[t['row']] + dPW * t['A']) - Mt[t['row']]
+        D = change[t['pair_entry']] / model['count'][t['pair_loc']]
+        col = t['col'][t['pair_entry']]
+        S[0] += np.bincount(col, weights=D, minlength=len(P))
+        S[1] += np.bincount(col, weights=(2 * M[t['pair_loc']] + D) * D, minlength=len(P))
+        S[2] += np.bincount(col, weights=D * y[t['pair_loc']], minlength=len(P))
+
+    return objective(*S, y)
+
+
+def fit_integer(model, y, P, lower, upper, objective, iterations = 10000):
+    """Round the ratings, then move one rating by one while that improves the loss
+
+    Returns:
+        P: fitted integer ratings
+        loss: final loss
+        iterations: number of moves made
+    """
+    lower, upper = np.ceil(lower), np.floor(upper)
+    P = np.clip(np.round(P), lower, upper)
+    loss = evaluate(model, y, P, objective)
+    for i in range(iterations):
+        up = np.where(P + 1 <= upper, move_losses(model, y, P, 1, objective), np.inf)
+        down = np.where(P - 1 >= lower, move_losses(model, y, P, -1, objective), np.inf)
+        best = min(up.min(), down.min())
+        if not best < loss - 1e-12:
+            return P, loss, i
+        if up.min() <= down.min():
+            P[up.argmin()] += 1
+        else:
+            P[down.argmin()] -= 1
+        loss = best
+
+    return P, loss, iterations
+
+
+def calibrate(
+    target,
+    column = None,
+    objective = 'correlation',
+    bounds = (1, 5),
+    integer = True,
+    fixed = (),
+    normalizeAll = True,
+    ignore_subtypes = True,
+    iterations = 100,
+    verbose = False,
+):
+    """Fit the primacy ratings P so the model reproduces a target ranking or scores
+
+    Args:
+        target: DataFrame or path to a CSV with State, City and the target column, see read_target
+        column: column of the target to fit, see read_target
+        objective: 'correlation' (1 - Pearson correlation, for rankings and scores on any scale) or 'mse' (for scores on the 0-10 scale of M)
+        bounds: lower and upper bound of every rating
+        integer: keep the ratings whole numbers, as in source_ratings.json
+        fixed: sources whose rating is kept as it is
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        iterations: maximum number of Levenberg-Marquardt iterations
+        verbose: some extra print statements that may be useful when debugging
+
+    Returns:
+        result: dictionary with the fitted source_ratings (same shape as source_ratings.json), P before and after,
+            the loss before and after, the number of locations fitted and the iterations used
+    """
+    statename_to_abbr, source_ratings = load_config()[:2]
+    names = load_name_index(statename_to_abbr, list(source_ratings))
+    source_ratings, source_types, source_subtypes, data = load_sources(verbose)
+    process_sources(data, normalizeAll, source_ratings, source_subtypes, ignore_subtypes)
+    states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+
+    prepared = prepare_sweep(data, source_types, states, None if ignore_subtypes else source_subtypes)
+    model, y = calibration_model(prepared, read_target(target, names, column))
+    sources = prepared['sources']
+    objective_function = OBJECTIVES[objective]
+
+    P0 = np.array([source_ratings[s][0] for s in sources], dtype=float)
+    lower = np.where(np.isin(sources, list(fixed)), P0, bounds[0])
+    upper = np.where(np.isin(sources, list(fixed)), P0, bounds[1])
+    loss0 = evaluate(model, y, P0, objective_function)
+
+    P, steps = fit_continuous(model, y, P0, lower, upper, objective == 'correlation', iterations)
+    loss = evaluate(model, y, P, objective_function)
+    if verbose:
+        print(f'Continuous fit: {objective} {loss0:.6g} -> {loss:.6g} in {steps} steps')
+    moves = 0
+    if integer:
+        P, loss, moves = fit_integer(model, y, P, lower, upper, objective_function)
+        P = P.astype(int)
+        if verbose:
+            print(f'Integer fit: {objective} {loss:.6g} after {moves} moves')
+
+    fitted = {source: list(ratings) for source, ratings in source_ratings.items()}
+    for source, p in zip(sources, P):
+        fitted[source][0] = p.item()
+
+    return {
+        'source_ratings': fitted,
+        'P_before': pd.Series(P0, index=sources),
+        'P': pd.Series(P, index=sources),
+        'loss_before': loss0,
+        'loss': loss,
+        'locations': len(y),
+        'iterations': steps,
+        'moves': moves,
+    }
+
+
+def save_ratings(source_ratings, path):
+    """Save fitted ratings in the format of source_ratings.json"""
+    with open(path, 'w') as f:
+        json.dump(source_ratings, f, indent=6)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the source ratings to a target ranking or scores')
+    parser.add_argument('target', help='CSV with State, City and M, Score or Rank')
+    parser.add_argument('--column', default=None)
+    parser.add_argument('--objective', default='correlation', choices=list(OBJECTIVES))
+    parser.add_argument('--bounds', type=float, nargs=2, default=(1, 5))
+    parser.add_argument('--continuous', action='store_true', help='allow ratings that are not whole numbers')
+    parser.add_argument('--raw', action='store_true', help='do not normalize the raw data (normalizeAll=False)')
+    parser.add_argument('--output', default=None, help='where to save the fitted source_ratings.json')
+    args = parser.parse_args()
+    target = os.path.abspath(args.target) # given from where the command was run, not from the repository root
+    output = os.path.abspath(args.output) if args.output else None
+    enter_root()
+
+    result = calibrate(target, args.column, args.objective, args.bounds, not args.continuous, normalizeAll=not args.raw, verbose=True)
+    print(pd.DataFrame({'before': result['P_before'], 'after': result['P']}).to_string())
+    print(f"{args.objective}: {result['loss_before']:.6g} -> {result['loss']:.6g} over {result['locations']} locations")
+    if output:
+        save_ratings(result['source_ratings'], output)
+        print(f'Ratings have been saved to {output}')
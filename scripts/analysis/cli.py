@@ -0,0 +1,247 @@
+"""
+Command-line interface of the GARDN-M model, run through scripts/gardnm.
+
+    gardnm run [--config run.json] [options]   run gardnm() and save the rankings
+    gardnm lookup CITY [--state ST]            print the saved rankings of a location
+    gardnm sweep CONFIGS.json                  rank many weightings in one pass, see sweep.py
+    gardnm rollup [--unweighted]               roll the rankings up to states, metros, ..., see rollups.py
+    gardnm export --to parquet                 convert the saved rankings to another format
+
+The parameters of gardnm() come from a JSON config file of keyword
+arguments, overridden by the options given on the command line. Only the
+standard library is imported up front: pandas, NumPy and the model are
+imported by the subcommands that run it, so --help and lookups in a saved
+csv or sqlite output start in tens of milliseconds (see the startup
+benchmark in benchmark.py).
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+from paths import enter_root
+from writers import output_name, output_path, WRITERS
+
+
+def load_options(path):
+    """Keyword arguments of gardnm() from a JSON config file, {} without one"""
+    if path is None:
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def lookup(city, state = None, filename = 'gardnm', normalizeAll = True, output_format = 'csv'):
+    """Rows of the saved rankings for a location, read without the model
+
+    Args:
+        city: city name, '' for the state rows
+        state: state abbreviation, any state when None
+        filename: prefix of the rankings file, as given to gardnm()
+        normalizeAll: whether the run normalized the raw data
+        output_format: format the rankings were saved in, see writers.py
+
+    Returns:
+        columns: list of column names
+        rows: list of matching rows, each a list of values
+
+    Raises:
+        FileNotFoundError: if the rankings were not saved in this format
+    """
+    path = output_path(output_name(filename, normalizeAll), output_format)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{path} was not found, save the rankings with "gardnm run" first')
+
+    if output_format == 'csv':
+        with open(path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            columns = ['location'] + next(reader)[1:]
+            i_state, i_city = columns.index('State'), columns.index('City')
+            rows = [row for row in reader if row[i_city] == city and state in (None, row[i_state])]
+    elif output_format == 'sqlite':
+        import sqlite3
+
+        # answered from the (State, City) and City indexes
+        query, parameters = 'SELECT * FROM rankings WHERE City = ?', [city]
+        if state is not None:
+            query, parameters = query + ' AND State = ?', parameters + [state]
+        with sqlite3.connect(path) as connection:
+            cursor = connection.execute(query, parameters)
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        connection.close()
+    else:
+        import pyarrow.compute as pc
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if output_format == 'parquet':
+            table = pq.read_table(path)
+        else:
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+        mask = pc.equal(table['City'].cast(pa.string()), city)
+        if state is not None:
+            mask = pc.and_(mask, pc.equal(table['State'].cast(pa.string()), state))
+        columns = table.column_names
+        rows = [list(row.values()) for row in table.filter(mask).to_pylist()]
+
+    return columns, rows
+
+
+def print_rows(columns, rows):
+    """Print rows side by side, one line per column"""
+    width = max(len(c) for c in columns)
+    for i, column in enumerate(columns):
+        print(f'{column:<{width}}  ' + '  '.join(f'{row[i]!s:>12}' for row in rows))
+
+
+def command_run(args):
+    options = load_options(args.config)
+    overrides = {
+        'normalizeAll': args.normalizeAll,
+        'ignore_subtypes': args.ignore_subtypes,
+        'filename': args.filename,
+        'engine': args.engine,
+        'cache': args.cache,
+        'bootstrap': args.bootstrap,
+        'confidence': args.confidence,
+        'trace': os.path.abspath(args.trace) if args.trace else None,
+        'trace_memory': args.trace_memory,
+        'output_format': args.format,
+        'cities_to_print': args.cities,
+        'verbose': args.verbose,
+    }
+    options.update({k: v for k, v in overrides.items() if v is not None})
+
+    enter_root()
+    from main import gardnm
+
+    gardnm(**options)
+    return 0
+
+
+def command_lookup(args):
+    options = load_options(args.config)
+    enter_root()
+    try:
+        columns, rows = lookup(
+            args.city,
+            args.state,
+            args.filename or options.get('filename', 'gardnm'),
+            options.get('normalizeAll', True) if args.normalizeAll is None else args.normalizeAll,
+            args.format or options.get('output_format', 'csv'),
+        )
+    except FileNotFoundError as error:
+        print(error)
+        return 1
+
+    if not rows:
+        print(f'Sorry, {args.city} was not found in the data...')
+        return 1
+    if args.columns:
+        keep = [columns.index(c) for c in ['State', 'City'] + args.columns if c in columns]
+        columns, rows = [columns[i] for i in keep], [[row[i] for i in keep] for row in rows]
+    print_rows(columns, rows)
+    return 0
+
+
+def command_sweep(args):
+    configs = load_options(args.configs)
+    enter_root()
+    from sweep import weight_sweep
+
+    locations, M = weight_sweep(configs, args.normalizeAll is not False, args.ignore_subtypes is not False, args.filename, args.format, verbose=True)
+    print(f'{len(locations)} locations x {M.shape[1]} configurations')
+    return 0
+
+
+def command_rollup(args):
+    enter_root()
+    from rollups import gardnm_rollups
+
+    rollups = gardnm_rollups(args.normalizeAll is not False, args.ignore_subtypes is not False, args.filename, args.format, not args.unweighted, verbose=True)
+    print(f"{len(rollups)} regions at the levels {', '.join(rollups['level'].unique())}")
+    return 0
+
+
+def command_export(args):
+    normalizeAll = args.normalizeAll is not False
+    enter_root()
+    from writers import read_rankings, save_rankings
+
+    name = output_name(args.filename, normalizeAll)
+    path = save_rankings(read_rankings(name, getattr(args, 'from')), name, args.to)
+    print(f'Data has been saved to {path}!')
+    return 0
+
+
+def add_model_options(parser):
+    """Options shared by the subcommands that name a run"""
+    parser.add_argument('--raw', dest='normalizeAll', action='store_const', const=False, default=None, help='do not normalize the raw data (normalizeAll=False)')
+    parser.add_argument('--subtypes', dest='ignore_subtypes', action='store_const', const=False, default=None, help='use the subtypes in source_subtypes.json')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='gardnm', description='Run and query the GARDN-M model')
+    commands = parser.add_subparsers(dest='command', required=True)
+    formats = list(WRITERS)
+
+    run = commands.add_parser('run', help='run gardnm() and save the rankings')
+    run.add_argument('--config', help='JSON file of gardnm() keyword arguments, the options below override it')
+    add_model_options(run)
+    run.add_argument('--filename', help='prefix of the rankings file')
+    run.add_argument('--engine', choices=['array', 'pandas'])
+    run.add_argument('--cache', action='store_const', const=True, default=None, help='reuse the up-to-date results in data/cache')
+    run.add_argument('--bootstrap', type=int, help='number of bootstrap draws for the confidence bounds')
+    run.add_argument('--confidence', type=float)
+    run.add_argument('--trace', help='write a trace of the run to this file, see tracing.py')
+    run.add_argument('--trace-memory', action='store_const', const=True, default=None, help='also record the peak memory of every span in the trace')
+    run.add_argument('--format', choices=formats)
+    run.add_argument('--cities', nargs='*', help='print the rankings of these cities')
+    run.add_argument('--verbose', action='store_const', const=True, default=None)
+    run.set_defaults(function=command_run)
+
+    find = commands.add_parser('lookup', help='print the saved rankings of a location')
+    find.add_argument('city', help="city name, '' for the state rows")
+    find.add_argument('--state', help='state abbreviation')
+    find.add_argument('--config', help='JSON file of gardnm() keyword arguments, to find the rankings file of that run')
+    add_model_options(find)
+    find.add_argument('--filename')
+    find.add_argument('--format', choices=formats)
+    find.add_argument('--columns', nargs='*', help='only print these columns')
+    find.set_defaults(function=command_lookup)
+
+    sweep = commands.add_parser('sweep', help='rank many weightings in one pass')
+    sweep.add_argument('configs', help='JSON list of configurations, see sweep.stack_configs')
+    add_model_options(sweep)
+    sweep.add_argument('--filename', default='gardnm')
+    sweep.add_argument('--format', default='npz', choices=['npz', 'parquet'])
+    sweep.set_defaults(function=command_sweep)
+
+    rollup = commands.add_parser('rollup', help='roll the rankings up from cities to states and the levels of data/utils/crosswalk.csv')
+    add_model_options(rollup)
+    rollup.add_argument('--unweighted', action='store_true', help='weight every city equally, even with populations in the crosswalk')
+    rollup.add_argument('--filename', default='gardnm')
+    rollup.add_argument('--format', default='csv', choices=formats)
+    rollup.set_defaults(function=command_rollup)
+
+    export = commands.add_parser('export', help='convert the saved rankings to another format')
+    export.add_argument('--to', required=True, choices=formats)
+    export.add_argument('--from', default='csv', choices=formats)
+    add_model_options(export)
+    export.add_argument('--filename', default='gardnm')
+    export.set_defaults(function=command_export)
+
+    return parser
+
+
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
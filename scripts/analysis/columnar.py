@@ -0,0 +1,179 @@
+"""
+Binary columnar cache for the files in data/processed_data.
+
+Each source is compiled once into memory-mappable .npy column files under
+data/cache/columns/<source>/: State is stored as integer codes into its
+(already abbreviated) categories, City as integer codes into its categories,
+and the Score/Rank/Processed columns that assign_CompScore reads as float64.
+Later loads skip both the CSV parser and the object-dtype State replace.
+
+An entry is rebuilt when the CSV changes (modification time and size, then
+content hash) or when the state abbreviations change.
+
+Running this file reports CSV, cold (compile) and warm load times.
+"""
+
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from cache import CACHE_DIR, file_hash, make_key
+
+COLUMN_DIR = os.path.join(CACHE_DIR, 'columns')
+SCORE_COLUMNS = ['Score', 'Rank', 'Processed'] # the columns assign_CompScore reads
+
+
+def compile_source(path, directory, statename_to_abbr, wanted = SCORE_COLUMNS):
+    """Compile one processed_data CSV into .npy column files
+
+    Args:
+        path: path to the CSV
+        directory: directory to write the column files to
+        statename_to_abbr: dictionary of state name -> abbreviation
+        wanted: score columns to compile, when the CSV has them
+
+    Returns:
+        sdata: the compiled source data, or None if a score column is not numeric
+    """
+    raw = pd.read_csv(path)
+    columns = {}
+    for column in wanted:
+        if column in raw.keys():
+            try:
+                columns[column] = pd.to_numeric(raw[column]).astype(np.float64).values
+            except (ValueError, TypeError):
+                return None
+
+    states = raw['State'].replace(statename_to_abbr).fillna('').astype(str) if 'State' in raw.keys() else pd.Series([''] * len(raw))
+    cities = raw['City'].fillna('').astype(str) if 'City' in raw.keys() else pd.Series([''] * len(raw))
+    state_codes, state_names = pd.factorize(states)
+    city_codes, city_names = pd.factorize(cities)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    np.save(os.path.join(directory, 'State.npy'), state_codes.astype(np.int32))
+    np.save(os.path.join(directory, 'City.npy'), city_codes.astype(np.int32))
+    for column, values in columns.items():
+        np.save(os.path.join(directory, f'{column}.npy'), values)
+
+    stat = os.stat(path)
+    meta = {
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'hash': file_hash(path),
+        'abbr': make_key(statename_to_abbr),
+        'State': list(state_names),
+        'City': list(city_names),
+        'columns': list(columns),
+        'wanted': list(wanted),
+    }
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return load_columns(directory, meta)
+
+
+def load_columns(directory, meta):
+    """Load compiled column files as source data
+
+    Args:
+        directory: directory holding the column files
+        meta: the metadata written by compile_source
+
+    Returns:
+        sdata: source data with State, City and the score columns
+    """
+    sdata = pd.DataFrame({
+        'State': np.array(meta['State'], dtype=object)[np.load(os.path.join(directory, 'State.npy'))],
+        'City': np.array(meta['City'], dtype=object)[np.load(os.path.join(directory, 'City.npy'))],
+    })
+    for column in meta['columns']:
+        sdata[column] = np.load(os.path.join(directory, f'{column}.npy'), mmap_mode='r')
+
+    return sdata
+
+
+def read_columnar(path, statename_to_abbr, wanted = SCORE_COLUMNS):
+    """Read a processed_data CSV through the columnar cache
+
+    Args:
+        path: path to the CSV
+        statename_to_abbr: dictionary of state name -> abbreviation
+        wanted: score columns to read, the column of an ingest spec on top of SCORE_COLUMNS
+
+    Returns:
+        sdata: source data with State abbreviated, City filled and the score columns as floats
+        compiled: True if the cache entry had to be (re)built
+
+    Raises:
+        FileNotFoundError: if the CSV does not exist
+    """
+    stat = os.stat(path)
+    directory = os.path.join(COLUMN_DIR, os.path.splitext(os.path.basename(path))[0])
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        meta = None
+
+    if meta is not None and meta['abbr'] == make_key(statename_to_abbr) and set(wanted) <= set(meta.get('wanted', SCORE_COLUMNS)):
+        if [meta['mtime'], meta['size']] == [stat.st_mtime_ns, stat.st_size]:
+            return load_columns(directory, meta), False
+        if meta['hash'] == file_hash(path): # touched but unchanged
+            meta['mtime'], meta['size'] = stat.st_mtime_ns, stat.st_size
+            with open(os.path.join(directory, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            return load_columns(directory, meta), False
+
+    sdata = compile_source(path, directory, statename_to_abbr, wanted)
+    if sdata is None: # not representable, read it the slow way
+        sdata = pd.read_csv(path)
+        sdata['State'] = sdata['State'].replace(statename_to_abbr)
+
+    return sdata, True
+
+
+def benchmark_load(datadir = './data/processed_data/'):
+    """Report CSV, cold and warm load times of every processed_data file
+
+    Args:
+        datadir: directory of the processed CSVs
+
+    Returns:
+        timings: dictionary of 'csv', 'cold' and 'warm' -> seconds
+    """
+    with open('./data/utils/statename_to_abbr.json', 'r') as f:
+        statename_to_abbr = json.load(f)
+    paths = sorted(os.path.join(datadir, p) for p in os.listdir(datadir) if p.endswith('.csv'))
+
+    timings = {}
+    start = time.perf_counter()
+    for path in paths:
+        sdata = pd.read_csv(path)
+        sdata['State'] = sdata['State'].replace(statename_to_abbr)
+    timings['csv'] = time.perf_counter() - start
+
+    for path in paths:
+        shutil.rmtree(os.path.join(COLUMN_DIR, os.path.splitext(os.path.basename(path))[0]), ignore_errors=True)
+    for run in ['cold', 'warm']:
+        start = time.perf_counter()
+        for path in paths:
+            read_columnar(path, statename_to_abbr)
+        timings[run] = time.perf_counter() - start
+
+    for run, seconds in timings.items():
+        print(f'{run:>5}: {len(paths)} sources in {seconds*1000:.1f} ms')
+
+    return timings
+
+
+if __name__ == '__main__':
+    from paths import enter_root
+
+    enter_root()
+    benchmark_load()
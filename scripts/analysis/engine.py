@@ -0,0 +1,242 @@
+"""
+Array-backed scoring engine for the GARDN-M model.
+
+Steps (3) and (4) of gardnm() are computed here from a single dense
+location x source matrix of B and PSW values, instead of concatenating and
+merging one pandas frame per source. Every (State, City) pair gets an integer
+location ID once, and all per-source_type reductions are masked NumPy
+operations over that matrix.
+
+City rows fall back on their state row for the sources and source_types that
+do not cover them by following the parent pointers of a LocationIndex. The
+pandas path in main.py forward fills a sorted frame instead, which can carry
+the values of one city over to the next city of the same state; apart from
+those rows the two paths give identical results.
+"""
+
+import numpy as np
+import pandas as pd
+
+from locations import LocationIndex
+import tracing
+
+
+def build_locations(data, source_types, states):
+    """Assign integer location IDs to every (State, City) pair
+
+    IDs are handed out in the same order the pandas path builds its final
+    rankings frame (all states first, then the new locations of each
+    source_type in sorted order), so that the ID doubles as the index of the
+    saved rankings.
+
+    Args:
+        data: dictionary of source data, each with State, City, B and PSW
+        source_types: dictionary of source_type -> list of sources
+        states: sorted array of every state found in the data
+
+    Returns:
+        locations: LocationIndex of every (State, City)
+    """
+    locations = LocationIndex(states)
+    for st_list in source_types.values():
+        frames = [data[s][['State', 'City']] for s in st_list if s in data]
+        if not len(frames):
+            continue
+        keys = pd.concat(frames).drop_duplicates().sort_values(by=['State', 'City'])
+        locations.add(keys['State'].values, keys['City'].values)
+
+    return locations
+
+
+def source_rows(data, sources, locations):
+    """Location IDs of the rows of every source
+
+    Args:
+        data: dictionary of source data, each with State and City
+        sources: list of sources
+        locations: LocationIndex from build_locations
+
+    Returns:
+        rows: dictionary of source -> array of location IDs
+    """
+    return {source: locations.get(data[source]['State'].values, data[source]['City'].values) for source in sources}
+
+
+def build_matrices(data, sources, locations, rows = None):
+    """Stack the B and PSW values of every source into dense matrices
+
+    Args:
+        data: dictionary of source data, each with State, City, B and PSW
+        sources: ordered list of sources, one column each
+        locations: LocationIndex from build_locations
+        rows: location IDs of every source from source_rows, looked up when not given
+
+    Returns:
+        B: (locations x sources) array of composite scores, NaN where missing
+        PSW: (locations x sources) array of weights, NaN where missing
+        present: (locations x sources) boolean array, True where the source has a row
+    """
+    # stored source-major so that row reductions run over sources in order
+    B = np.full((len(sources), len(locations)), np.nan)
+    PSW = np.full((len(sources), len(locations)), np.nan)
+    present = np.zeros((len(sources), len(locations)), dtype=bool)
+    if rows is None:
+        rows = source_rows(data, sources, locations)
+    for j, source in enumerate(sources):
+        sdata = data[source]
+        B[j, rows[source]] = sdata['B'].values
+        PSW[j, rows[source]] = sdata['PSW'].values
+        present[j, rows[source]] = True
+
+    return B.T, PSW.T, present.T
+
+
+def subtype_groups(st_list, source_subtypes):
+    """Subtype index of every source of a source_type
+
+    Args:
+        st_list: sources of the source_type
+        source_subtypes: dictionary of source -> subtype; a source without one is a subtype of its own
+
+    Returns:
+        groups: (sources) integer array, equal for sources of the same subtype
+    """
+    return np.unique([source_subtypes.get(s, f'source:{s}') for s in st_list], return_inverse=True)[1].ravel()
+
+
+def subtype_weights(PSW, W, groups):
+    """Factor that turns the PSW values of one source_type into subtype-aware weights
+
+    The k sources of a subtype that have a row for a location count as one
+    source there: each gets W = 1/k at that location in place of the W it was
+    assigned in assign_PSW, whatever the number of sources of the subtype
+    that skip the location. A subtype of one source keeps W = 1.
+
+    Args:
+        PSW: (locations x sources) array of weights, NaN where a source has no row
+        W: (sources) array of the W that PSW was computed with
+        groups: (sources) subtype index of every source, from subtype_groups
+
+    Returns:
+        factor: (locations x sources) array to multiply PSW by, NaN where a source has no row
+    """
+    present = ~np.isnan(PSW)
+    k = present @ (groups[:, None] == np.arange(groups.max() + 1)).astype(float) # sources with a row, per subtype
+    with np.errstate(divide='ignore'):
+        return np.where(present, 1 / k[:, groups], np.nan) / W
+
+
+def nanmean(values):
+    """Row-wise mean ignoring NaNs, summed in column order like pandas
+
+    Args:
+        values: 2D array
+
+    Returns:
+        mean: 1D array, NaN where a row has no valid entries
+    """
+    mask = np.isnan(values)
+    count = values.shape[1] - mask.sum(axis=1)
+    total = np.asfortranarray(np.where(mask, 0, values)).sum(axis=1) # Fortran order keeps the summation sequential
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def subrank_arrays(data, source_types, states, verbose = False, locations = None, rows = None, source_subtypes = None):
+    """Calculate the subrankings of every source_type from dense matrices
+
+    Args:
+        data: dictionary of source data, each with State, City, B, W and PSW
+        source_types: dictionary of source_type -> list of sources
+        states: sorted array of every state found in the data
+        verbose: print each subranking
+        locations: LocationIndex from build_locations, built when not given
+        rows: location IDs of every source from source_rows, looked up when not given
+        source_subtypes: dictionary of source -> subtype to weight the sources of a subtype as one source
+            at every location (see subtype_weights), or None to ignore subtypes
+
+    Returns:
+        subrankings: dictionary of source_type -> DataFrame sorted by (State, City)
+    """
+    sources = [s for st_list in source_types.values() for s in st_list if s in data]
+    with tracing.span('build_matrices', sources=len(sources)) as sp:
+        if locations is None:
+            locations = build_locations(data, source_types, states)
+        B, PSW, present = build_matrices(data, sources, locations, rows)
+        sp.set(rows=len(locations))
+    loc_state = locations.state
+    loc_city = locations.city
+    order = locations.sort_order() # global (State, City) sort of all locations
+    col = {s: j for j, s in enumerate(sources)}
+
+    subrankings = {}
+    for source_type, st_list in source_types.items():
+        with tracing.span('subrank', source_type=source_type, engine='array') as sp:
+            st_list = [s for s in st_list if s in data] # remove missing sources from st_list
+            cols = [col[s] for s in st_list]
+
+            # rows of this source_type: every state plus the locations of its sources
+            member = present[:, cols].any(axis=1)
+            member[:len(states)] = True
+            rows = order[member[order]]
+
+            Bt = B[np.ix_(rows, cols)]
+            PSWt = PSW[np.ix_(rows, cols)]
+            if source_subtypes is not None:
+                W = np.array([data[s]['W'].iloc[0] for s in st_list], dtype=float)
+                PSWt = PSWt * subtype_weights(PSWt, W, subtype_groups(st_list, source_subtypes))
+            avgPSW = nanmean(PSWt)
+            Mi = Bt * PSWt / avgPSW[:, None]
+            n = (~np.isnan(Mi)).sum(axis=1)
+            M = nanmean(Mi)
+
+            # fill data from sets missing cities
+            filled = locations.fill_from_parents(np.column_stack([M, avgPSW, Mi]), rows)
+
+            sp.set(sources=len(st_list), rows=len(rows))
+            subrankings[source_type] = pd.DataFrame({'State': loc_state[rows], 'City': loc_city[rows], 'M': filled[:, 0], 'n': n, 'avgPSW': filled[:, 1]})
+            for j, source in enumerate(st_list):
+                subrankings[source_type][f'M_{source}'] = filled[:, 2+j]
+
+            if verbose:
+                print(subrankings[source_type][['State', 'City', 'M', 'n']].sort_values('City', ascending=False))
+
+    return subrankings
+
+
+def combine_arrays(subrankings, states, source_types):
+    """Combine subrankings into the final rankings
+
+    Args:
+        subrankings: dictionary of source_type -> DataFrame with State, City, M and n
+        states: sorted array of every state found in the data
+        source_types: dictionary of source_type -> list of sources
+
+    Returns:
+        rankings: DataFrame sorted by (State, City), indexed by location ID
+    """
+    locations = LocationIndex(states)
+    rows = {}
+    for source_type in source_types:
+        stdata = subrankings[source_type]
+        rows[source_type] = locations.add(stdata['State'].values, stdata['City'].values)
+    order = locations.sort_order()
+
+    Mt = np.full((len(source_types), len(locations)), np.nan)
+    nt = np.full((len(source_types), len(locations)), np.nan)
+    for j, source_type in enumerate(source_types):
+        Mt[j, rows[source_type]] = subrankings[source_type]['M'].values
+        nt[j, rows[source_type]] = subrankings[source_type]['n'].values
+
+    # fill data from source_types missing cities
+    Mt = locations.fill_from_parents(Mt.T[order], order)
+    nt = locations.fill_from_parents(nt.T[order], order)
+
+    rankings = pd.DataFrame({'State': locations.state[order], 'City': locations.city[order]}, index=order)
+    rankings['M'] = nanmean(Mt)
+    rankings['n'] = np.asfortranarray(np.where(np.isnan(nt), 0, nt)).sum(axis=1).astype(int)
+    for j, source_type in enumerate(source_types):
+        rankings[f'M_{source_type}'] = Mt[:, j]
+        rankings[f'n_{source_type}'] = nt[:, j]
+
+    return rankings
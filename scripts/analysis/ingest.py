@@ -0,0 +1,317 @@
+"""
+One-pass ingest of the processed_data CSVs into a canonical long table.
+
+The processed CSVs come in many shapes (blank headers, trailing unnamed
+columns, fractions, ranks or scores), so how the composite score B of every
+source is read is declared in data/sources/ingest_specs.json instead of
+guessed at run time:
+
+    column  the CSV column holding the values
+    kind    'score'     a percentage, B = value / 10
+            'rank'      a rank out of n, B = (n - (value - 1)) / (n / 10)
+            'processed' already on the 0-10 scale, B = value
+    n       for ranks, the size of the field ranked (defaults to the number of rows)
+
+A source without a spec is read the way assign_CompScore always did: Score,
+else Rank out of its number of rows, else Processed. This is reported.
+
+Every source is parsed in parallel, only the columns its spec names, and its
+place names are resolved through the name index of names.py. The result is
+one compact table with a row per source and location:
+
+    location_id  int32, into the locations of the name index
+    source       categorical
+    B_raw        float64, the composite score before normalization
+    kind         categorical
+
+Problems are collected for every source and row at once instead of failing
+on the first: values that are missing or not numbers, ranks outside 1..n,
+place names that could not be resolved, and repeated locations. Rows whose
+value is not a number or whose location repeats are dropped, the others are
+kept as before. The table and its report are cached under data/cache/ingest,
+and so is the part of every source, so editing one source only parses that
+source again.
+
+Running this file prints the report.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cache import file_hash, make_key, load_cached, store_cached
+from locations import join_keys
+from names import resolve_names
+
+SPECS_PATH = './data/sources/ingest_specs.json'
+KINDS = ['score', 'rank', 'processed']
+
+
+def load_specs():
+    """Load data/sources/ingest_specs.json, empty when there is none
+
+    Returns:
+        specs: dictionary of source -> spec
+    """
+    try:
+        with open(SPECS_PATH, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def infer_spec(columns):
+    """Spec of a source without one, as assign_CompScore used to guess it: ranks are out of the number of rows
+
+    Args:
+        columns: column names of the source
+
+    Returns:
+        spec: dictionary, or None when no column can be interpreted
+    """
+    for column, kind in [('Score', 'score'), ('Rank', 'rank'), ('Processed', 'processed')]:
+        if column in columns:
+            return {'column': column, 'kind': kind}
+    return None
+
+
+def composite(values, spec, n_rows = None):
+    """Composite scores B of the values of a source
+
+    Args:
+        values: array of the values of the spec column
+        spec: spec of the source
+        n_rows: number of rows, the field size of ranks without an explicit n
+
+    Returns:
+        B: array of composite scores
+    """
+    if spec['kind'] == 'score':
+        return values / 10 # TODO: Assumes score in percents
+    elif spec['kind'] == 'rank':
+        n = spec.get('n', n_rows)
+        return (n - (values - 1)) / (n / 10) # normalized ranking (0-10)
+    elif spec['kind'] == 'processed':
+        return values
+    raise ValueError(f"Unknown kind {spec['kind']}, expected one of {KINDS}")
+
+
+def ingest_source(source, spec, statename_to_abbr, names, locations):
+    """Parse one processed_data CSV into rows of the canonical table
+
+    Args:
+        source: source name
+        spec: spec of the source, None to infer it
+        statename_to_abbr: dictionary of state name -> abbreviation
+        names: place-name index from names.load_name_index
+        locations: pd.Index of the joined canonical (State, City) of every location of the name index
+
+    Returns:
+        rows: DataFrame with location_id, B_raw and kind, or None if the source could not be read
+        issues: list of (source, line, issue, value), line being the line of the CSV or None
+    """
+    issues = []
+    path = f'./data/processed_data/{source}.csv'
+    if not os.path.exists(path):
+        return None, [(source, None, 'processed data was not found', path)]
+
+    header = pd.read_csv(path, nrows=0).columns
+    if spec is None:
+        spec = infer_spec(header)
+        if spec is None:
+            return None, [(source, None, 'no ingest spec, and no Score, Rank or Processed column', list(header))]
+        issues.append((source, None, 'no ingest spec, inferred', json.dumps(spec)))
+    if spec['column'] not in header:
+        return None, issues + [(source, None, 'column of the spec was not found', spec['column'])]
+
+    wanted = [c for c in ['State', 'City', spec['column']] if c in header]
+    raw = pd.read_csv(path, usecols=wanted, dtype={'State': object, 'City': object})
+    line = np.arange(len(raw)) + 2 # 1-based, after the header
+
+    values = pd.to_numeric(raw[spec['column']], errors='coerce').values.astype(np.float64)
+    given = raw[spec['column']].notna().values
+    for i in np.flatnonzero(~given):
+        issues.append((source, int(line[i]), f"no {spec['column']}", None))
+    for i in np.flatnonzero(given & np.isnan(values)):
+        issues.append((source, int(line[i]), f"{spec['column']} is not a number", raw[spec['column']].iloc[i]))
+    keep = ~(given & np.isnan(values))
+
+    states = raw['State'].replace(statename_to_abbr).fillna('').astype(str).values if 'State' in raw else np.full(len(raw), '', dtype=object)
+    cities = raw['City'].fillna('').astype(str).values if 'City' in raw else np.full(len(raw), '', dtype=object)
+    state, city, resolved = resolve_names(states, cities, names)
+    for i in np.flatnonzero(~resolved):
+        issues.append((source, int(line[i]), 'place name could not be resolved', f'{states[i]}, {cities[i]}'))
+    location = locations.get_indexer(join_keys(state, city))
+    for i in np.flatnonzero(location < 0):
+        issues.append((source, int(line[i]), 'location is not in the name index', f'{state[i]}, {city[i]}'))
+    keep &= location >= 0
+
+    repeated = keep & pd.Series(location).where(keep).duplicated().values
+    for i in np.flatnonzero(repeated):
+        issues.append((source, int(line[i]), 'repeats a location of the source', f'{state[i]}, {city[i]}'))
+    keep &= ~repeated
+
+    B = composite(values[keep], spec, int(keep.sum()))
+    if spec['kind'] == 'rank':
+        n = spec.get('n', int(keep.sum()))
+        for i in np.flatnonzero(keep & ((values < 1) | (values > n))):
+            issues.append((source, int(line[i]), f'rank outside 1..{n}', values[i]))
+
+    rows = pd.DataFrame({'location_id': location[keep].astype(np.int32), 'B_raw': B, 'kind': spec['kind']})
+    return rows, issues
+
+
+def ingest_sources(sources, specs, statename_to_abbr, names, workers = None, cache = False):
+    """Parse every source in parallel into the canonical table
+
+    Args:
+        sources: list of sources, in source order
+        specs: output of load_specs
+        statename_to_abbr: dictionary of state name -> abbreviation
+        names: place-name index from names.load_name_index
+        workers: number of sources parsed at the same time, defaults to the number of CPUs
+        cache: reuse the rows of every source whose file, spec and name index did not change, from data/cache/ingest
+
+    Returns:
+        table: DataFrame with location_id, source, B_raw and kind
+        report: DataFrame of the issues, with source, line, issue and value
+    """
+    locations = pd.Index(join_keys(names['state'], names['city']))
+
+    def ingest(source):
+        path = f'./data/processed_data/{source}.csv'
+        if not cache or not os.path.exists(path):
+            return ingest_source(source, specs.get(source), statename_to_abbr, names, locations)
+        key = make_key('ingest', file_hash(path), names['key'], specs.get(source))
+        result = load_cached('ingest', f'source_{source}', key)
+        if result is None:
+            result = ingest_source(source, specs.get(source), statename_to_abbr, names, locations)
+            store_cached('ingest', f'source_{source}', key, result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = list(executor.map(ingest, sources))
+
+    frames = [rows.assign(source=source) for source, (rows, _) in zip(sources, results) if rows is not None]
+    if frames:
+        table = pd.concat(frames, ignore_index=True)
+    else:
+        table = pd.DataFrame({'location_id': np.array([], dtype=np.int32), 'B_raw': np.array([]), 'kind': [], 'source': []})
+    table['source'] = pd.Categorical(table['source'], categories=[s for s, (rows, _) in zip(sources, results) if rows is not None])
+    table['kind'] = pd.Categorical(table['kind'], categories=KINDS)
+    table = table[['location_id', 'source', 'B_raw', 'kind']]
+
+    report = pd.DataFrame([issue for _, issues in results for issue in issues], columns=['source', 'line', 'issue', 'value'])
+    report['line'] = report['line'].astype('Int64')
+    return table, report
+
+
+def print_report(report):
+    """One warning per source and kind of issue"""
+    for (source, issue), group in report.groupby(['source', 'issue'], sort=False):
+        if issue == 'processed data was not found':
+            print(f' ---   WARNING: processed data for {source}.csv was not found... skipping!')
+        elif group['line'].isna().all():
+            print(f" ---   WARNING: {source}: {issue} {group['value'].iloc[0]}")
+        else:
+            lines = ', '.join(str(int(l)) for l in group['line'].head(5)) + (', ...' if len(group) > 5 else '')
+            print(f" ---   WARNING: {source}: {len(group)} {'row' if len(group) == 1 else 'rows'} {issue} (lines {lines})")
+
+
+def load_ingested(statename_to_abbr, sources, names, cache = True, strict = False, verbose = False):
+    """Canonical table of every source, cached until a source, the specs or the name index change
+
+    When the table is stale, only the sources that changed are parsed again.
+    Its issues are printed when it is built; a table reused from the cache
+    only warns about missing sources, unless verbose.
+
+    Args:
+        statename_to_abbr: dictionary of state name -> abbreviation
+        sources: list of sources, in source order
+        names: place-name index from names.load_name_index
+        cache: read and store the table in data/cache/ingest
+        strict: raise instead of warning when there are issues other than inferred specs and missing files
+        verbose: print whether the table was reused, and its issues even when it was
+
+    Returns:
+        ingested: dictionary with 'table', 'report' and the cache 'key'
+
+    Raises:
+        ValueError: in strict mode, listing every issue found
+    """
+    specs = load_specs()
+    paths = {s: f'./data/processed_data/{s}.csv' for s in sources}
+    files = [(s, file_hash(paths[s]) if os.path.exists(paths[s]) else None, specs.get(s)) for s in sources]
+    key = make_key('ingest', names['key'], files)
+    ingested = load_cached('ingest', 'table', key) if cache else None
+    rebuilt = ingested is None
+    if rebuilt:
+        table, report = ingest_sources(sources, specs, statename_to_abbr, names, cache=cache)
+        ingested = {'table': table, 'report': report, 'key': key}
+        if cache:
+            store_cached('ingest', 'table', key, ingested)
+    elif verbose:
+        print('Cache: reused the ingested table')
+
+    report = ingested['report']
+    errors = report[~report['issue'].isin(['no ingest spec, inferred', 'processed data was not found'])]
+    if strict and len(errors):
+        raise ValueError(f'{len(errors)} ingest issues:\n{errors.to_string()}')
+    if rebuilt or verbose:
+        print_report(report)
+    else:
+        # the issues were reported when the table was built, but a missing source is always worth a warning
+        print_report(report[report['issue'] == 'processed data was not found'])
+
+    return ingested
+
+
+def source_frames(ingested, names):
+    """Source data of every ingested source, as read_source would give it with B assigned
+
+    Args:
+        ingested: output of load_ingested
+        names: place-name index from names.load_name_index
+
+    Returns:
+        data: dictionary of source -> DataFrame with State, City and B
+    """
+    table = ingested['table']
+    codes = table['source'].cat.codes.values
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(table['source'].cat.categories) + 1))
+    location = table['location_id'].values
+    B = table['B_raw'].values
+
+    data = {}
+    for k, source in enumerate(table['source'].cat.categories):
+        rows = order[bounds[k]:bounds[k+1]]
+        data[source] = pd.DataFrame({'State': names['state'][location[rows]], 'City': names['city'][location[rows]], 'B': B[rows]})
+
+    return data
+
+
+if __name__ == '__main__':
+    import main
+    from names import load_name_index
+    from paths import enter_root
+
+    parser = argparse.ArgumentParser(description='Ingest every processed_data CSV and report the problems found')
+    parser.add_argument('--strict', action='store_true', help='fail on any issue')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--output', default=None, help='also save the full report to this CSV')
+    args = parser.parse_args()
+    enter_root()
+
+    statename_to_abbr, source_ratings = main.load_config()[:2]
+    names = load_name_index(statename_to_abbr, list(source_ratings))
+    ingested = load_ingested(statename_to_abbr, list(source_ratings), names, not args.no_cache, args.strict, verbose=True)
+    table = ingested['table']
+    print(f"{len(table)} rows of {len(table['source'].cat.categories)} sources over {table['location_id'].nunique()} locations, {table.memory_usage(deep=True).sum() / 1e3:.0f} kB")
+    if args.output:
+        ingested['report'].to_csv(args.output, index=False)
+        print(f'Report has been saved to {args.output}')
@@ -0,0 +1,154 @@
+"""
+Hierarchical location index for the GARDN-M model.
+
+Every (State, City) pair gets an integer ID, and every location has a parent
+pointer: cities point at their state row, states have no parent (-1). The
+fallback of a location onto its parent for the sources that do not cover it
+is then a gather along the parent pointers, instead of relying on the sort
+order of a frame and forward filling.
+
+State rows have City == '', as in the rest of the model.
+"""
+
+import numpy as np
+import pandas as pd
+
+STATE = 0
+CITY = 1
+
+
+def join_keys(state, city):
+    """Join (State, City) pairs into single strings, which hash much faster than tuples"""
+    return state + '\x1f' + city
+
+
+class LocationIndex:
+    """Integer IDs for every location, with pointers from each city to its state
+
+    Args:
+        states: state abbreviations to start the index with, in ID order
+    """
+
+    def __init__(self, states = ()):
+        self._state = np.empty(0, dtype=object)
+        self._city = np.empty(0, dtype=object)
+        self.index = pd.Index(np.empty(0, dtype=object)) # hash index of the joined (State, City) keys
+        self.parent = np.empty(0, dtype=np.int64)
+        self.level = np.empty(0, dtype=np.int8)
+        self.add(np.asarray(states, dtype=object), np.full(len(states), '', dtype=object))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def state(self):
+        """Array of the State of every location, by ID"""
+        return self._state
+
+    @property
+    def city(self):
+        """Array of the City of every location, by ID ('' for states)"""
+        return self._city
+
+    @property
+    def depth(self):
+        """Number of parent pointers between the deepest location and its root"""
+        return int(self.level.max()) if len(self) else 0
+
+    def add(self, state, city):
+        """Add locations that are not in the index yet, in the order given
+
+        The state row of a new city is added first if it is missing.
+
+        Args:
+            state: array of state abbreviations
+            city: array of city names, '' for states
+
+        Returns:
+            ids: array of the IDs of all the given locations
+        """
+        state = np.asarray(state, dtype=object)
+        city = np.asarray(city, dtype=object)
+        is_city = city != ''
+        candidate_state = np.concatenate([state[is_city], state])
+        candidate_city = np.concatenate([np.full(is_city.sum(), '', dtype=object), city])
+        candidates = pd.Index(join_keys(candidate_state, candidate_city))
+        new = ~candidates.duplicated() & ~candidates.isin(self.index)
+
+        if new.any():
+            self._state = np.concatenate([self._state, candidate_state[new]])
+            self._city = np.concatenate([self._city, candidate_city[new]])
+            self.index = self.index.append(candidates[new])
+            level = np.where(candidate_city[new] == '', STATE, CITY).astype(np.int8)
+            state_ids = self.index.get_indexer(join_keys(candidate_state[new], np.full(new.sum(), '', dtype=object)))
+            self.parent = np.concatenate([self.parent, np.where(level == CITY, state_ids, -1)])
+            self.level = np.concatenate([self.level, level])
+
+        return self.get(state, city)
+
+    def get(self, state, city):
+        """Look up the IDs of locations
+
+        Args:
+            state: array of state abbreviations
+            city: array of city names, '' for states
+
+        Returns:
+            ids: array of IDs, -1 where a location is not in the index
+        """
+        return self.index.get_indexer(join_keys(np.asarray(state, dtype=object), np.asarray(city, dtype=object)))
+
+    def sort_order(self, ids = None):
+        """IDs sorted by (State, City), so that every state comes before its cities
+
+        Args:
+            ids: IDs to sort, defaults to every location
+
+        Returns:
+            ids: sorted array of IDs
+        """
+        ids = np.arange(len(self)) if ids is None else np.asarray(ids)
+        return ids[np.lexsort((self.city[ids], self.state[ids]))]
+
+    def fill_index(self, valid, ids):
+        """Row that every entry takes its value from when falling back on parents
+
+        An entry keeps its own row if it is valid, otherwise it walks up the
+        parent pointers to the nearest valid ancestor among the rows.
+
+        Args:
+            valid: 2D boolean array, one row per entry of ids, True where an entry has a value
+            ids: array of the location ID of every row
+
+        Returns:
+            rows: 2D integer array of source rows, the same shape as valid
+            found: 2D boolean array, False where no ancestor has a value either
+        """
+        position = np.full(len(self), -1)
+        position[ids] = np.arange(len(ids))
+        parent_ids = self.parent[ids]
+        parent_rows = np.where(parent_ids >= 0, position[parent_ids], -1)
+
+        rows = np.broadcast_to(np.arange(len(ids))[:, None], valid.shape).copy()
+        found = valid.copy()
+        for _ in range(self.depth):
+            step = ~found & (parent_rows[rows] >= 0)
+            if not step.any():
+                break
+            rows = np.where(step, parent_rows[rows], rows)
+            found = np.take_along_axis(valid, rows, axis=0)
+
+        return rows, found
+
+    def fill_from_parents(self, values, ids):
+        """Fill missing entries of every location from its nearest ancestor that has them
+
+        Args:
+            values: 2D array, one row per entry of ids
+            ids: array of the location ID of every row
+
+        Returns:
+            values: 2D array with the missing entries filled where possible
+        """
+        rows, found = self.fill_index(~np.isnan(values), ids)
+        return np.take_along_axis(values, rows, axis=0)
@@ -5,18 +5,26 @@ Created on Wed Jul 19 13:57:23 2023
 
 The main script for running the GARDN-M model.
 
+Every data path is relative to the repository root, which the command-line
+entry points make the working directory (see paths.py and cli.py).
+
 @author: oaknelson
 """
 
-import git
 import pandas as pd
 import os
 import json
 import numpy as np
+import time
 
-# establish relative directories (use pathlib)
-repo = git.Repo('.', search_parent_directories=True)
-os.chdir(repo.working_tree_dir)
+from engine import build_locations, source_rows, subrank_arrays, combine_arrays
+from bootstrap import add_intervals
+from cache import file_hash, make_key, load_cached, store_cached
+from columnar import SCORE_COLUMNS, read_columnar
+from ingest import composite, infer_spec, load_ingested, load_specs, source_frames
+from writers import output_name, save_rankings
+from names import load_name_index, resolve_source
+import tracing
 
 def gardnm(
     cities_to_print = ['Atlanta', 'Boston', 'Memphis'],  
@@ -24,6 +32,13 @@ def gardnm(
     filename = 'gardnm', 
     ignore_subtypes = True, 
     verbose = False, 
+    engine = 'array', 
+    cache = False, 
+    trace = None, 
+    trace_memory = False, 
+    bootstrap = 0, 
+    confidence = 0.95, 
+    output_format = 'csv', 
 ):
     """Calculation of GARDN-M coefficients
 
@@ -33,19 +48,197 @@ def gardnm(
         filename: prefix for filename to use when saving this run
         ignore_subtypes: option to ignore the various subtypes in source_subtypes
         verbose: some extra print statements that may be useful when debugging
+        engine: 'array' to combine sources with the dense matrices in engine.py, or 'pandas' for the original merge-based path (for cross-checking, it forward fills city rows in sort order)
+        cache: reuse the per-source and per-source_type results stored in data/cache that are still up to date
+        trace: write a trace of every stage, source and source_type to this file (.json for Chrome trace format, otherwise JSON lines), see tracing.py; GARDNM_TRACE does the same
+        trace_memory: also record the peak memory of every span in the trace (tracemalloc, slower); GARDNM_TRACE_MEMORY does the same
+        bootstrap: number of bootstrap draws; when nonzero, add <column>_lo and <column>_hi confidence bounds for M and every M_<source_type>, see bootstrap.py
+        confidence: coverage of the bootstrap intervals
+        output_format: 'csv', 'parquet', 'arrow' or 'sqlite', see writers.py
 
     Returns:
         Nothing yet, but it saves stuff to a file
     """
 
     # set filename
-    filename += '_algorithm_rework' # based on git commit for the moment
+    filename = output_name(filename, normalizeAll)
 
-    if normalizeAll:
-        filename += '_normalized'
+    # a trace of this run replaces any tracing already on (e.g. from GARDNM_TRACE) until the run is over
+    if trace is not None:
+        previous = tracing.swap(tracing.Tracer(trace, memory=trace_memory))
+
+    # the trace of this run is closed even if a stage fails, so that it does not stay on for the rest of the process
+    try:
+        ## (1) Load all the data from GARDN-M/data/processed_data
+
+        with tracing.span('1_load', cache=cache) as sp:
+            if cache:
+                # cached sources come back already normalized and weighted, so this covers (2) as well
+                source_ratings, source_types, source_subtypes, data, keys = load_cached_sources(normalizeAll, ignore_subtypes, verbose)
+            else:
+                source_ratings, source_types, source_subtypes, data = load_sources(verbose)
+            sp.set(sources=len(data), rows=sum(len(sdata) for sdata in data.values()))
+
+        # we need to remove fail-to-find sources from the master list
+        sources = data.keys()
+
+
+
+        ## (2) Normalize and weight all availible data
+
+        if not cache:
+            with tracing.span('2_process'):
+                process_sources(data, normalizeAll, source_ratings, source_subtypes, ignore_subtypes)
+
+
+
+        # (3) Combine data arrays into subrankings arrays
+
+        with tracing.span('3_subrank', engine=engine) as sp:
+            # get all states and initialize rankings
+            states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+            if cache:
+                subrankings = cached_subrank(data, keys, source_types, source_subtypes, states, ignore_subtypes, engine, verbose)
+            else:
+                subrankings = subrank(data, source_types, source_subtypes, states, ignore_subtypes, engine, verbose)
+            sp.set(rows=sum(len(stdata) for stdata in subrankings.values()))
+
+
+
+        # (4) Combine subrankings into final rankings
+
+        with tracing.span('4_combine', engine=engine) as sp:
+            if engine == 'array':
+                rankings = combine_arrays(subrankings, states, source_types)
+            else:
+                rankings = combine_pandas(subrankings, states, source_types)
+            sp.set(rows=len(rankings))
+
+        if bootstrap:
+            with tracing.span('4_bootstrap', draws=bootstrap):
+                rankings = add_intervals(rankings, data, source_types, states, bootstrap, confidence, source_subtypes=None if ignore_subtypes else source_subtypes)
+
+
+
+        # (5) Save the output and print results
+
+        with tracing.span('5_save', rows=len(rankings), format=output_format):
+            save_path = save_rankings(rankings, filename, output_format)
+        if verbose:
+            print(f'Data has been saved to {save_path}!')
+
+    finally:
+        if trace is not None:
+            tracing.swap(previous).close()
+        else:
+            tracing.flush()
+
+    if len(cities_to_print):
+        inds_to_print = []
+        for city_to_print in cities_to_print:
+            if city_to_print in rankings['City'].values:
+                inds_to_print += [np.where(rankings['City']==city_to_print)[0][0]]
+            else:
+                print(f'Sorry, {city_to_print} was not found in the data...')
+        items_to_print = ['State','City','M'] + [f'M_{st}' for st in source_types] #+ [f'M_{s}' for s in sources]
+        print(rankings[items_to_print].iloc[inds_to_print].transpose().to_string())
+    
+
+def gardnm_variants(variants, engine = 'array', verbose = False, output_format = 'csv'):
+    """Calculation of GARDN-M coefficients for several variants in one pass
+
+    The sources are read and their composite scores assigned once, the
+    normalized scores are shared by every variant that normalizes, and only
+    the weighting and the combination are done per variant. Variants that
+    only differ by filename are computed once.
+
+    Each variant is a dictionary with any of:
+        filename: prefix for filename to use when saving this variant (default 'gardnm')
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale (default True)
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes (default True)
+        source_ratings: path to an alternative source_ratings.json, or a dictionary in the same
+            shape; sources it leaves out keep their default ratings
+
+    Args:
+        variants: list of variant dictionaries
+        engine: 'array' or 'pandas', see gardnm
+        verbose: some extra print statements that may be useful when debugging
+        output_format: 'csv', 'parquet', 'arrow' or 'sqlite', see writers.py
+
+    Returns:
+        rankings: dictionary of output filename -> rankings DataFrame
+    """
+
+    ## (1) Load all the data once
+
+    with tracing.span('1_load') as sp:
+        source_ratings, source_types, source_subtypes, data = load_sources(verbose)
+        sp.set(sources=len(data), rows=sum(len(sdata) for sdata in data.values()))
+    states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
 
-    ## (1) Load all the data from GARDN-M/data/processed_data
 
+
+    ## (2) Composite scores once, normalized once if any variant needs them
+
+    with tracing.span('2_score'):
+        scores = {False: {source: score_source(sdata, source)[['State', 'City', 'B']] for source, sdata in data.items()}}
+        if any(variant.get('normalizeAll', True) for variant in variants):
+            scores[True] = {source: normalize_CompScore(sdata.copy()) for source, sdata in scores[False].items()}
+
+        # every variant has the same locations, so the array engine can index them once
+        if engine == 'array':
+            sources = [s for st_list in source_types.values() for s in st_list if s in data]
+            locations = build_locations(scores[False], source_types, states)
+            rows = source_rows(scores[False], sources, locations)
+
+
+
+    # (3) and (4) per distinct variant, (5) per variant
+
+    computed = {}
+    outputs = {}
+    n_subtypes = subtype_sizes(source_subtypes)
+    for variant in variants:
+        normalizeAll = variant.get('normalizeAll', True)
+        ignore_subtypes = variant.get('ignore_subtypes', True)
+        ratings = variant.get('source_ratings', {})
+        if isinstance(ratings, str):
+            with open(ratings, 'r') as f:
+                ratings = json.load(f)
+        ratings = {**source_ratings, **ratings}
+
+        filename = output_name(variant.get('filename', 'gardnm'), normalizeAll)
+        key = json.dumps([normalizeAll, ignore_subtypes, ratings], sort_keys=True)
+        with tracing.span('variant', filename=filename, reused=key in computed) as sp:
+            if key not in computed:
+                variant_data = {source: assign_PSW(sdata.copy(), source, ratings, source_subtypes, ignore_subtypes, n_subtypes) for source, sdata in scores[normalizeAll].items()}
+                if engine == 'array':
+                    subrankings = subrank_arrays(variant_data, source_types, states, verbose, locations, rows, None if ignore_subtypes else source_subtypes)
+                    computed[key] = combine_arrays(subrankings, states, source_types)
+                else:
+                    subrankings = subrank(variant_data, source_types, source_subtypes, states, ignore_subtypes, engine, verbose)
+                    computed[key] = combine_pandas(subrankings, states, source_types)
+
+            outputs[filename] = computed[key]
+            save_path = save_rankings(outputs[filename], filename, output_format)
+            sp.set(rows=len(outputs[filename]))
+        if verbose:
+            print(f'Data has been saved to {save_path}!')
+
+    tracing.flush()
+
+    return outputs
+
+
+def load_config():
+    """Load the state abbreviations and the source configuration from GARDN-M/data
+
+    Returns:
+        statename_to_abbr: dictionary of state name -> abbreviation
+        source_ratings: dictionary of source -> ratings, the first of which is P
+        source_types: dictionary of source_type -> list of sources
+        source_subtypes: dictionary of source -> subtype
+    """
     with open('./data/utils/statename_to_abbr.json', 'r') as f:
         statename_to_abbr = json.load(f)
 
@@ -58,71 +251,321 @@ def gardnm(
     with open('./data/sources/source_subtypes.json', 'r') as f:
         source_subtypes = json.load(f)
 
+    return statename_to_abbr, source_ratings, source_types, source_subtypes
+
+
+def read_source(source, statename_to_abbr, columnar = True, names = None):
+    """Read the processed data of one source
+
+    Args:
+        source: source name
+        statename_to_abbr: dictionary of state name -> abbreviation
+        columnar: read through the compiled column files in data/cache (see columnar.py) instead of the CSV
+        names: place-name index from names.load_name_index, loaded for every source in source_ratings.json when not given
+
+    Returns:
+        sdata: source data, with states abbreviated and place names resolved to their canonical form
+
+    Raises:
+        FileNotFoundError: if there is no processed data for this source
+    """
+    if columnar:
+        spec = load_specs().get(source)
+        wanted = SCORE_COLUMNS + [spec['column']] if spec is not None and spec['column'] not in SCORE_COLUMNS else SCORE_COLUMNS
+        sdata = read_columnar(f'./data/processed_data/{source}.csv', statename_to_abbr, wanted)[0]
+    else:
+        sdata = pd.read_csv(f'./data/processed_data/{source}.csv')
+        sdata['State'] = sdata['State'].replace(statename_to_abbr) # change to abbeviations
+
+    if names is None:
+        names = load_name_index(statename_to_abbr, list(load_config()[1]))
+
+    return resolve_source(sdata, source, names)
+
+
+def load_sources(verbose = False, columnar = True, ingested = True):
+    """Load the source configuration and all the data from GARDN-M/data/processed_data
+
+    Args:
+        verbose: some extra print statements that may be useful when debugging
+        columnar: read through the compiled column files in data/cache (see columnar.py)
+        ingested: take every source from the canonical table of ingest.py, with B already assigned, instead of reading them one by one
+
+    Returns:
+        source_ratings: dictionary of source -> ratings, the first of which is P
+        source_types: dictionary of source_type -> list of sources
+        source_subtypes: dictionary of source -> subtype
+        data: dictionary of source -> source data, for every source that was found
+    """
+    statename_to_abbr, source_ratings, source_types, source_subtypes = load_config()
+
     sources = source_ratings.keys()
+    names = load_name_index(statename_to_abbr, list(sources), verbose)
 
     # get processed data
     data = {}
-    datadir = './data/processed_data/'
+    start = time.perf_counter()
+    if ingested:
+        with tracing.span('ingest') as sp:
+            data = source_frames(load_ingested(statename_to_abbr, list(sources), names, verbose=verbose), names)
+            sp.set(rows=sum(len(sdata) for sdata in data.values()))
+        sources = []
     for source in sources:
         if verbose: 
             print(f'Reading data from {source}...')
         try:
-            data[source] = pd.read_csv(datadir+f'{source}.csv')
-            data[source]['State'] = data[source]['State'].replace(statename_to_abbr) # change to abbeviations
+            with tracing.span('read', source=source) as sp:
+                data[source] = read_source(source, statename_to_abbr, columnar, names)
+                sp.set(rows=len(data[source]))
         except FileNotFoundError:
             print(f' ---   WARNING: processed data for {source}.csv was not found... skipping!')  
-            
-    # we need to remove fail-to-find sources from the master list
-    sources = data.keys()
+    if verbose:
+        print(f'Loaded {len(data)} sources in {(time.perf_counter()-start)*1000:.1f} ms')
+
+    return source_ratings, source_types, source_subtypes, data
+
+
+def score_source(sdata, source):
+    """Assign the composite scores of one source, which do not depend on any run option
+
+    Args:
+        sdata: source data
+        source: source name
+
+    Returns:
+        sdata: source data, with City filled in and B assigned
+    """
+    if 'City' not in sdata.keys():
+        sdata['City'] = np.NaN
+    sdata.City = sdata.City.fillna('')
 
+    if 'B' in sdata.keys(): # taken from the ingested table
+        return sdata
+    return assign_CompScore(sdata, source)
 
 
-    ## (2) Normalize and weight all availible data
+def process_source(sdata, source, normalizeAll, source_ratings, source_subtypes, ignore_subtypes, n_subtypes = None):
+    """Run the standard analysis on one source
 
+    Args:
+        sdata: source data
+        source: source name
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        source_ratings: a list of all the source ratings
+        source_subtypes: a list of all the source subtypes
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        n_subtypes: output of subtype_sizes, computed when not given
+
+    Returns:
+        sdata: source data, with B, P, S, W and PSW assigned
+    """
+    sdata = score_source(sdata, source)
+    if normalizeAll:
+        sdata = normalize_CompScore(sdata)
+    sdata = assign_PSW(sdata, source, source_ratings, source_subtypes, ignore_subtypes, n_subtypes)
+
+    return sdata
+
+
+def process_sources(data, normalizeAll, source_ratings, source_subtypes, ignore_subtypes):
+    """Normalize and weight all availible data, in place
+
+    Args:
+        data: dictionary of source -> source data
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        source_ratings: a list of all the source ratings
+        source_subtypes: a list of all the source subtypes
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+
+    Returns:
+        data: the same dictionary, with B, P, S, W and PSW assigned to every source
+    """
     # Run standard analysis on each source
+    n_subtypes = None if ignore_subtypes else subtype_sizes(source_subtypes)
     for source, sdata in data.items():
+        with tracing.span('process', source=source, rows=len(sdata)):
+            data[source] = process_source(sdata, source, normalizeAll, source_ratings, source_subtypes, ignore_subtypes, n_subtypes)
 
-        if 'City' not in sdata.keys():
-            sdata['City'] = np.NaN
-        sdata.City = sdata.City.fillna('')
-        sdata = assign_CompScore(sdata, source)
-        if normalizeAll:
-            sdata = normalize_CompScore(sdata)
-        sdata = assign_PSW(sdata, source, source_ratings, source_subtypes, ignore_subtypes)
+    return data
 
 
+def load_cached_sources(normalizeAll, ignore_subtypes, verbose = False):
+    """Steps (1) and (2), reusing the cached result of every unchanged source
 
-    # (3) Combine data arrays into subrankings arrays
+    A source is only read and processed again when its processed_data file,
+    its entries in source_ratings.json/source_subtypes.json/ingest_specs.json,
+    the state abbreviations, the place-name index or the run options change.
 
-    # get all states and initialize rankings
-    states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+    Args:
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        verbose: print what was reused and what was recomputed
+
+    Returns:
+        source_ratings: dictionary of source -> ratings, the first of which is P
+        source_types: dictionary of source_type -> list of sources
+        source_subtypes: dictionary of source -> subtype
+        data: dictionary of source -> processed source data, for every source that was found
+        keys: dictionary of source -> cache key of its processed data
+    """
+    statename_to_abbr, source_ratings, source_types, source_subtypes = load_config()
+    abbr_hash = file_hash('./data/utils/statename_to_abbr.json')
+    names = load_name_index(statename_to_abbr, list(source_ratings), verbose)
+    specs = load_specs()
+
+    data = {}
+    keys = {}
+    reused = []
+    n_subtypes = None if ignore_subtypes else subtype_sizes(source_subtypes)
+    for source in source_ratings.keys():
+        path = f'./data/processed_data/{source}.csv'
+        if not os.path.exists(path):
+            print(f' ---   WARNING: processed data for {source}.csv was not found... skipping!')
+            continue
+
+        subtype = source_subtypes.get(source)
+        n_subtype = None if ignore_subtypes else n_subtypes.get(source, 1)
+        keys[source] = make_key(source, file_hash(path), abbr_hash, names['key'], specs.get(source), source_ratings[source], subtype, n_subtype, normalizeAll, ignore_subtypes)
+
+        with tracing.span('load_cached', source=source) as sp:
+            data[source] = load_cached('sources', source, keys[source])
+            sp.set(reused=data[source] is not None)
+            if data[source] is None:
+                sdata = read_source(source, statename_to_abbr, names=names)
+                sdata = process_source(sdata, source, normalizeAll, source_ratings, source_subtypes, ignore_subtypes, n_subtypes)
+                data[source] = sdata[['State', 'City', 'B', 'P', 'S', 'W', 'PSW']]
+                store_cached('sources', source, keys[source], data[source])
+            else:
+                reused.append(source)
+            sp.set(rows=len(data[source]))
+
+    if verbose:
+        recomputed = [s for s in data if s not in reused]
+        print(f'Cache: reused {len(reused)} sources, recomputed {len(recomputed)} {recomputed}')
+
+    return source_ratings, source_types, source_subtypes, data, keys
+
+
+def subrank(data, source_types, source_subtypes, states, ignore_subtypes, engine = 'array', verbose = False):
+    """Step (3), calculate the subrankings with the chosen engine
+
+    Args:
+        data: dictionary of source data, each with State, City, B and PSW
+        source_types: dictionary of source_type -> list of sources
+        source_subtypes: a list of all the source subtypes
+        states: sorted array of every state found in the data
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        engine: 'array' or 'pandas', see gardnm
+        verbose: print each subranking
+
+    Returns:
+        subrankings: dictionary of source_type -> DataFrame
+    """
+    if engine == 'array':
+        return subrank_arrays(data, source_types, states, verbose, source_subtypes=None if ignore_subtypes else source_subtypes)
+    elif engine == 'pandas':
+        return subrank_pandas(data, data.keys(), source_types, source_subtypes, states, ignore_subtypes, verbose)
+    else:
+        raise ValueError(f'Unknown engine {engine}, expected "array" or "pandas"')
+
+
+def cached_subrank(data, keys, source_types, source_subtypes, states, ignore_subtypes, engine = 'array', verbose = False):
+    """Step (3), only recomputing the subrankings whose sources changed
+
+    Args:
+        data: dictionary of source data, each with State, City, B and PSW
+        keys: dictionary of source -> cache key, from load_cached_sources
+        source_types: dictionary of source_type -> list of sources
+        source_subtypes: a list of all the source subtypes
+        states: sorted array of every state found in the data
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        engine: 'array' or 'pandas', see gardnm
+        verbose: print what was reused and what was recomputed
+
+    Returns:
+        subrankings: dictionary of source_type -> DataFrame
+    """
     subrankings = {}
+    reused = []
     for source_type, st_list in source_types.items():
-        st_list = [s for s in st_list if s in sources] # remove missing sources from st_list
-        sb_list = np.unique([sbt for s, sbt in source_subtypes.items() if s in st_list]) # get unique subtypes in this source_type
-
-        subrankings[source_type] = pd.DataFrame({'State':states}) 
-        subrankings[source_type]['City'] = '' # initialize
-        for sdata in [sd for source, sd in data.items() if source in st_list]:
-            subrankings[source_type] = pd.concat([subrankings[source_type], sdata])
-        subrankings[source_type] = subrankings[source_type].drop_duplicates(['State', 'City'])[['State', 'City']]
-
-        # initialize results columns so that they appear in the beginning of the structure
-        subrankings[source_type]['M'] = np.NaN # initialize
-        subrankings[source_type]['n'] = np.NaN # initialize
-        subrankings[source_type]['avgPSW'] = np.NaN # this will later hold the average weight
-
-        # combine individual metrics into rankings
-        subrankings[source_type]['B'] = '' # empty to force suffix on merge, will drop later
-        subrankings[source_type]['PSW'] = '' # empty to force suffix on merge, will drop later
-        for source in st_list:
-            sdata = data[source]
-            subrankings[source_type] = pd.merge(subrankings[source_type], sdata[['State', 'City', 'B', 'PSW']], on=['State', 'City'], how='left', suffixes=(None, f'_{source}'))
-        subrankings[source_type].drop(columns=['B'], inplace=True)
-        subrankings[source_type].drop(columns=['PSW'], inplace=True)
-
-        if ignore_subtypes:
-             # we need to divide by the sum of the weights for each city
+        st_list = [s for s in st_list if s in data] # remove missing sources from st_list
+        key = make_key(source_type, engine, list(states), [keys[s] for s in st_list])
+
+        with tracing.span('cached_subrank', source_type=source_type) as sp:
+            subrankings[source_type] = load_cached('subrankings', source_type, key)
+            sp.set(reused=subrankings[source_type] is not None)
+            if subrankings[source_type] is None:
+                subrankings.update(subrank(data, {source_type: st_list}, source_subtypes, states, ignore_subtypes, engine, verbose))
+                store_cached('subrankings', source_type, key, subrankings[source_type])
+            else:
+                reused.append(source_type)
+
+    if verbose:
+        recomputed = [st for st in source_types if st not in reused]
+        print(f'Cache: reused {len(reused)} subrankings {reused}, recomputed {len(recomputed)} {recomputed}')
+
+    return subrankings
+
+
+def subrank_pandas(data, sources, source_types, source_subtypes, states, ignore_subtypes, verbose = False):
+    """Calculate the subrankings of every source_type by merging source frames
+
+    This is the original implementation of step (3), kept for cross-checking
+    the array engine in engine.py. City rows are forward filled from the row
+    sorted before them, so a city can inherit another city's values where the
+    array engine falls back on its state.
+
+    Args:
+        data: dictionary of source data, each with State, City, B and PSW
+        sources: names of all the sources that were found
+        source_types: dictionary of source_type -> list of sources
+        source_subtypes: a list of all the source subtypes
+        states: sorted array of every state found in the data
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        verbose: print each subranking
+
+    Returns:
+        subrankings: dictionary of source_type -> DataFrame
+    """
+    subrankings = {}
+    for source_type, st_list in source_types.items():
+        with tracing.span('subrank', source_type=source_type, engine='pandas') as sp:
+            st_list = [s for s in st_list if s in sources] # remove missing sources from st_list
+            sb_list = np.unique([sbt for s, sbt in source_subtypes.items() if s in st_list]) # get unique subtypes in this source_type
+
+            subrankings[source_type] = pd.DataFrame({'State':states}) 
+            subrankings[source_type]['City'] = '' # initialize
+            for sdata in [sd for source, sd in data.items() if source in st_list]:
+                subrankings[source_type] = pd.concat([subrankings[source_type], sdata])
+            subrankings[source_type] = subrankings[source_type].drop_duplicates(['State', 'City'])[['State', 'City']]
+
+            # initialize results columns so that they appear in the beginning of the structure
+            subrankings[source_type]['M'] = np.NaN # initialize
+            subrankings[source_type]['n'] = np.NaN # initialize
+            subrankings[source_type]['avgPSW'] = np.NaN # this will later hold the average weight
+
+            # combine individual metrics into rankings
+            subrankings[source_type]['B'] = '' # empty to force suffix on merge, will drop later
+            subrankings[source_type]['PSW'] = '' # empty to force suffix on merge, will drop later
+            for source in st_list:
+                sdata = data[source]
+                with tracing.span('merge', source=source, rows=len(sdata)):
+                    subrankings[source_type] = pd.merge(subrankings[source_type], sdata[['State', 'City', 'B', 'PSW']], on=['State', 'City'], how='left', suffixes=(None, f'_{source}'))
+            subrankings[source_type].drop(columns=['B'], inplace=True)
+            subrankings[source_type].drop(columns=['PSW'], inplace=True)
+
+            if not ignore_subtypes:
+                # the sources of a subtype that have a row for a location count as one source there
+                for subtype in sb_list:
+                    sb_sources = [s for s in st_list if source_subtypes.get(s) == subtype]
+                    k = subrankings[source_type][[f'PSW_{s}' for s in sb_sources]].count(axis=1)
+                    for source in sb_sources:
+                        subrankings[source_type][f'PSW_{source}'] = subrankings[source_type][f'PSW_{source}'] / data[source]['W'].iloc[0] / k
+                for source in st_list:
+                    if source not in source_subtypes: # a subtype of its own
+                        subrankings[source_type][f'PSW_{source}'] = subrankings[source_type][f'PSW_{source}'] / data[source]['W'].iloc[0]
+
+            # we need to divide by the sum of the weights for each city
             PSWi = [x for x in subrankings[source_type].keys() if 'PSW_' in x]
             subrankings[source_type]['avgPSW'] =  subrankings[source_type][PSWi].mean(axis=1) 
 
@@ -131,28 +574,41 @@ def gardnm(
                 subrankings[source_type][f'M_{source}'] = subrankings[source_type][f'B_{source}'] * subrankings[source_type][f'PSW_{source}']
                 subrankings[source_type][f'M_{source}'] = subrankings[source_type][f'M_{source}'].divide(subrankings[source_type]['avgPSW']) 
 
-        else: 
-            pass #TODO, this will fail
 
+            # sum and average M values from each source
+            Mi = [x for x in subrankings[source_type].keys() if 'M_' in x]
+            subrankings[source_type]['n'] = subrankings[source_type][Mi].count(axis=1).astype(int) # number of non null Mi entries
+            subrankings[source_type]['M'] = subrankings[source_type][Mi].mean(axis=1) 
 
-        # sum and average M values from each source
-        Mi = [x for x in subrankings[source_type].keys() if 'M_' in x]
-        subrankings[source_type]['n'] = subrankings[source_type][Mi].count(axis=1).astype(int) # number of non null Mi entries
-        subrankings[source_type]['M'] = subrankings[source_type][Mi].mean(axis=1) 
+            # fill data from sets missing cities
+            subrankings[source_type].sort_values(by=['State', 'City'], inplace=True) # sort so that fillna(method='ffil')  is appropriate
+            subrankings[source_type] = subrankings[source_type].where(subrankings[source_type]['City']!='', subrankings[source_type].fillna('tmp')) # fill no-city entries with placeholders
+            subrankings[source_type].fillna(method='ffill', inplace=True) # fill city-specific rows with no-city entries
+            subrankings[source_type].replace('tmp', np.nan, inplace=True) # replace no-city placeholders
+            sp.set(sources=len(st_list), rows=len(subrankings[source_type]))
 
-        # fill data from sets missing cities
-        subrankings[source_type].sort_values(by=['State', 'City'], inplace=True) # sort so that fillna(method='ffil')  is appropriate
-        subrankings[source_type] = subrankings[source_type].where(subrankings[source_type]['City']!='', subrankings[source_type].fillna('tmp')) # fill no-city entries with placeholders
-        subrankings[source_type].fillna(method='ffill', inplace=True) # fill city-specific rows with no-city entries
-        subrankings[source_type].replace('tmp', np.nan, inplace=True) # replace no-city placeholders
+            if verbose:
+                print(subrankings[source_type][['State', 'City', 'M', 'n']].sort_values('City', ascending=False))#.to_string())
 
-        if verbose:
-            print(subrankings[source_type][['State', 'City', 'M', 'n']].sort_values('City', ascending=False))#.to_string())
+    return subrankings
 
 
+def combine_pandas(subrankings, states, source_types):
+    """Combine subrankings into the final rankings by merging them
 
-    # (4) Combine subrankings into final rankings
+    This is the original implementation of step (4), kept for cross-checking
+    the array engine in engine.py. City rows are forward filled from the row
+    sorted before them, so a city can inherit another city's values where the
+    array engine falls back on its state.
 
+    Args:
+        subrankings: dictionary of source_type -> DataFrame with State, City, M and n
+        states: sorted array of every state found in the data
+        source_types: dictionary of source_type -> list of sources
+
+    Returns:
+        rankings: DataFrame of the final rankings
+    """
     rankings = pd.DataFrame({'State':states}) 
     rankings['City'] = '' # initialize
     rankings['M'] = np.NaN # initialize
@@ -169,49 +625,31 @@ def gardnm(
     rankings['n'] = rankings[[f'n_{st}' for st in source_types]].sum(axis=1).astype(int)
     rankings['M'] = rankings[[f'M_{st}' for st in source_types]].mean(axis=1)
 
+    return rankings
 
 
-    # (5) Save the output and print results
-
-    rankings.to_csv(f'data/outputs/{filename}.csv')
-    if verbose:
-        print(f'Data has been saved to data/outputs/{filename}.csv!')
-
-    if len(cities_to_print):
-        inds_to_print = []
-        for city_to_print in cities_to_print:
-            if city_to_print in rankings['City'].values:
-                inds_to_print += [np.where(rankings['City']==city_to_print)[0][0]]
-            else:
-                print(f'Sorry, {city_to_print} was not found in the data...')
-        items_to_print = ['State','City','M'] + [f'M_{st}' for st in source_types] #+ [f'M_{s}' for s in sources]
-        print(rankings[items_to_print].iloc[inds_to_print].transpose().to_string())
-    
-
-def assign_CompScore(sdata, source):
-    """Assign composite scores 
+def assign_CompScore(sdata, source, spec = None):
+    """Assign composite scores, as declared in data/sources/ingest_specs.json (see ingest.py)
 
     Args:
         sdata: source data
         source: source name
+        spec: ingest spec of the source, read from ingest_specs.json when not given
 
     Returns:
         sdata: source data, but with composite scores assigned
     """
-    if 'Score' in sdata.keys():
-        sdata['B'] = sdata.Score / 10 # TODO: Assumes score in percents
-    elif 'Rank' in sdata.keys():
-        nNorm = len(sdata.Rank) # this should be the number of states... (50, 51?)
-        if source == 'statusWomen_bestWorstStates':
-            nNorm = 50 # we know this dataset is incomplete, and expect it to be, but nNorm is still 50
-        if nNorm != 50:
-            print(f' ---   WARNING: nNorm for {source} was {nNorm}...')
-        compscore = (nNorm-(sdata.Rank-1)) / (nNorm/10) # normalized ranking (0-10)
-        sdata['B'] = compscore
-    elif 'Processed' in sdata.keys():
-        sdata['B'] = sdata.Processed
-    else:
-        print(f' ---   WARNING: unclear interpretation of composite score for {source}... this will break!') 
+    if spec is None:
+        spec = load_specs().get(source)
+    if spec is None:
+        spec = infer_spec(sdata.keys())
+        if spec is None:
+            print(f' ---   WARNING: unclear interpretation of composite score for {source}... this will break!')
+            return sdata
+        if spec['kind'] == 'rank' and len(sdata) != 50:
+            print(f' ---   WARNING: nNorm for {source} was {len(sdata)}, declare n in ingest_specs.json...')
+
+    sdata['B'] = composite(pd.to_numeric(sdata[spec['column']], errors='coerce'), spec, len(sdata))
 
     return sdata
 
@@ -230,7 +668,7 @@ def normalize_CompScore(sdata):
 
     return sdata
 
-def assign_PSW(sdata, source, source_ratings, source_subtypes, ignore_subtypes): 
+def assign_PSW(sdata, source, source_ratings, source_subtypes, ignore_subtypes, n_subtypes = None): 
     """Assign individual weightings for each entry
 
     Args:
@@ -239,6 +677,7 @@ def assign_PSW(sdata, source, source_ratings, source_subtypes, ignore_subtypes):
         source_ratings: a list of all the source ratings
         source_subtypes: a list of all the source subtypes
         ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        n_subtypes: output of subtype_sizes, computed when not given
     Returns:
         sdata: source data, but with individual measures assigned
     """
@@ -248,21 +687,36 @@ def assign_PSW(sdata, source, source_ratings, source_subtypes, ignore_subtypes):
     # sensitivity index (S): Rank metric sensitivity and normalize from 1-2
     S_city = 2
     S_state = 1
-    sdata['S'] = S_state
-    sdata['S'].where(sdata.City == '', S_city, inplace=True)
+    sdata['S'] = np.where(sdata.City == '', S_state, S_city)
 
     # repetition weight (W): Score of 0-1 depending on how many repeated entries there are for this branch
     if ignore_subtypes:
         sdata['W'] = 1
     else:
-        subtype = source_subtypes[source]
-        n_subtype = len([s for s, sbt in source_subtypes.items() if sbt == subtype])
-        sdata['W'] = 1 / n_subtype 
+        if n_subtypes is None:
+            n_subtypes = subtype_sizes(source_subtypes)
+        sdata['W'] = 1 / n_subtypes.get(source, 1)
 
     sdata['PSW'] = sdata['P'] * sdata['S']* sdata['W']
 
     # to get a true weighted average, we need to divide by the sum of the weights... this is done later...
     return sdata
 
+
+def subtype_sizes(source_subtypes):
+    """Number of sources of every subtype, counted once for all the sources
+
+    Args:
+        source_subtypes: dictionary of source -> subtype
+
+    Returns:
+        n_subtypes: dictionary of source -> number of sources sharing its subtype
+    """
+    counts = pd.Series(source_subtypes, dtype=object).value_counts()
+    return {source: int(counts[subtype]) for source, subtype in source_subtypes.items()}
+
 if __name__ == '__main__':
+    from paths import enter_root
+
+    enter_root()
     gardnm()
\ No newline at end of file
@@ -0,0 +1,349 @@
+"""
+Place-name resolution for joining the GARDN-M sources.
+
+Sources spell the same place in different ways: full state names or
+abbreviations, "City; ST" in one column, "St." or "Saint", consolidated
+city-county names such as "Lexington-Fayette". Joining on the raw strings
+silently splits such places into several locations. Every raw (State, City)
+pair is therefore resolved to a canonical location first:
+
+    state  the abbreviation from statename_to_abbr.json, matched on a
+           normalized form of any full name, abbreviation or alias in
+           data/utils/place_aliases.json
+    city   the alias target from place_aliases.json, otherwise the first
+           spelling of its normalized form met in the sources, so that
+           "St Louis" and "St. Louis" become one location
+
+The name index is built from every processed_data file at once, so the raw
+pairs of the sources map to canonical location IDs with one hashed lookup,
+and it is cached under data/cache/names until the place names of a source,
+the abbreviations or the aliases change; edits to the values of a source
+leave it alone. Pairs that could not be resolved are kept as they are
+and listed in the report, with every alias, respelling, split and duplicate.
+
+Running this file prints the report.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from cache import file_hash, make_key, load_cached, store_cached
+from columnar import read_columnar
+from locations import join_keys
+
+ALIASES_PATH = './data/utils/place_aliases.json'
+PREFIXES = {'saint': 'st', 'sainte': 'ste', 'fort': 'ft', 'mount': 'mt'}
+
+
+def normalize_name(name):
+    """Normalized form of a place name, equal for spellings that only differ in case, accents, punctuation or spacing
+
+    Args:
+        name: place name
+
+    Returns:
+        name: lowercase ASCII words separated by single spaces, with Saint/Fort/Mount shortened
+    """
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+    name = re.sub(r"[.']", '', name.casefold().replace('&', ' and '))
+    words = re.sub(r'[^a-z0-9]+', ' ', name).split()
+    if words:
+        words[0] = PREFIXES.get(words[0], words[0])
+    return ' '.join(words)
+
+
+def load_aliases():
+    """Load data/utils/place_aliases.json, empty when there is none
+
+    Returns:
+        aliases: dictionary with 'states' (alias -> abbreviation) and 'cities' (abbreviation -> alias -> city)
+    """
+    try:
+        with open(ALIASES_PATH, 'r') as f:
+            aliases = json.load(f)
+    except FileNotFoundError:
+        aliases = {}
+    return {'states': aliases.get('states', {}), 'cities': aliases.get('cities', {})}
+
+
+def name_tables(statename_to_abbr, aliases):
+    """Lookup tables of the normalized state and city names
+
+    Args:
+        statename_to_abbr: dictionary of state name -> abbreviation
+        aliases: output of load_aliases
+
+    Returns:
+        states: dictionary of normalized state name, abbreviation or alias -> abbreviation
+        cities: dictionary of 'ST\\x1fnormalized city' -> canonical city, for the aliases and their targets
+    """
+    states = {}
+    for name, abbr in list(statename_to_abbr.items()) + list(aliases['states'].items()):
+        states[normalize_name(name)] = abbr
+        states.setdefault(normalize_name(abbr), abbr)
+
+    cities = {}
+    for abbr, city_aliases in aliases['cities'].items():
+        for alias, city in city_aliases.items():
+            cities[f'{abbr}\x1f{normalize_name(city)}'] = city
+            cities[f'{abbr}\x1f{normalize_name(alias)}'] = city
+
+    return states, cities
+
+
+def resolve_pair(state, city, states, cities, spellings):
+    """Resolve one raw (State, City) pair
+
+    Args:
+        state: raw state, '' when the source has none
+        city: raw city, '' for state rows
+        states: state table from name_tables
+        cities: city alias table from name_tables
+        spellings: dictionary of 'ST\\x1fnormalized city' -> first spelling met, updated with new cities
+
+    Returns:
+        state: abbreviation, or the raw state if it could not be resolved
+        city: canonical city
+        issue: None, 'unknown state', 'split', 'alias' or 'spelling'
+    """
+    issue = None
+    abbr = states.get(normalize_name(state)) if state != '' else None
+    for separator in (';', ','):
+        if separator in city:
+            # "City; ST" from the wallethub city pages, or "City, ST"
+            head, tail = city.rsplit(separator, 1)
+            split = states.get(normalize_name(tail))
+            if split is not None and abbr in (None, split):
+                abbr, city, issue = split, head.strip(), 'split'
+                break
+    if abbr is None:
+        return state, city, 'unknown state'
+    if city == '':
+        return abbr, city, issue
+
+    key = f'{abbr}\x1f{normalize_name(city)}'
+    canonical = cities.get(key)
+    if canonical is not None:
+        issue = 'alias' if canonical != city else issue
+    else:
+        canonical = spellings.setdefault(key, city)
+        issue = 'spelling' if canonical != city else issue
+
+    return abbr, canonical, issue
+
+
+def raw_strings(values, n):
+    """Raw names as stripped strings, '' where missing"""
+    if values is None:
+        return np.full(n, '', dtype=object)
+    return pd.Series(values, dtype=object).fillna('').astype(str).str.strip().values.astype(object)
+
+
+def build_name_index(statename_to_abbr, aliases, frames):
+    """Resolve every raw (State, City) pair of the sources
+
+    Args:
+        statename_to_abbr: dictionary of state name -> abbreviation
+        aliases: output of load_aliases
+        frames: iterable of (source, DataFrame with State and City) in source order
+
+    Returns:
+        names: dictionary with the raw pair index, the canonical locations, the lookup tables and the report
+    """
+    states, cities = name_tables(statename_to_abbr, aliases)
+    spellings = {}
+    raw = {}
+    locations = {}
+    report = []
+    for source, sdata in frames:
+        pairs = pd.DataFrame({
+            'State': raw_strings(sdata['State'].values if 'State' in sdata else None, len(sdata)),
+            'City': raw_strings(sdata['City'].values if 'City' in sdata else None, len(sdata)),
+        }).drop_duplicates()
+        seen = {}
+        for state, city in zip(pairs['State'], pairs['City']):
+            key = join_keys(state, city)
+            resolved_state, resolved_city, issue = resolve_pair(state, city, states, cities, spellings)
+            location = locations.setdefault(join_keys(resolved_state, resolved_city), len(locations))
+            raw.setdefault(key, location)
+            if location in seen:
+                issue = 'duplicate'
+            seen.setdefault(location, key)
+            if issue is not None:
+                report.append((source, state, city, resolved_state, resolved_city, issue))
+
+    keys = np.array(list(locations), dtype=object)
+    return {
+        'raw': pd.Index(np.array(list(raw), dtype=object)),
+        'location': np.array(list(raw.values()), dtype=np.int64),
+        'state': np.array([k.split('\x1f')[0] for k in keys], dtype=object),
+        'city': np.array([k.split('\x1f')[1] for k in keys], dtype=object),
+        'states': states,
+        'cities': cities,
+        'spellings': spellings,
+        'report': pd.DataFrame(report, columns=['source', 'State', 'City', 'resolved_State', 'resolved_City', 'issue']),
+    }
+
+
+def source_pairs(source, path, statename_to_abbr):
+    """Distinct raw (State, City) pairs of a source in order of appearance, cached until its file changes
+
+    Args:
+        source: source name
+        path: path to its processed_data CSV
+        statename_to_abbr: dictionary of state name -> abbreviation
+
+    Returns:
+        pairs: dictionary with the 'pairs' (DataFrame of State and City) and their 'digest'
+    """
+    key = make_key('pairs', file_hash(path), statename_to_abbr)
+    pairs = load_cached('names', f'pairs_{source}', key)
+    if pairs is None:
+        sdata = read_columnar(path, statename_to_abbr)[0]
+        frame = pd.DataFrame({
+            'State': raw_strings(sdata['State'].values if 'State' in sdata else None, len(sdata)),
+            'City': raw_strings(sdata['City'].values if 'City' in sdata else None, len(sdata)),
+        }).drop_duplicates().reset_index(drop=True)
+        digest = hashlib.sha256('\x1e'.join(join_keys(frame['State'].values, frame['City'].values)).encode()).hexdigest()
+        pairs = {'pairs': frame, 'digest': digest}
+        store_cached('names', f'pairs_{source}', key, pairs)
+
+    return pairs
+
+
+def load_name_index(statename_to_abbr, sources, verbose = False):
+    """Name index of the processed_data of the sources, cached until their place names, the abbreviations or the aliases change
+
+    The key only covers the distinct place names of every source, so editing
+    the values of a source leaves the index, and every cache keyed on it,
+    untouched.
+
+    Args:
+        statename_to_abbr: dictionary of state name -> abbreviation
+        sources: list of sources, the first spelling of a city wins in this order
+        verbose: print whether the index was reused
+
+    Returns:
+        names: see build_name_index, with its cache key under 'key'
+    """
+    paths = [(source, f'./data/processed_data/{source}.csv') for source in sources]
+    paths = [(source, path) for source, path in paths if os.path.exists(path)]
+
+    # the digests of every source in one entry, so a warm run reads no pairs at all
+    digests_key = make_key('digests', statename_to_abbr)
+    known = load_cached('names', 'digests', digests_key) or {}
+    digests = {}
+    changed = False
+    for source, path in paths:
+        hash = file_hash(path)
+        if known.get(source, [None])[0] != hash:
+            known[source] = [hash, source_pairs(source, path, statename_to_abbr)['digest']]
+            changed = True
+        digests[source] = known[source][1]
+    if changed:
+        store_cached('names', 'digests', digests_key, known)
+
+    key = make_key('names', list(digests.items()), statename_to_abbr,
+        file_hash(ALIASES_PATH) if os.path.exists(ALIASES_PATH) else None)
+    names = load_cached('names', 'index', key)
+    if names is None:
+        pairs = ((source, source_pairs(source, path, statename_to_abbr)['pairs']) for source, path in paths)
+        names = build_name_index(statename_to_abbr, load_aliases(), pairs)
+        names['key'] = key
+        store_cached('names', 'index', key, names)
+    elif verbose:
+        print('Cache: reused the place-name index')
+
+    return names
+
+
+def resolve_names(state, city, names):
+    """Canonical (State, City) of raw pairs, one hashed lookup for the pairs found in the sources
+
+    Args:
+        state: array of raw states
+        city: array of raw cities, '' or NaN for state rows
+        names: output of load_name_index
+
+    Returns:
+        state: array of abbreviations
+        city: array of canonical cities
+        resolved: boolean array, False where the state could not be resolved
+    """
+    state = raw_strings(state, len(state))
+    city = raw_strings(city, len(state)) if city is not None else raw_strings(None, len(state))
+    found = names['raw'].get_indexer(join_keys(state, city))
+    resolved = found >= 0
+    resolved_state = state.copy()
+    resolved_city = city.copy()
+    resolved_state[resolved] = names['state'][names['location'][found[resolved]]]
+    resolved_city[resolved] = names['city'][names['location'][found[resolved]]]
+
+    # pairs that no source has, e.g. from a calibration target, are resolved one by one
+    missing = np.flatnonzero(found < 0)
+    if len(missing):
+        spellings = dict(names['spellings'])
+        for i in missing:
+            resolved_state[i], resolved_city[i], issue = resolve_pair(state[i], city[i], names['states'], names['cities'], spellings)
+            resolved[i] = issue != 'unknown state'
+    resolved[resolved] = np.isin(resolved_state[resolved], list(names['states'].values()))
+
+    return resolved_state, resolved_city, resolved
+
+
+def resolve_source(sdata, source, names):
+    """Replace the State and City of a source by their canonical names
+
+    Rows whose names could not be resolved are kept as they are; rows that
+    resolve to a location the source already has are dropped.
+
+    Args:
+        sdata: source data with State and, for city-level sources, City
+        source: source name
+        names: output of load_name_index
+
+    Returns:
+        sdata: source data with canonical State and City
+    """
+    state, city, resolved = resolve_names(sdata['State'].values, sdata['City'].values if 'City' in sdata else None, names)
+    if not resolved.all():
+        print(f' ---   WARNING: {(~resolved).sum()} place names of {source} could not be resolved, see names.py')
+    sdata['State'] = state
+    if 'City' in sdata or (city != '').any():
+        sdata['City'] = city
+
+    duplicated = pd.Index(join_keys(state, city)).duplicated()
+    if duplicated.any():
+        print(f' ---   WARNING: {duplicated.sum()} rows of {source} name a location it already has... skipping!')
+        sdata = sdata[~duplicated].reset_index(drop=True)
+
+    return sdata
+
+
+if __name__ == '__main__':
+    import main
+    from paths import enter_root
+
+    parser = argparse.ArgumentParser(description='Report how the place names of the sources were resolved')
+    parser.add_argument('--all', action='store_true', help='list aliases, respellings and splits too, not only the problems')
+    parser.add_argument('--output', default=None, help='also save the report to this CSV')
+    args = parser.parse_args()
+    enter_root()
+
+    statename_to_abbr, source_ratings = main.load_config()[:2]
+    names = load_name_index(statename_to_abbr, list(source_ratings), verbose=True)
+    report = names['report']
+    if not args.all:
+        report = report[report['issue'].isin(['unknown state', 'duplicate'])]
+    print(f"{len(names['raw'])} raw names resolve to {len(names['state'])} locations")
+    print(report.to_string() if len(report) else 'Every place name was resolved')
+    if args.output:
+        report.to_csv(args.output, index=False)
+        print(f'Report has been saved to {args.output}')
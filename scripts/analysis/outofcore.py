@@ -0,0 +1,249 @@
+"""
+Out-of-core execution of the GARDN-M model for very many locations.
+
+Instead of keeping a frame per source and a dense location x source matrix
+in memory, the B, PSW and presence values of every source are written to
+memory-mapped files (float32 by default), one source row at a time, and the
+rankings are computed and streamed to the output file one chunk of locations
+at a time. Only one source or one chunk is mapped at any moment, so the
+peak memory is set by the size of the largest source and the chunk size,
+not by the number of locations times the number of sources.
+
+The files are laid out source-major with locations in (State, City) order,
+so a chunk is one contiguous slice of every source row. City rows fall back
+on their state row as in engine.py: the subranking values of the states are
+computed first and every chunk gathers them along the parent pointers.
+
+The location index itself (keys, IDs and parent pointers) stays in memory;
+it takes tens of bytes per location.
+
+With dtype='float64' the output is identical to gardnm(engine='array').
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import tracing
+from cache import CACHE_DIR
+from engine import nanmean, subtype_groups, subtype_weights
+from locations import LocationIndex, join_keys
+from main import assign_PSW, load_config, normalize_CompScore, output_name, read_source, score_source
+from names import load_name_index
+from paths import enter_root
+from writers import save_rankings
+
+
+def read_processed(source, statename_to_abbr, normalizeAll, source_ratings, source_subtypes, ignore_subtypes, names = None):
+    """Read one source and assign its composite scores and weights
+
+    Returns:
+        sdata: State, City, B, W and PSW of the source
+    """
+    sdata = score_source(read_source(source, statename_to_abbr, names=names), source)
+    if normalizeAll:
+        sdata = normalize_CompScore(sdata)
+    sdata = assign_PSW(sdata, source, source_ratings, source_subtypes, ignore_subtypes)
+
+    return sdata[['State', 'City', 'B', 'W', 'PSW']]
+
+
+def index_locations(sources, source_types, statename_to_abbr, names = None):
+    """First pass over the sources: assign location IDs as build_locations does
+
+    Args:
+        sources: list of sources that were found
+        source_types: dictionary of source_type -> list of sources
+        statename_to_abbr: dictionary of state name -> abbreviation
+        names: place-name index from names.load_name_index
+
+    Returns:
+        locations: LocationIndex of every (State, City)
+    """
+    states = set()
+    source_type_of = {s: st for st, st_list in source_types.items() for s in st_list}
+    type_keys = {source_type: (pd.Index(np.empty(0, dtype=object)), np.empty(0, dtype=object), np.empty(0, dtype=object)) for source_type in source_types}
+    for source in sources:
+        sdata = score_source(read_source(source, statename_to_abbr, names=names), source)
+        states.update(sdata['State'].unique())
+        if source in source_type_of:
+            # keep only the unique keys of every source_type in memory
+            seen, state, city = type_keys[source_type_of[source]]
+            keys = pd.Index(join_keys(sdata['State'].values.astype(object), sdata['City'].values.astype(object)))
+            new = ~keys.duplicated() & ~keys.isin(seen)
+            type_keys[source_type_of[source]] = (seen.append(keys[new]), np.concatenate([state, sdata['State'].values[new]]), np.concatenate([city, sdata['City'].values[new]]))
+
+    locations = LocationIndex(np.array(sorted(states), dtype=object))
+    for seen, state, city in type_keys.values():
+        order = np.lexsort((city, state))
+        locations.add(state[order], city[order])
+
+    return locations
+
+
+def map_row(path, j, n_locations, dtype, mode = 'r+'):
+    """Memory-map the row of source j in a source-major matrix file"""
+    return np.memmap(path, dtype=dtype, mode=mode, offset=j * n_locations * np.dtype(dtype).itemsize, shape=(n_locations,))
+
+
+def type_values(B, PSW, present, cols, W = None, groups = None):
+    """Subranking M and n of one source_type for a block of locations
+
+    Args:
+        B: (locations x sources) array of composite scores
+        PSW: (locations x sources) array of weights
+        present: (locations x sources) boolean array
+        cols: columns of the sources of this source_type
+        W: (sources) array of the W of the sources of this source_type, only with groups
+        groups: subtype index of the sources of this source_type from engine.subtype_groups, or None to ignore subtypes
+
+    Returns:
+        M: M of every location, NaN where it has no values
+        n: number of sources with a value
+        member: True where a source of this source_type has a row for the location
+    """
+    Bt = B[:, cols]
+    PSWt = PSW[:, cols]
+    if groups is not None:
+        PSWt = PSWt * subtype_weights(PSWt, W, groups)
+    avgPSW = nanmean(PSWt)
+    Mi = Bt * PSWt / avgPSW[:, None]
+
+    return nanmean(Mi), (~np.isnan(Mi)).sum(axis=1), present[:, cols].any(axis=1)
+
+
+def gardnm_outofcore(
+    normalizeAll = True,
+    filename = 'gardnm',
+    ignore_subtypes = True,
+    chunk_size = 10000,
+    dtype = 'float32',
+    verbose = False,
+    output_format = 'csv',
+):
+    """Calculation of GARDN-M coefficients with bounded memory
+
+    Args:
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        filename: prefix for filename to use when saving this run
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        chunk_size: number of locations computed at once, bounds the memory used
+        dtype: dtype of the memory-mapped B and PSW values, 'float32' or 'float64'
+        verbose: some extra print statements that may be useful when debugging
+        output_format: 'csv', 'parquet', 'arrow' or 'sqlite', see writers.py; every chunk is written as it is computed
+
+    Returns:
+        path: where the rankings were saved
+    """
+    statename_to_abbr, source_ratings, source_types, source_subtypes = load_config()
+    sources = []
+    for source in source_ratings:
+        if os.path.exists(f'./data/processed_data/{source}.csv'):
+            sources.append(source)
+        else:
+            print(f' ---   WARNING: processed data for {source}.csv was not found... skipping!')
+    matrix_sources = [s for st_list in source_types.values() for s in st_list if s in sources]
+
+    ## (1) Index every location
+
+    with tracing.span('1_index', sources=len(sources)) as sp:
+        names = load_name_index(statename_to_abbr, list(source_ratings))
+        locations = index_locations(sources, source_types, statename_to_abbr, names)
+        n_locations = len(locations)
+        n_states = int((locations.level == 0).sum())
+        order = locations.sort_order()
+        position = np.empty_like(order)
+        position[order] = np.arange(n_locations)
+        sp.set(rows=n_locations)
+    if verbose:
+        print(f'Indexed {n_locations} locations from {len(sources)} sources')
+
+    workdir = tempfile.mkdtemp(prefix='outofcore-', dir=CACHE_DIR if os.path.isdir(CACHE_DIR) else None)
+    paths = {name: os.path.join(workdir, f'{name}.bin') for name in ['B', 'PSW', 'present']}
+    dtypes = {'B': dtype, 'PSW': dtype, 'present': np.bool_}
+    try:
+
+        ## (2) Normalize and weight one source at a time into the memory-mapped rows
+
+        W = np.ones(len(matrix_sources))
+        with tracing.span('2_process'):
+            for name, path in paths.items():
+                with open(path, 'wb') as f:
+                    f.truncate(len(matrix_sources) * n_locations * np.dtype(dtypes[name]).itemsize)
+            for j, source in enumerate(matrix_sources):
+                with tracing.span('process', source=source) as sp:
+                    sdata = read_processed(source, statename_to_abbr, normalizeAll, source_ratings, source_subtypes, ignore_subtypes, names)
+                    rows = position[locations.get(sdata['State'].values, sdata['City'].values)]
+                    W[j] = sdata['W'].iloc[0]
+                    for name in paths:
+                        row = map_row(paths[name], j, n_locations, dtypes[name])
+                        if name != 'present':
+                            row[:] = np.nan
+                            row[rows] = sdata[name].values
+                        else:
+                            row[rows] = True
+                        row.flush()
+                        del row
+                    sp.set(rows=len(sdata))
+
+        ## (3) and (4) Subrankings and rankings, chunk by chunk, with the states first
+
+        cols = [[matrix_sources.index(s) for s in st_list if s in matrix_sources] for st_list in source_types.values()]
+        weights = [(W[c], None if ignore_subtypes else subtype_groups([matrix_sources[j] for j in c], source_subtypes)) for c in cols]
+
+        def load_block(slice_or_positions):
+            block = {}
+            for name, path in paths.items():
+                matrix = np.memmap(path, dtype=dtypes[name], mode='r', shape=(len(matrix_sources), n_locations))
+                block[name] = np.array(matrix[:, slice_or_positions].T, dtype=np.float64 if name != 'present' else bool)
+                del matrix
+            return block
+
+        with tracing.span('3_states', rows=n_states):
+            block = load_block(position[:n_states])
+            state_values = [type_values(block['B'], block['PSW'], block['present'], c, *w)[:2] for c, w in zip(cols, weights)]
+
+        def chunks():
+            for start in range(0, n_locations, chunk_size):
+                with tracing.span('chunk', start=start) as sp:
+                    ids = order[start:start+chunk_size]
+                    block = load_block(slice(start, start+chunk_size))
+                    parent = np.where(locations.parent[ids] >= 0, locations.parent[ids], ids) # state IDs are 0..n_states-1
+
+                    Mt = np.empty((len(ids), len(cols)))
+                    nt = np.empty((len(ids), len(cols)))
+                    for t, c in enumerate(cols):
+                        M, n, member = type_values(block['B'], block['PSW'], block['present'], c, *weights[t])
+                        member |= ids < n_states
+                        state_M, state_n = state_values[t]
+                        Mt[:, t] = np.where(np.isnan(M), state_M[parent], M)
+                        nt[:, t] = np.where(member, n, state_n[parent])
+
+                    rankings = pd.DataFrame({'State': locations.state[ids], 'City': locations.city[ids]}, index=ids)
+                    rankings['M'] = nanmean(Mt)
+                    rankings['n'] = np.asfortranarray(nt).sum(axis=1).astype(int)
+                    for t, source_type in enumerate(source_types):
+                        rankings[f'M_{source_type}'] = Mt[:, t]
+                        rankings[f'n_{source_type}'] = nt[:, t]
+                    sp.set(rows=len(ids))
+                yield rankings
+
+        with tracing.span('4_chunks', rows=n_locations, chunk_size=chunk_size, format=output_format):
+            save_path = save_rankings(chunks(), output_name(filename, normalizeAll), output_format)
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        tracing.flush()
+
+    if verbose:
+        print(f'Data has been saved to {save_path}!')
+
+    return save_path
+
+
+if __name__ == '__main__':
+    enter_root()
+    gardnm_outofcore(verbose=True)
@@ -0,0 +1,17 @@
+"""
+Location of the repository root.
+
+Every data path of the model is relative to the repository root
+(./data/...), so the command-line entry points make it the working
+directory first. It is found from the location of this file, which needs
+neither GitPython nor a git checkout.
+"""
+
+import os
+
+ROOT = os.path.abspath(f'{__file__}/../../..')
+
+
+def enter_root():
+    """Make the repository root the working directory, as the data paths expect"""
+    os.chdir(ROOT)
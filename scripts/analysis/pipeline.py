@@ -0,0 +1,423 @@
+"""
+Fingerprinted pipeline runner for the GARDN-M model, from the scrapers to
+the rankings.
+
+    scrape:<source>   data/scraped_data/<file>                the registered scraper, see scripts/gather/registry.py
+    process:<source>  data/processed_data/<source>.csv        PROCESSORS[source], or by hand
+    names             the place-name index                    names.py
+    score:<source>    B, P, S, W and PSW of one source        main.process_source
+    states            every state found in the data
+    subrank:<type>    the subranking of one source_type       main.subrank
+    rankings          data/outputs/<name>                     engine.combine_arrays and writers.py
+
+A node is rebuilt when it is stale: an output is missing, or its fingerprint
+changed. The fingerprint hashes the options of the node, the content of its
+input files and the content of the outputs of the nodes it depends on, so a
+rebuild whose output comes out the same stops there and is reported as
+unchanged. The place-name index only changes with the place names, so editing
+the values of one source only rebuilds that source, its source_type and the
+rankings. The fingerprints are kept in data/cache/pipeline/fingerprints.json.
+Nodes that do not depend on each other are built in parallel, each as soon as
+its dependencies are done.
+
+The processed data is curated by hand, so a process node without a
+registered processor is never rebuilt; when the scraped data behind it
+changes, it is reported until the processed file is updated.
+
+Checking an up-to-date tree only hashes files, the model modules are only
+imported once something has to be rebuilt.
+
+Running this file runs the pipeline, --dry-run lists what would be rebuilt
+and why.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from cache import CACHE_DIR, file_hash, make_key
+from paths import ROOT, enter_root
+from writers import output_name, output_path
+
+PIPELINE_DIR = os.path.join(CACHE_DIR, 'pipeline')
+FINGERPRINTS_PATH = os.path.join(PIPELINE_DIR, 'fingerprints.json')
+CONFIG_FILES = {
+    'statename_to_abbr': './data/utils/statename_to_abbr.json',
+    'source_ratings': './data/sources/source_ratings.json',
+    'source_types': './data/sources/source_types.json',
+    'source_subtypes': './data/sources/source_subtypes.json',
+}
+ALIASES_PATH = './data/utils/place_aliases.json'
+SPECS_PATH = './data/sources/ingest_specs.json'
+
+# source -> function(scraped_paths, processed_path) that writes data/processed_data/<source>.csv
+PROCESSORS = {}
+
+
+def read_config():
+    """The JSON files of CONFIG_FILES, read without importing the model"""
+    config = {}
+    for name, path in CONFIG_FILES.items():
+        with open(path, 'r') as f:
+            config[name] = json.load(f)
+    return config
+
+
+def load_fingerprints():
+    """Fingerprints of the last build of every node"""
+    try:
+        with open(FINGERPRINTS_PATH, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_fingerprints(records):
+    os.makedirs(PIPELINE_DIR, exist_ok=True)
+    temporary = f'{FINGERPRINTS_PATH}.{os.getpid()}'
+    with open(temporary, 'w') as f:
+        json.dump(records, f, indent=1, sort_keys=True)
+    os.replace(temporary, FINGERPRINTS_PATH)
+
+
+def node(name, build = None, deps = (), files = (), config = None, outputs = (), after = ()):
+    """One node of the pipeline
+
+    Args:
+        name: unique name, e.g. 'score:<source>'
+        build: function without arguments writing the outputs, None for outputs maintained by hand
+        deps: names of the nodes whose outputs this node reads
+        files: input files that no node writes
+        config: JSON-serializable options of the node
+        outputs: files the node writes
+        after: names of nodes that must run first without being inputs
+
+    Returns:
+        node: dictionary
+    """
+    return {'name': name, 'build': build, 'deps': list(deps), 'files': list(files), 'config': config, 'outputs': list(outputs), 'after': list(after)}
+
+
+def hashes(paths):
+    """Content hash of every file, None where it is missing"""
+    return {path: file_hash(path) if os.path.exists(path) else None for path in paths}
+
+
+def fingerprint(n, nodes):
+    """Hash of everything a node depends on: its options, its input files and the outputs of its dependencies"""
+    return make_key(n['name'], n['config'], input_hashes(n, nodes))
+
+
+def stale_reason(n, nodes, records, status, force):
+    """Why a node has to be rebuilt, None when it is up to date
+
+    Args:
+        n: the node
+        nodes: dictionary of name -> node
+        records: output of load_fingerprints
+        status: status of the nodes decided so far
+        force: names of nodes to rebuild anyway
+
+    Returns:
+        reason: string, or None
+    """
+    if n['name'] in force:
+        return 'forced'
+    upstream = [d for d in n['deps'] + n['after'] if status.get(d) == 'would rebuild']
+    if upstream:
+        return f'{upstream[0]} would rebuild' # a dry run cannot tell whether its output would change
+    missing = [path for path in n['outputs'] if not os.path.exists(path)]
+    if missing:
+        return f'{missing[0]} is missing'
+    record = records.get(n['name'])
+    if record is None:
+        return 'never built'
+    if record['fingerprint'] != fingerprint(n, nodes):
+        inputs = input_hashes(n, nodes)
+        changed = [k for k in dict.fromkeys(list(inputs) + list(record['inputs'])) if inputs.get(k) != record['inputs'].get(k)]
+        return f'{changed[0]} changed' if changed else 'options changed'
+    return None
+
+
+def input_hashes(n, nodes):
+    """Hashes behind the fingerprint of a node, kept to explain later rebuilds; missing input files are left out"""
+    inputs = {d: hashes(nodes[d]['outputs']) for d in n['deps']}
+    inputs.update({path: h for path, h in hashes(n['files']).items() if h is not None})
+    return inputs
+
+
+def run(nodes, dry_run = False, force = (), workers = None, verbose = True):
+    """Build every stale node, in parallel where the dependencies allow
+
+    Args:
+        nodes: dictionary of name -> node, see build_graph
+        dry_run: only report what would be rebuilt and why
+        force: names of nodes to rebuild even when they are up to date
+        workers: number of nodes built at the same time, defaults to the number of CPUs
+        verbose: print every node that is not up to date
+
+    Returns:
+        status: dictionary of name -> 'up to date', 'rebuilt', 'unchanged' (rebuilt with the same outputs as before),
+            'would rebuild', 'manual', 'failed' or 'skipped'
+    """
+    start = time.perf_counter()
+    records = load_fingerprints()
+    status = {}
+    reasons = {}
+    pending = dict(nodes)
+    running = {}
+    executor = None
+
+    def report(name):
+        if verbose and status[name] != 'up to date':
+            print(f'{name}: {status[name]}' + (f' ({reasons[name]})' if name in reasons else ''))
+
+    while pending or running:
+        for name, n in list(pending.items()):
+            if any(d in pending or d in running.values() for d in n['deps'] + n['after']):
+                continue
+            del pending[name]
+            failed = [d for d in n['deps'] + n['after'] if status[d] in ('failed', 'skipped')]
+            reason = None if failed else stale_reason(n, nodes, records, status, force)
+            if failed:
+                status[name], reasons[name] = 'skipped', f'{failed[0]} failed'
+            elif reason is None:
+                status[name] = 'up to date'
+            elif n['build'] is None:
+                # maintained by hand: report it while its inputs changed and its outputs did not, otherwise adopt them
+                record = records.get(name)
+                changed = reason.endswith('would rebuild') or (record is not None and record['inputs'] != input_hashes(n, nodes))
+                if not changed or record['outputs'] != hashes(n['outputs']):
+                    if not dry_run:
+                        records[name] = {'fingerprint': fingerprint(n, nodes), 'inputs': input_hashes(n, nodes), 'outputs': hashes(n['outputs'])}
+                    status[name] = 'up to date'
+                else:
+                    status[name], reasons[name] = 'manual', f'{reason}, update {n["outputs"][0]} by hand'
+            elif dry_run:
+                status[name], reasons[name] = 'would rebuild', reason
+            else:
+                reasons[name] = reason
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+                running[executor.submit(n['build'])] = name
+                continue
+            report(name)
+
+        if running:
+            done = wait(running, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                name = running.pop(future)
+                n = nodes[name]
+                try:
+                    future.result()
+                    outputs = hashes(n['outputs'])
+                    status[name] = 'unchanged' if records.get(name, {}).get('outputs') == outputs else 'rebuilt'
+                    records[name] = {'fingerprint': fingerprint(n, nodes), 'inputs': input_hashes(n, nodes), 'outputs': outputs}
+                    save_fingerprints(records)
+                except Exception:
+                    status[name] = 'failed'
+                    traceback.print_exc()
+                report(name)
+        elif pending:
+            raise ValueError(f'Unknown dependencies or a cycle among {list(pending)}')
+
+    if executor is not None:
+        executor.shutdown()
+    if not dry_run:
+        save_fingerprints(records)
+    if verbose:
+        counts = {s: list(status.values()).count(s) for s in dict.fromkeys(status.values())}
+        print(', '.join(f'{k} {s}' for s, k in counts.items()) + f' in {time.perf_counter() - start:.2f} s')
+
+    return status
+
+
+def build_graph(
+    scrape = (),
+    normalizeAll = True,
+    ignore_subtypes = True,
+    engine = 'array',
+    filename = 'gardnm',
+    output_format = 'csv',
+):
+    """Nodes of the pipeline for the current source configuration
+
+    Args:
+        scrape: sources to scrape again, their scrape nodes are only part of the graph then
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        engine: 'array' or 'pandas', see main.gardnm
+        filename: prefix of the rankings file
+        output_format: 'csv', 'parquet', 'arrow' or 'sqlite', see writers.py
+
+    Returns:
+        nodes: dictionary of name -> node, in an order where dependencies come first
+    """
+    config = read_config()
+    statename_to_abbr = config['statename_to_abbr']
+    source_ratings = config['source_ratings']
+    source_types = config['source_types']
+    source_subtypes = config['source_subtypes']
+    records = load_fingerprints()
+    specs = {}
+    if os.path.exists(SPECS_PATH):
+        with open(SPECS_PATH, 'r') as f:
+            specs = json.load(f)
+    nodes = {}
+
+    def add(n):
+        nodes[n['name']] = n
+
+    if scrape:
+        sys.path.insert(0, os.path.join(ROOT, 'scripts', 'gather'))
+        import main_gather # registers every scraper
+        from registry import SCRAPERS, load_sources, run_scraper, scraped_file
+        from utils import get_processed_data_directory
+        urls = load_sources()
+        for source in scrape:
+            if source not in SCRAPERS or scraped_file(source) is None:
+                print(f' ---   WARNING: no scraper with a known output for {source}... skipping!')
+                continue
+            path = os.path.relpath(os.path.join(get_processed_data_directory(), scraped_file(source)))
+            add(node(f'scrape:{source}', lambda source=source: run_scraper(source, urls[source]), config=urls[source], outputs=[path]))
+
+    sources = []
+    for source in source_ratings:
+        path = f'./data/processed_data/{source}.csv'
+        if not os.path.exists(path) and source not in PROCESSORS:
+            print(f' ---   WARNING: processed data for {source}.csv was not found... skipping!')
+            continue
+        sources.append(source)
+        # the scraped files are known from the last scrape, so the fingerprint does not depend on whether this run scrapes
+        scraped = nodes[f'scrape:{source}']['outputs'] if f'scrape:{source}' in nodes else records.get(f'scrape:{source}', {}).get('outputs', [])
+        build = (lambda source=source, scraped=list(scraped), path=path: PROCESSORS[source](scraped, path)) if source in PROCESSORS else None
+        add(node(f'process:{source}', build, files=scraped, outputs=[path], after=[f'scrape:{source}'] if f'scrape:{source}' in nodes else []))
+
+    names_path = os.path.join(PIPELINE_DIR, 'names.pkl')
+    add(node('names', lambda: build_names(statename_to_abbr, sources, names_path),
+        deps=[f'process:{s}' for s in sources], files=[CONFIG_FILES['statename_to_abbr']] + ([ALIASES_PATH] if os.path.exists(ALIASES_PATH) else []),
+        config=sources, outputs=[names_path]))
+
+    counts = {}
+    for subtype in source_subtypes.values():
+        counts[subtype] = counts.get(subtype, 0) + 1
+    scores = {}
+    for source in sources:
+        scores[source] = os.path.join(PIPELINE_DIR, 'scores', f'{source}.pkl')
+        options = [source_ratings[source], specs.get(source), normalizeAll, ignore_subtypes]
+        if not ignore_subtypes:
+            options += [source_subtypes.get(source), counts.get(source_subtypes.get(source), 1)]
+        add(node(f'score:{source}', lambda source=source: build_score(source, names_path, scores[source], normalizeAll, ignore_subtypes),
+            deps=[f'process:{source}', 'names'], files=[CONFIG_FILES['statename_to_abbr']], config=options, outputs=[scores[source]]))
+
+    states_path = os.path.join(PIPELINE_DIR, 'states.json')
+    add(node('states', lambda: build_states(scores, states_path), deps=[f'score:{s}' for s in sources], outputs=[states_path]))
+
+    subrankings = {}
+    for source_type, st_list in source_types.items():
+        st_list = [s for s in st_list if s in scores]
+        subrankings[source_type] = os.path.join(PIPELINE_DIR, 'subrankings', f'{source_type}.pkl')
+        subtypes = None if ignore_subtypes else {s: source_subtypes.get(s) for s in st_list}
+        add(node(f'subrank:{source_type}', lambda source_type=source_type, st_list=st_list: build_subrank(source_type, st_list, scores, states_path, subrankings[source_type], ignore_subtypes, engine),
+            deps=[f'score:{s}' for s in st_list] + ['states'], config=[source_type, st_list, subtypes, engine], outputs=[subrankings[source_type]]))
+
+    name = output_name(filename, normalizeAll)
+    add(node('rankings', lambda: build_rankings(subrankings, states_path, list(source_types), engine, name, output_format),
+        deps=[f'subrank:{st}' for st in source_types] + ['states'], config=[list(source_types), engine, name, output_format],
+        outputs=[output_path(name, output_format)]))
+
+    return nodes
+
+
+def build_names(statename_to_abbr, sources, path):
+    import pandas as pd
+    from names import load_name_index
+
+    names = load_name_index(statename_to_abbr, sources)
+    # pickles of the same index need not come out byte for byte the same, and the key only changes with the
+    # place names, so the file is left alone while it holds the same index
+    try:
+        if pd.read_pickle(path)['key'] == names['key']:
+            return
+    except (FileNotFoundError, KeyError, EOFError, pickle.UnpicklingError):
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.to_pickle(names, path)
+
+
+def build_score(source, names_path, path, normalizeAll, ignore_subtypes):
+    import pandas as pd
+    from main import load_config, process_source, read_source, subtype_sizes
+
+    statename_to_abbr, source_ratings, source_types, source_subtypes = load_config()
+    sdata = read_source(source, statename_to_abbr, names=pd.read_pickle(names_path))
+    n_subtypes = None if ignore_subtypes else subtype_sizes(source_subtypes)
+    sdata = process_source(sdata, source, normalizeAll, source_ratings, source_subtypes, ignore_subtypes, n_subtypes)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.to_pickle(sdata[['State', 'City', 'B', 'P', 'S', 'W', 'PSW']], path)
+
+
+def build_states(scores, path):
+    import numpy as np
+    import pandas as pd
+
+    states = np.unique(np.concatenate([pd.read_pickle(p).State.values for p in scores.values()]))
+    with open(path, 'w') as f:
+        json.dump(states.tolist(), f)
+
+
+def read_states(path):
+    import numpy as np
+
+    with open(path, 'r') as f:
+        return np.array(json.load(f), dtype=object)
+
+
+def build_subrank(source_type, st_list, scores, states_path, path, ignore_subtypes, engine):
+    import pandas as pd
+    from main import load_config, subrank
+
+    source_subtypes = load_config()[3]
+    data = {s: pd.read_pickle(scores[s]) for s in st_list}
+    subrankings = subrank(data, {source_type: st_list}, source_subtypes, read_states(states_path), ignore_subtypes, engine)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.to_pickle(subrankings[source_type], path)
+
+
+def build_rankings(subrankings, states_path, source_types, engine, name, output_format):
+    import pandas as pd
+    from engine import combine_arrays
+    from main import combine_pandas
+    from writers import save_rankings
+
+    subrankings = {st: pd.read_pickle(path) for st, path in subrankings.items()}
+    states = read_states(states_path)
+    if engine == 'array':
+        rankings = combine_arrays(subrankings, states, source_types)
+    else:
+        rankings = combine_pandas(subrankings, states, source_types)
+    save_rankings(rankings, name, output_format)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the stale steps of the GARDN-M pipeline')
+    parser.add_argument('--dry-run', action='store_true', help='list what would be rebuilt and why')
+    parser.add_argument('--scrape', nargs='*', default=[], help='scrape these sources again before processing')
+    parser.add_argument('--force', nargs='*', default=[], help='rebuild these nodes even when they are up to date')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--engine', default='array', choices=['array', 'pandas'])
+    parser.add_argument('--format', default='csv', help='csv, parquet, arrow or sqlite')
+    parser.add_argument('--raw', action='store_true', help='do not normalize the raw data')
+    parser.add_argument('--subtypes', action='store_true', help='use the subtypes in source_subtypes.json')
+    args = parser.parse_args()
+
+    enter_root()
+    nodes = build_graph(args.scrape, not args.raw, not args.subtypes, args.engine, output_format=args.format)
+    force = set(args.force) | {f'scrape:{s}' for s in args.scrape}
+    status = run(nodes, args.dry_run, force, args.workers)
+    sys.exit(1 if 'failed' in status.values() else 0)
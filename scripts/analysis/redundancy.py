@@ -0,0 +1,300 @@
+"""
+Redundancy analysis of the GARDN-M sources.
+
+Many sources measure nearly the same thing, and W is meant to keep such
+repetitions from counting several times. This computes the pairwise
+Spearman and Kendall tau-b correlations of the composite scores B of every
+pair of sources over the locations both have a row for, and suggests
+subtypes and W values from them: the sources of a source_type whose
+correlation reaches a threshold are grouped together, and every member of a
+group of k sources gets W = 1/k, as assign_PSW does for source_subtypes.json.
+
+All pairs of one source with the sources after it are computed at once, as
+segments of a few flat arrays: ranks are averaged over ties with bincounts,
+and the discordant pairs of Kendall's tau are counted as inversions with a
+bottom-up merge sort over every segment at the same time (Knight's
+algorithm), so a pair with n shared locations costs O(n log n).
+
+The matrices are cached under data/cache/redundancy and recomputed when any
+processed_data file, the ingest specs, the state abbreviations or the place
+aliases change.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import file_hash, make_key, load_cached, store_cached
+from ingest import load_specs
+from locations import join_keys
+from main import load_config, read_source, score_source
+from names import load_name_index
+from paths import enter_root
+
+
+def source_codes(names, verbose = False):
+    """Dense rank codes of the composite scores B of every source over all locations
+
+    Args:
+        names: place-name index from names.load_name_index
+        verbose: some extra print statements that may be useful when debugging
+
+    Returns:
+        sources: list of sources that were found
+        codes: (locations x sources) integer array, the rank of B among the values of the source, -1 where missing
+    """
+    statename_to_abbr, source_ratings, source_types, source_subtypes = load_config()
+    sources = []
+    keys = []
+    values = []
+    for source in source_ratings:
+        try:
+            sdata = score_source(read_source(source, statename_to_abbr, names=names), source)
+        except FileNotFoundError:
+            print(f' ---   WARNING: processed data for {source}.csv was not found... skipping!')
+            continue
+        sdata = sdata.dropna(subset=['B']).drop_duplicates(subset=['State', 'City'], keep='last')
+        sources.append(source)
+        keys.append(pd.Index(join_keys(sdata['State'].values.astype(object), sdata['City'].values.astype(object))))
+        values.append(sdata['B'].values)
+    if verbose:
+        print(f'Read {len(sources)} sources')
+
+    locations = keys[0].append(keys[1:]).unique() if keys else pd.Index([])
+    codes = np.full((len(locations), len(sources)), -1)
+    for j, (k, v) in enumerate(zip(keys, values)):
+        codes[locations.get_indexer(k), j] = np.unique(v, return_inverse=True)[1].ravel()
+
+    return sources, codes
+
+
+def tie_groups(sorted_keys):
+    """Group index of every entry of a sorted key array, and the size of every group"""
+    start = np.empty(len(sorted_keys), dtype=bool)
+    start[:1] = True
+    start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group = np.cumsum(start) - 1
+    return group, np.bincount(group)
+
+
+def average_ranks(keys, segment, n_segments):
+    """1-based ranks within every segment, averaged over ties
+
+    Args:
+        keys: integer array of values to rank, unique per segment only up to ties
+        segment: segment index of every entry
+        n_segments: number of segments
+
+    Returns:
+        ranks: rank of every entry within its segment
+        ties: number of tied pairs in every segment
+    """
+    order = np.lexsort((keys, segment))
+    n = np.bincount(segment, minlength=n_segments)
+    position = np.arange(len(keys)) - (np.cumsum(n) - n)[segment[order]] + 1
+    group, size = tie_groups(segment[order].astype(np.int64) * (keys.max() + 1 if len(keys) else 1) + keys[order])
+    ranks = np.empty(len(keys))
+    ranks[order] = (np.bincount(group, weights=position) / size)[group]
+    first = np.flatnonzero(np.diff(group, prepend=-1) > 0) # first entry of every group
+    ties = np.bincount(segment[order][first], weights=size * (size - 1) / 2, minlength=n_segments)
+
+    return ranks, ties
+
+
+def segment_inversions(y, segment, position, n):
+    """Number of pairs i < j with y[i] > y[j] within every segment
+
+    Bottom-up merge sort over all segments at once: at every level each right
+    block counts the entries of its left block that are larger, and the two
+    sorted blocks are merged with a stable sort, which takes linear time on
+    two sorted runs.
+
+    Args:
+        y: integer array, ordered by segment and then position
+        segment: segment index of every entry
+        position: 0-based position of every entry within its segment
+        n: length of every segment
+
+    Returns:
+        inversions: array with the count of every segment
+    """
+    y = y.astype(np.int64)
+    K = y.max() + 1 if len(y) else 1
+    inversions = np.zeros(len(n))
+    width = 1
+    while width < (n.max() if len(n) else 0):
+        blocks = n.max() // (2 * width) + 1
+        block = segment.astype(np.int64) * blocks + position // (2 * width)
+        key = block * K + y
+        right = (position // width) % 2 == 1
+        left = key[~right] # sorted: blocks in order, and every left block is sorted
+        larger = np.searchsorted(left, (block[right] + 1) * K) - np.searchsorted(left, key[right], side='right')
+        inversions += np.bincount(segment[right], weights=larger, minlength=len(n))
+        y = y[np.argsort(key, kind='stable')]
+        width *= 2
+
+    return inversions
+
+
+def pair_correlations(x, y, segment, n_segments):
+    """Spearman and Kendall tau-b correlations of many pairs of samples at once
+
+    Args:
+        x: integer rank codes of the first sample of every pair
+        y: integer rank codes of the second sample of every pair
+        segment: pair index of every entry
+        n_segments: number of pairs
+
+    Returns:
+        spearman: array of Spearman correlations, NaN where a sample is constant
+        kendall: array of Kendall tau-b correlations, NaN where a sample is constant
+        n: array of the number of shared entries
+    """
+    n = np.bincount(segment, minlength=n_segments)
+    rx, u = average_ranks(x, segment, n_segments)
+    ry, v = average_ranks(y, segment, n_segments)
+    joint = x.astype(np.int64) * (y.max() + 1 if len(y) else 1) + y
+    t = average_ranks(joint, segment, n_segments)[1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Pearson correlation of the ranks, the mean rank is (n + 1) / 2 for both
+        mean = (n + 1) / 2
+        cov = np.bincount(segment, weights=rx * ry, minlength=n_segments) / n - mean**2
+        var_x = np.bincount(segment, weights=rx**2, minlength=n_segments) / n - mean**2
+        var_y = np.bincount(segment, weights=ry**2, minlength=n_segments) / n - mean**2
+        spearman = cov / np.sqrt(var_x * var_y)
+
+        # discordant pairs are the inversions of y once sorted by (x, y)
+        order = np.lexsort((y, x, segment))
+        position = np.arange(len(x)) - (np.cumsum(n) - n)[segment[order]]
+        discordant = segment_inversions(y[order], segment[order], position, n)
+        total = n * (n - 1) / 2
+        kendall = (total - u - v + t - 2 * discordant) / np.sqrt((total - u) * (total - v))
+
+    return np.clip(spearman, -1, 1), np.clip(kendall, -1, 1), n
+
+
+def correlation_matrices(sources, codes, min_shared = 10):
+    """Pairwise Spearman and Kendall tau-b correlations of every pair of sources
+
+    Args:
+        sources: list of sources, one column of codes each
+        codes: output of source_codes
+        min_shared: pairs with fewer shared locations get NaN
+
+    Returns:
+        matrices: dictionary of 'spearman', 'kendall' and 'shared' -> (sources x sources) DataFrame
+    """
+    S = len(sources)
+    spearman = np.eye(S)
+    kendall = np.eye(S)
+    has = codes >= 0
+    shared = has.sum(axis=0) * np.eye(S, dtype=int)
+    for i in range(S - 1):
+        # every pair (i, j > i) is one segment
+        rows = np.flatnonzero(has[:, i])
+        entry, j = np.nonzero(has[rows, i+1:].T)[::-1]
+        r, k, n = pair_correlations(codes[rows[entry], i], codes[rows[entry], i + 1 + j], j, S - i - 1)
+        few = n < max(min_shared, 2)
+        r[few] = np.nan
+        k[few] = np.nan
+        spearman[i, i+1:] = spearman[i+1:, i] = r
+        kendall[i, i+1:] = kendall[i+1:, i] = k
+        shared[i, i+1:] = shared[i+1:, i] = n
+
+    return {name: pd.DataFrame(matrix, index=sources, columns=sources) for name, matrix in [('spearman', spearman), ('kendall', kendall), ('shared', shared)]}
+
+
+def redundancy(min_shared = 10, cache = True, verbose = False):
+    """Correlation matrices of all the sources, cached until a source file changes
+
+    Args:
+        min_shared: pairs with fewer shared locations get NaN
+        cache: read and store the matrices in data/cache/redundancy
+        verbose: some extra print statements that may be useful when debugging
+
+    Returns:
+        matrices: see correlation_matrices
+    """
+    statename_to_abbr, source_ratings = load_config()[:2]
+    names = load_name_index(statename_to_abbr, list(source_ratings))
+    files = [(s, file_hash(f'./data/processed_data/{s}.csv')) for s in source_ratings if os.path.exists(f'./data/processed_data/{s}.csv')]
+    key = make_key('redundancy', files, names['key'], load_specs(), min_shared)
+    if cache:
+        matrices = load_cached('redundancy', 'matrices', key)
+        if matrices is not None:
+            if verbose:
+                print('Cache: reused the correlation matrices')
+            return matrices
+
+    matrices = correlation_matrices(*source_codes(names, verbose), min_shared)
+    if cache:
+        store_cached('redundancy', 'matrices', key, matrices)
+
+    return matrices
+
+
+def suggest_subtypes(correlations, source_types, threshold = 0.7):
+    """Group the sources of every source_type that are correlated at or above a threshold
+
+    Sources are grouped by single linkage: two sources land in the same group
+    when a chain of pairs at or above the threshold connects them. Pairs with
+    too few shared locations do not link.
+
+    Args:
+        correlations: (sources x sources) DataFrame, e.g. the 'kendall' matrix of redundancy
+        source_types: dictionary of source_type -> list of sources
+        threshold: correlation from which two sources count as repetitions
+
+    Returns:
+        suggested: DataFrame indexed by source with source_type, subtype, k (size of the subtype) and the suggested W = 1/k
+    """
+    suggested = []
+    for source_type, st_list in source_types.items():
+        st_list = [s for s in st_list if s in correlations.index]
+        linked = (correlations.loc[st_list, st_list].values >= threshold) | np.eye(len(st_list), dtype=bool)
+        group = np.arange(len(st_list))
+        for _ in range(len(st_list)):
+            # every source takes the smallest group it is linked to, until nothing changes
+            new = np.where(linked, group[None, :], len(st_list)).min(axis=1)
+            if (new == group).all():
+                break
+            group = new
+        group = np.unique(group, return_inverse=True)[1].ravel()
+        k = np.bincount(group)[group]
+        suggested.append(pd.DataFrame({'source_type': source_type, 'subtype': [f'{source_type}_{g}' for g in group], 'k': k, 'W': 1 / k}, index=pd.Index(st_list, name='source')))
+
+    return pd.concat(suggested)
+
+
+def save_subtypes(suggested, path):
+    """Save suggested subtypes in the format of source_subtypes.json"""
+    with open(path, 'w') as f:
+        json.dump(suggested['subtype'].to_dict(), f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Correlations between the sources and suggested repetition weights')
+    parser.add_argument('--method', default='kendall', choices=['kendall', 'spearman'], help='correlation used to group the sources')
+    parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--min-shared', type=int, default=10, help='pairs with fewer shared locations are not compared')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--output', default=None, help='where to save the suggested source_subtypes.json')
+    args = parser.parse_args()
+    enter_root()
+
+    matrices = redundancy(args.min_shared, not args.no_cache, verbose=True)
+    source_types = load_config()[2]
+    correlations = matrices[args.method]
+
+    pairs = correlations.where(np.triu(np.ones(correlations.shape, dtype=bool), 1)).stack()
+    pairs = pd.DataFrame({args.method: pairs, 'shared': matrices['shared'].stack()[pairs.index]}).sort_values(args.method, ascending=False)
+    print(pairs.head(20).to_string())
+    suggested = suggest_subtypes(correlations, source_types, args.threshold)
+    print(suggested.to_string())
+    if args.output:
+        save_subtypes(suggested, args.output)
+        print(f'Subtypes have been saved to {args.output}, use them as source_subtypes.json with ignore_subtypes=False')
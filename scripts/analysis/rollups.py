@@ -0,0 +1,259 @@
+"""
+Geographic rollups of the GARDN-M rankings, from cities to larger regions.
+
+The rankings mix cities and states in one frame, with every city falling
+back on its state row for the source_types that do not cover it. A rollup
+instead averages the cities of a region, weighted by their population:
+
+    M_region = sum(population * M) / sum(population), over the member cities that have an M
+
+separately for M and for the M_<source_type> of every source_type, where a
+city only counts for a source_type if that source_type covers the city
+itself rather than through its state.
+
+The regions come from a local crosswalk, data/utils/crosswalk.csv, with one
+row per city:
+
+    State, City   the city, resolved like the place names of the sources (see names.py)
+    population    optional, cities are weighted equally when the column is missing
+    any other     one column per level (e.g. metro, county), naming the region of the
+                  city at that level, empty when it belongs to none
+
+The state level needs no crosswalk: every city belongs to its own state. No
+population is ever made up; a city the crosswalk gives no population for is
+left out of the weighted rollups, and reported.
+
+The membership of every city in every region of every level is one sparse
+(regions x locations) matrix, built once by prepare_rollups. All the levels
+and source_types are then averaged with a single sparse matrix product, so
+rollups of new rankings (or of a whole weight sweep, see sweep.py) take
+milliseconds.
+
+Running this file saves the rollups of the current rankings.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from engine import combine_arrays
+from locations import join_keys
+from main import load_cached_sources, load_config, output_name, subrank
+from names import load_name_index, resolve_names
+from paths import enter_root
+from writers import save_rankings
+
+CROSSWALK_PATH = './data/utils/crosswalk.csv'
+
+
+def load_crosswalk(names, path = CROSSWALK_PATH):
+    """Load the crosswalk with its place names resolved, None when there is none
+
+    Args:
+        names: place-name index from names.load_name_index
+        path: CSV of State, City, an optional population and one column per level
+
+    Returns:
+        crosswalk: DataFrame with canonical State and City, or None
+    """
+    if not os.path.exists(path):
+        return None
+    crosswalk = pd.read_csv(path, dtype=object)
+    if 'population' in crosswalk:
+        crosswalk['population'] = pd.to_numeric(crosswalk['population'], errors='coerce')
+
+    state, city, resolved = resolve_names(crosswalk['State'].values, crosswalk['City'].values, names)
+    if not resolved.all():
+        print(f' ---   WARNING: {(~resolved).sum()} place names of the crosswalk could not be resolved... skipping!')
+    crosswalk['State'], crosswalk['City'] = state, city
+    crosswalk = crosswalk[resolved & (city != '')]
+
+    duplicated = pd.Index(join_keys(crosswalk['State'].values, crosswalk['City'].values)).duplicated()
+    if duplicated.any():
+        print(f' ---   WARNING: {duplicated.sum()} rows of the crosswalk name a city it already has... skipping!')
+        crosswalk = crosswalk[~duplicated]
+
+    return crosswalk.reset_index(drop=True)
+
+
+def prepare_rollups(locations, crosswalk = None, weighted = True):
+    """Sparse membership of every location in the regions of every level
+
+    Args:
+        locations: DataFrame of State and City, one row per location in the order of the values to roll up
+        crosswalk: output of load_crosswalk, None for the state level only
+        weighted: weight the cities by the population of the crosswalk, if it has one
+
+    Returns:
+        prepared: dictionary of the membership 'matrix' (regions x locations), the 'level' and 'region' of its rows,
+            and the 'weight' of every location (0 for states and for cities left out)
+    """
+    state = locations['State'].values.astype(object)
+    city = locations['City'].values.astype(object)
+    is_city = city != ''
+    columns = [] if crosswalk is None else [c for c in crosswalk.columns if c not in ('State', 'City', 'population')]
+
+    # row of every location in the crosswalk, -1 for the cities it does not have
+    if crosswalk is not None:
+        row = pd.Index(join_keys(crosswalk['State'].values, crosswalk['City'].values)).get_indexer(join_keys(state, city))
+    else:
+        row = np.full(len(locations), -1)
+    row[~is_city] = -1
+
+    weight = is_city.astype(float)
+    if weighted and crosswalk is not None and 'population' in crosswalk:
+        population = np.where(row >= 0, crosswalk['population'].values[row], np.nan)
+        missing = is_city & ~(population > 0)
+        if missing.any():
+            print(f' ---   WARNING: the crosswalk has no population for {missing.sum()} of {is_city.sum()} cities... skipping!')
+        weight = np.where(missing, 0, np.nan_to_num(population))
+    elif weighted and crosswalk is not None:
+        print(' ---   WARNING: the crosswalk has no population, weighting every city equally')
+
+    # one block of rows per level, region names sorted within the level
+    level_of = {'state': np.where(is_city, state, None)}
+    for column in columns:
+        level_of[column] = np.where(row >= 0, crosswalk[column].values[row], None)
+    levels, regions, rows, cols = [], [], [], []
+    offset = 0
+    for level, values in level_of.items():
+        member = np.flatnonzero(pd.notna(values) & (values != ''))
+        found, inverse = np.unique(values[member].astype(str), return_inverse=True)
+        rows.append(offset + inverse.ravel())
+        cols.append(member)
+        levels.append(np.full(len(found), level, dtype=object))
+        regions.append(found.astype(object))
+        offset += len(found)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(offset, len(locations)))
+
+    return {
+        'matrix': matrix,
+        'level': np.concatenate(levels),
+        'region': np.concatenate(regions),
+        'weight': weight,
+    }
+
+
+def rollup_prepared(prepared, values, valid = None):
+    """Weighted means of many columns over every region, in one sparse product
+
+    Args:
+        prepared: output of prepare_rollups
+        values: (locations x columns) array, e.g. the M and M_<source_type> of the rankings or the M of a sweep
+        valid: (locations x columns) boolean array of the entries to count, defaults to those that are not NaN
+
+    Returns:
+        mean: (regions x columns) weighted means, NaN where no member has a value
+        n: (regions x columns) number of members counted
+        weight: (regions x columns) total weight of the members counted
+    """
+    values = np.asarray(values, dtype=float).reshape(len(prepared['weight']), -1)
+    w = prepared['weight'][:, None]
+    valid = (~np.isnan(values) if valid is None else valid & ~np.isnan(values)) & (w > 0)
+    k = values.shape[1]
+
+    total = prepared['matrix'] @ np.hstack([np.where(valid, values * w, 0), valid * w, valid])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(total[:, k:2*k] > 0, total[:, :k] / total[:, k:2*k], np.nan)
+
+    return mean, total[:, 2*k:].astype(int), total[:, k:2*k]
+
+
+def coverage(rankings, subrankings, source_types):
+    """Entries of the rankings that a location has of its own, rather than through its state
+
+    Args:
+        rankings: DataFrame with State, City, M and the M_<source_type> of every source_type
+        subrankings: dictionary of source_type -> DataFrame with State and City, the rows of the source_type
+        source_types: dictionary of source_type -> list of sources
+
+    Returns:
+        valid: (locations x 1 + source_types) boolean array, for M and then every M_<source_type>
+    """
+    keys = join_keys(rankings['State'].values.astype(object), rankings['City'].values.astype(object))
+    valid = [np.ones(len(rankings), dtype=bool)] # every location of the rankings is covered by some source_type
+    for source_type in source_types:
+        stdata = subrankings[source_type]
+        valid.append(pd.Index(keys).isin(join_keys(stdata['State'].values.astype(object), stdata['City'].values.astype(object))))
+
+    return np.column_stack(valid)
+
+
+def rollup(rankings, subrankings, source_types, prepared):
+    """Rollups of the rankings to every level of a prepared crosswalk
+
+    Args:
+        rankings: DataFrame with State, City, M and the M_<source_type> of every source_type
+        subrankings: dictionary of source_type -> DataFrame with State and City
+        source_types: dictionary of source_type -> list of sources
+        prepared: output of prepare_rollups for the locations of the rankings
+
+    Returns:
+        rollups: DataFrame with level, region, M, n (member cities counted), population (total weight counted)
+            and the M and n of every source_type
+    """
+    columns = ['M'] + [f'M_{source_type}' for source_type in source_types]
+    mean, n, weight = rollup_prepared(prepared, rankings[columns].values, coverage(rankings, subrankings, source_types))
+
+    rollups = pd.DataFrame({'level': prepared['level'], 'region': prepared['region'], 'M': mean[:, 0], 'n': n[:, 0], 'population': weight[:, 0]})
+    for j, source_type in enumerate(source_types):
+        rollups[f'M_{source_type}'] = mean[:, 1+j]
+        rollups[f'n_{source_type}'] = n[:, 1+j]
+
+    return rollups
+
+
+def gardnm_rollups(
+    normalizeAll = True,
+    ignore_subtypes = True,
+    filename = 'gardnm',
+    output_format = 'csv',
+    weighted = True,
+    verbose = False,
+):
+    """Calculation of the GARDN-M rankings, rolled up to every level of the crosswalk
+
+    Args:
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        filename: prefix for filename to use when saving the rollups, None to not save
+        output_format: 'csv', 'parquet', 'arrow' or 'sqlite', see writers.py
+        weighted: weight the cities by the population of the crosswalk, if it has one
+        verbose: some extra print statements that may be useful when debugging
+
+    Returns:
+        rollups: DataFrame with one row per level and region, see rollup
+    """
+    statename_to_abbr = load_config()[0]
+    source_ratings, source_types, source_subtypes, data, keys = load_cached_sources(normalizeAll, ignore_subtypes, verbose)
+    states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+    subrankings = subrank(data, source_types, source_subtypes, states, ignore_subtypes)
+    rankings = combine_arrays(subrankings, states, source_types)
+
+    crosswalk = load_crosswalk(load_name_index(statename_to_abbr, list(source_ratings)))
+    if crosswalk is None and verbose:
+        print(f'No crosswalk at {CROSSWALK_PATH}, rolling up to states only with every city weighted equally')
+    prepared = prepare_rollups(rankings, crosswalk, weighted)
+    rollups = rollup(rankings, subrankings, source_types, prepared)
+
+    if filename is not None:
+        path = save_rankings(rollups, output_name(f'{filename}_rollups', normalizeAll), output_format)
+        if verbose:
+            print(f'Data has been saved to {path}!')
+
+    return rollups
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Roll the rankings up from cities to states and the levels of the crosswalk')
+    parser.add_argument('--raw', action='store_true', help='do not normalize the raw data of every source')
+    parser.add_argument('--unweighted', action='store_true', help='weight every city equally, even with populations in the crosswalk')
+    parser.add_argument('--format', default='csv', help='csv, parquet, arrow or sqlite')
+    args = parser.parse_args()
+    enter_root()
+
+    gardnm_rollups(normalizeAll=not args.raw, weighted=not args.unweighted, output_format=args.format, verbose=True)
@@ -0,0 +1,376 @@
+"""
+Query service for the GARDN-M model.
+
+The sources are loaded, the rankings computed and the lookup indexes built
+once, then kept in memory to answer queries over HTTP (TCP or a Unix socket):
+
+    GET  /city?name=Boston[&state=MA]     rankings of every city with that name
+    GET  /state?name=MA                   rankings of a state (abbreviation or full name)
+    GET  /top?n=10[&level=city][&by=M]    best n locations, level is city, state or all
+    POST /score                           re-score with custom weights, see score()
+    POST /reload                          rebuild the model now
+    GET  /health                          when the model was built and from what
+
+A background thread watches data/processed_data and data/sources and builds
+a new model when anything changes. The new model replaces the old one in a
+single assignment, so requests that are already running finish on the model
+they started with.
+
+Usage:
+    python server.py [--host 127.0.0.1] [--port 8765] [--socket PATH] [--poll 5]
+"""
+
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from engine import combine_arrays
+from main import load_cached_sources, load_config, subrank
+from paths import enter_root
+from sweep import prepare_sweep, stack_configs, sweep_prepared
+
+WATCHED = ['./data/processed_data', './data/sources', './data/utils/statename_to_abbr.json', './data/utils/place_aliases.json']
+
+
+def data_signature():
+    """Modification times and sizes of every input of the model
+
+    Returns:
+        signature: sorted list of (path, mtime_ns, size)
+    """
+    signature = []
+    for path in WATCHED:
+        if not os.path.exists(path):
+            continue
+        paths = [os.path.join(path, f) for f in os.listdir(path)] if os.path.isdir(path) else [path]
+        for p in paths:
+            stat = os.stat(p)
+            signature.append((p, stat.st_mtime_ns, stat.st_size))
+
+    return sorted(signature)
+
+
+def to_records(frame):
+    """Rows of a frame as JSON-ready dictionaries, with NaN as None"""
+    records = frame.astype(object).where(frame.notna(), None).to_dict('records')
+    for record, location in zip(records, frame.index):
+        record['id'] = int(location)
+    return records
+
+
+def build_model(normalizeAll = True, ignore_subtypes = True):
+    """Run the model and build the indexes used to answer queries
+
+    Args:
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+
+    Returns:
+        model: dictionary of the rankings, the lookup indexes and the prepared re-scoring matrices
+    """
+    start = time.perf_counter()
+    signature = data_signature()
+    statename_to_abbr = load_config()[0]
+    source_ratings, source_types, source_subtypes, data, keys = load_cached_sources(normalizeAll, ignore_subtypes)
+    states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+    subrankings = subrank(data, source_types, source_subtypes, states, ignore_subtypes)
+    rankings = combine_arrays(subrankings, states, source_types)
+
+    records = to_records(rankings)
+    locations = {}
+    cities = {}
+    for i, record in enumerate(records):
+        locations[(record['State'], record['City'].casefold())] = i
+        if record['City'] != '':
+            cities.setdefault(record['City'].casefold(), []).append(i)
+
+    return {
+        'rankings': rankings,
+        'records': records,
+        'locations': locations,
+        'cities': cities,
+        'state_names': {name.casefold(): abbr for name, abbr in statename_to_abbr.items()},
+        'orders': {},
+        'source_ratings': source_ratings,
+        'prepared': prepare_sweep(data, source_types, states, None if ignore_subtypes else source_subtypes),
+        'signature': signature,
+        'built': time.time(),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def top(model, n = 10, level = 'all', by = 'M'):
+    """Best n locations of a model
+
+    Args:
+        model: dictionary from build_model
+        n: number of locations
+        level: 'city', 'state' or 'all'
+        by: column to rank by, M or one of the M_<source_type>
+
+    Returns:
+        records: list of ranking dictionaries, best first
+    """
+    if level not in ('city', 'state', 'all'):
+        raise ValueError(f'Unknown level {level}, expected "city", "state" or "all"')
+    if by not in model['rankings'] or not by.startswith('M'):
+        raise ValueError(f'Unknown column {by}')
+
+    # the sorted positions are computed on first use and kept with the model
+    order = model['orders'].get((level, by))
+    if order is None:
+        rankings = model['rankings']
+        values = rankings[by].values
+        keep = ~np.isnan(values)
+        if level != 'all':
+            keep &= (rankings['City'].values == '') == (level == 'state')
+        order = np.flatnonzero(keep)[np.argsort(-values[keep], kind='stable')]
+        model['orders'][(level, by)] = order
+
+    return [model['records'][i] for i in order[:n]]
+
+
+def score(model, config, n = 10, level = 'all', locations = None):
+    """Re-score every location with custom weights
+
+    Args:
+        model: dictionary from build_model
+        config: configuration dictionary as in sweep.stack_configs, with any of 'source_ratings', 'S_city', 'S_state' and 'W'
+        n: number of best locations to return, when no locations are given
+        level: 'city', 'state' or 'all'
+        locations: list of [State, City] pairs to return instead of the best n
+
+    Returns:
+        records: list of dictionaries with the State, City, id and re-scored M
+    """
+    if level not in ('city', 'state', 'all'):
+        raise ValueError(f'Unknown level {level}, expected "city", "state" or "all"')
+    prepared = model['prepared']
+    unknown = (set(config.get('source_ratings', {})) | set(config.get('W', {}))) - set(model['source_ratings'])
+    if unknown:
+        raise ValueError(f'Unknown sources {sorted(unknown)}')
+    P, S_city, S_state, W = stack_configs([config], prepared['sources'], model['source_ratings'], W=prepared['W'])
+    M = sweep_prepared(prepared, P, S_city, S_state, W=W)[:, 0]
+
+    frame = prepared['locations']
+    if locations is not None:
+        rows = []
+        for state, city in locations:
+            i = model['locations'].get((state, city.casefold()))
+            if i is None:
+                raise KeyError(f'{city}, {state}' if city else state)
+            rows.append(frame.index.get_loc(model['records'][i]['id']))
+    else:
+        keep = ~np.isnan(M)
+        if level != 'all':
+            keep &= (frame['City'].values == '') == (level == 'state')
+        rows = np.flatnonzero(keep)[np.argsort(-M[keep], kind='stable')][:n]
+
+    return [{'State': frame['State'].iat[r], 'City': frame['City'].iat[r], 'id': int(frame.index[r]), 'M': None if np.isnan(M[r]) else float(M[r])} for r in rows]
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def read_score_body(body):
+    """Check the JSON body of a POST /score and turn it into the arguments of score()
+
+    Args:
+        body: decoded JSON body
+
+    Returns:
+        config, n, level, locations: arguments of score
+
+    Raises:
+        ValueError: when any part of the body has the wrong type
+    """
+    if not isinstance(body, dict):
+        raise ValueError(f'the body must be a JSON object, not {type(body).__name__}')
+    config = {k: body[k] for k in ('source_ratings', 'S_city', 'S_state', 'W') if k in body}
+    for k in ('source_ratings', 'W'):
+        if not isinstance(config.get(k, {}), dict):
+            raise ValueError(f'{k} must be a JSON object of source -> value')
+    config['source_ratings'] = {s: p if isinstance(p, list) else [p] for s, p in config.get('source_ratings', {}).items()}
+    for s, p in config['source_ratings'].items():
+        if not p or not all(is_number(x) for x in p):
+            raise ValueError(f'the rating of {s} must be a number')
+    for s, w in config.get('W', {}).items():
+        if not is_number(w):
+            raise ValueError(f'the W of {s} must be a number')
+    for k in ('S_city', 'S_state'):
+        if k in config and not is_number(config[k]):
+            raise ValueError(f'{k} must be a number')
+
+    n, level, locations = body.get('n', 10), body.get('level', 'all'), body.get('locations')
+    if not isinstance(n, int) or isinstance(n, bool):
+        raise ValueError('n must be an integer')
+    if not isinstance(level, str):
+        raise ValueError('level must be a string')
+    if locations is not None and not (isinstance(locations, list) and all(
+            isinstance(l, list) and len(l) == 2 and all(isinstance(x, str) for x in l) for l in locations)):
+        raise ValueError('locations must be a list of [State, City] pairs')
+
+    return config, n, level, locations
+
+
+class Service:
+    """Holds the current model and replaces it when the data changes
+
+    Args:
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        poll: seconds between checks of the data for changes, 0 to never check
+    """
+
+    def __init__(self, normalizeAll = True, ignore_subtypes = True, poll = 5):
+        self.options = {'normalizeAll': normalizeAll, 'ignore_subtypes': ignore_subtypes}
+        self.poll = poll
+        self.building = threading.Lock()
+        self.model = build_model(**self.options)
+
+    def reload(self, force = False):
+        """Build a new model if the data changed (or always, with force) and swap it in
+
+        Returns:
+            reloaded: True if a new model was swapped in
+        """
+        with self.building:
+            if not force and data_signature() == self.model['signature']:
+                return False
+            self.model = build_model(**self.options)
+        print(f'Model rebuilt in {self.model["seconds"]*1000:.0f} ms')
+        return True
+
+    def watch(self):
+        """Check the data for changes every poll seconds, forever"""
+        while True:
+            time.sleep(self.poll)
+            try:
+                self.reload()
+            except Exception as error:
+                print(f' ---   WARNING: rebuilding the model failed, still serving the previous one: {error!r}')
+
+    def start(self):
+        """Start watching the data in a background thread"""
+        if self.poll:
+            threading.Thread(target=self.watch, daemon=True).start()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers the queries listed at the top of this module"""
+
+    protocol_version = 'HTTP/1.1' # keep connections open between queries
+
+    def send_json(self, obj, status = 200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        model = self.server.service.model # the model for the whole request, even if a reload swaps it meanwhile
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == '/city':
+                rows = model['cities'].get(query['name'].casefold(), [])
+                if 'state' in query:
+                    rows = [i for i in rows if model['records'][i]['State'] == query['state'].upper()]
+                self.send_json([model['records'][i] for i in rows], 200 if rows else 404)
+            elif url.path == '/state':
+                name = query['name']
+                abbr = model['state_names'].get(name.casefold(), name.upper())
+                i = model['locations'].get((abbr, ''))
+                self.send_json(model['records'][i] if i is not None else {'error': f'{name} was not found'}, 200 if i is not None else 404)
+            elif url.path == '/top':
+                self.send_json(top(model, int(query.get('n', 10)), query.get('level', 'all'), query.get('by', 'M')))
+            elif url.path == '/health':
+                self.send_json({'built': model['built'], 'seconds': model['seconds'], 'locations': len(model['records']), 'files': len(model['signature'])})
+            else:
+                self.send_json({'error': f'Unknown path {url.path}'}, 404)
+        except (KeyError, ValueError) as error:
+            self.send_json({'error': f'Bad query: {error}'}, 400)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if url.path == '/score':
+                model = self.server.service.model
+                self.send_json(score(model, *read_score_body(body)))
+            elif url.path == '/reload':
+                self.send_json({'reloaded': self.server.service.reload(force=True)})
+            else:
+                self.send_json({'error': f'Unknown path {url.path}'}, 404)
+        except KeyError as error:
+            self.send_json({'error': f'{error.args[0]} was not found'}, 404)
+        except ValueError as error:
+            self.send_json({'error': f'Bad query: {error}'}, 400)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ThreadingHTTPServer, over a Unix socket"""
+
+    daemon_threads = True
+
+
+def serve(host = '127.0.0.1', port = 8765, socket = None, poll = 5, normalizeAll = True, ignore_subtypes = True):
+    """Build the model and answer queries until interrupted
+
+    Args:
+        host: address to listen on
+        port: TCP port to listen on
+        socket: path of a Unix socket to listen on instead of host and port
+        poll: seconds between checks of the data for changes, 0 to never check
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+    """
+    service = Service(normalizeAll, ignore_subtypes, poll)
+    if socket is not None:
+        if os.path.exists(socket):
+            os.remove(socket)
+        httpd = UnixHTTPServer(socket, Handler)
+        where = socket
+    else:
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        where = f'http://{host}:{port}'
+    httpd.service = service
+    service.start()
+
+    print(f'Serving {len(service.model["records"])} locations on {where} (built in {service.model["seconds"]*1000:.0f} ms)')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve GARDN-M rankings from memory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help='listen on this Unix socket instead of host:port')
+    parser.add_argument('--poll', type=float, default=5, help='seconds between checks of the data for changes, 0 to disable')
+    parser.add_argument('--raw', action='store_true', help='do not normalize the raw data of every source')
+    args = parser.parse_args()
+    enter_root()
+
+    serve(args.host, args.port, args.socket, args.poll, normalizeAll=not args.raw)
@@ -0,0 +1,253 @@
+"""
+Batched weight sweeps for the GARDN-M model.
+
+Instead of rerunning gardnm() once per candidate weighting, the sources are
+loaded and normalized once and the final M of every location is computed for
+a whole stack of P/S/W configurations at the same time. Each source_type
+reduces to two (locations x sources) @ (sources x configs) products, and the
+fallback of city rows onto state rows only depends on which sources cover a
+location, so it is worked out once and shared by every configuration.
+
+The repetition weights W default to those of the loaded sources (1, or one
+over the size of the subtype of a source when subtypes apply), and a
+configuration can override them source by source. With subtypes, the
+per-location weights of engine.subtype_weights are scaled by the ratio of
+the overridden W to the loaded one, so a configuration that leaves W alone
+weights every subtype as gardnm() does.
+"""
+
+import numpy as np
+import pandas as pd
+
+from engine import build_locations, build_matrices, subtype_groups, subtype_weights
+from main import load_sources, process_sources
+
+
+def stack_configs(configs, sources, source_ratings, S_city = 2, S_state = 1, W = None):
+    """Turn a list of weight configurations into arrays
+
+    Each configuration is a dictionary with any of 'source_ratings' (in the
+    same shape as source_ratings.json, only P is used), 'S_city', 'S_state'
+    and 'W' (source -> repetition weight). Anything missing falls back to the
+    defaults.
+
+    Args:
+        configs: list of configuration dictionaries
+        sources: ordered list of sources, one column each
+        source_ratings: default ratings from source_ratings.json
+        S_city: default sensitivity of city entries, as in assign_PSW
+        S_state: default sensitivity of state entries, as in assign_PSW
+        W: (sources) array of default repetition weights, e.g. prepared['W'], 1 when not given
+
+    Returns:
+        P: (configs x sources) array of primacy ratings
+        S_city: (configs) array of city sensitivities
+        S_state: (configs) array of state sensitivities
+        W: (configs x sources) array of repetition weights
+    """
+    P = np.empty((len(configs), len(sources)))
+    S = np.empty((len(configs), 2))
+    Ws = np.empty((len(configs), len(sources)))
+    default = np.ones(len(sources)) if W is None else np.asarray(W, dtype=float)
+    for k, config in enumerate(configs):
+        ratings = {**source_ratings, **config.get('source_ratings', {})}
+        P[k] = [ratings[s][0] for s in sources]
+        S[k] = config.get('S_city', S_city), config.get('S_state', S_state)
+        Ws[k] = [config.get('W', {}).get(s, w) for s, w in zip(sources, default)]
+
+    return P, S[:, 0], S[:, 1], Ws
+
+
+def prepare_sweep(data, source_types, states, source_subtypes = None):
+    """Work out everything in a weight sweep that does not depend on the weights
+
+    Args:
+        data: dictionary of source data, each with State, City, B, W and PSW
+        source_types: dictionary of source_type -> list of sources
+        states: sorted array of every state found in the data
+        source_subtypes: dictionary of source -> subtype to weight the sources of a subtype as one source
+            at every location (see engine.subtype_weights), or None to ignore subtypes
+
+    Returns:
+        prepared: dictionary of the locations, per-source_type matrices and fallback rows, see sweep_prepared
+    """
+    sources = [s for st_list in source_types.values() for s in st_list if s in data]
+    locations = build_locations(data, source_types, states)
+    B, PSW, present = build_matrices(data, sources, locations)
+    W = np.array([data[s]['W'].iloc[0] for s in sources])
+    order = locations.sort_order()
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order)) # sorted position of every location ID
+    col = {s: j for j, s in enumerate(sources)}
+
+    # rows, masks and fallback rows of every source_type
+    types = []
+    has = np.zeros((len(order), len(source_types)), dtype=bool)
+    for j, st_list in enumerate(source_types.values()):
+        cols = [col[s] for s in st_list if s in data]
+        member = present[:, cols].any(axis=1)
+        member[:len(states)] = True
+        rows = np.flatnonzero(member)
+        valid = ~np.isnan(B[np.ix_(rows, cols)]) & ~np.isnan(PSW[np.ix_(rows, cols)])
+        n = valid.sum(axis=1)
+        nPSW = (~np.isnan(PSW[np.ix_(rows, cols)])).sum(axis=1)
+        # PW is multiplied by this per-location factor, 1 where the source has a weight unless subtypes apply
+        factor = (~np.isnan(PSW[np.ix_(rows, cols)])).astype(float)
+        if source_subtypes is not None:
+            factor = np.nan_to_num(subtype_weights(PSW[np.ix_(rows, cols)], W[cols], subtype_groups([s for s in st_list if s in data], source_subtypes)))
+        fill3, found3 = locations.fill_index((n > 0)[:, None], rows) # step (3) fallback within this source_type
+        has[position[rows], j] = found3[:, 0]
+        types.append({
+            'cols': cols,
+            'B': np.where(valid, B[np.ix_(rows, cols)] * factor, 0),
+            'PSW': factor,
+            'n': n,
+            'nPSW': nPSW,
+            'is_city': locations.city[rows] != '',
+            'position': position[rows],
+            'fill3': fill3[:, 0],
+        })
+    fill4, found4 = locations.fill_index(has, order) # step (4) fallback across source_types
+
+    return {
+        'sources': sources,
+        'W': W,
+        'types': types,
+        'fill4': fill4,
+        'found4': found4,
+        'locations': pd.DataFrame({'State': locations.state[order], 'City': locations.city[order]}, index=order),
+    }
+
+
+def sweep_prepared(prepared, P, S_city, S_state, chunk = 500, W = None):
+    """Calculate the final M of every location for a stack of weightings
+
+    Args:
+        prepared: output of prepare_sweep
+        P: (configs x sources) array of primacy ratings, sources ordered as in prepared['sources']
+        S_city: (configs) array of city sensitivities
+        S_state: (configs) array of state sensitivities
+        chunk: number of configurations computed at once, bounds the memory used
+        W: (configs x sources) array of repetition weights from stack_configs, prepared['W'] for every configuration when not given
+
+    Returns:
+        M: (locations x configs) array of final M values, rows ordered like prepared['locations']
+    """
+    types, fill4, found4 = prepared['types'], prepared['fill4'], prepared['found4']
+    W = np.broadcast_to(prepared['W'], P.shape) if W is None else W
+    n_locations = len(prepared['locations'])
+
+    M = np.empty((n_locations, len(P)))
+    for start in range(0, len(P), chunk):
+        PW = P[start:start+chunk] * W[start:start+chunk] # (configs x sources)
+        total = np.zeros((n_locations, len(PW)))
+        count = np.zeros(n_locations)
+        for j, t in enumerate(types):
+            S = np.where(t['is_city'][:, None], S_city[None, start:start+chunk], S_state[None, start:start+chunk])
+            num = S * (t['B'] @ PW[:, t['cols']].T) # sum of B*PSW
+            with np.errstate(invalid='ignore', divide='ignore'):
+                avgPSW = S * (t['PSW'] @ PW[:, t['cols']].T) / t['nPSW'][:, None]
+                Mt = num / avgPSW / t['n'][:, None]
+
+            Mfull = np.zeros((n_locations, len(PW)))
+            Mfull[t['position']] = Mt[t['fill3']]
+            total += np.where(found4[:, j, None], Mfull[fill4[:, j]], 0)
+            count += found4[:, j]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            M[:, start:start+chunk] = np.where(count[:, None] > 0, total / count[:, None], np.nan)
+
+    return M
+
+
+def sweep_arrays(data, source_types, states, P, S_city, S_state, chunk = 500, source_subtypes = None, W = None):
+    """Calculate the final M of every location for a stack of weightings
+
+    Args:
+        data: dictionary of source data, each with State, City, B, W and PSW
+        source_types: dictionary of source_type -> list of sources
+        states: sorted array of every state found in the data
+        P: (configs x sources) array of primacy ratings, sources ordered as in source_types
+        S_city: (configs) array of city sensitivities
+        S_state: (configs) array of state sensitivities
+        chunk: number of configurations computed at once, bounds the memory used
+        source_subtypes: dictionary of source -> subtype, or None to ignore subtypes, see prepare_sweep
+        W: (configs x sources) array of repetition weights, the W of the sources when not given
+
+    Returns:
+        locations: DataFrame of State and City, indexed by location ID and sorted like the rankings
+        M: (locations x configs) array of final M values
+    """
+    prepared = prepare_sweep(data, source_types, states, source_subtypes)
+
+    return prepared['locations'], sweep_prepared(prepared, P, S_city, S_state, chunk, W)
+
+
+def save_sweep(locations, M, filename, format = 'npz'):
+    """Save the output of a weight sweep
+
+    Args:
+        locations: DataFrame of State and City from sweep_arrays
+        M: (locations x configs) array of final M values
+        filename: prefix for filename to use when saving this sweep
+        format: 'npz' for a compressed NumPy archive, or 'parquet' for a long table (needs pyarrow)
+
+    Returns:
+        path: where the sweep was saved
+    """
+    if format == 'npz':
+        path = f'data/outputs/{filename}_sweep.npz'
+        np.savez_compressed(path, location=locations.index.values, State=locations['State'].values.astype(str), City=locations['City'].values.astype(str), M=M.astype(np.float32))
+    elif format == 'parquet':
+        path = f'data/outputs/{filename}_sweep.parquet'
+        table = pd.DataFrame({
+            'location': np.repeat(locations.index.values, M.shape[1]),
+            'State': pd.Categorical(np.repeat(locations['State'].values, M.shape[1])),
+            'City': pd.Categorical(np.repeat(locations['City'].values, M.shape[1])),
+            'config': np.tile(np.arange(M.shape[1], dtype=np.int32), len(locations)),
+            'M': M.astype(np.float32).ravel(),
+        })
+        table.to_parquet(path, index=False)
+    else:
+        raise ValueError(f'Unknown format {format}, expected "npz" or "parquet"')
+
+    return path
+
+
+def weight_sweep(
+    configs,
+    normalizeAll = True,
+    ignore_subtypes = True,
+    filename = None,
+    format = 'npz',
+    verbose = False,
+):
+    """Calculation of GARDN-M coefficients for many weightings in one pass
+
+    Args:
+        configs: list of configuration dictionaries, see stack_configs
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        filename: if given, prefix for filename to use when saving this sweep
+        format: file format used when saving, see save_sweep
+        verbose: some extra print statements that may be useful when debugging
+
+    Returns:
+        locations: DataFrame of State and City, indexed by location ID
+        M: (locations x configs) array of final M values
+    """
+    source_ratings, source_types, source_subtypes, data = load_sources(verbose)
+    process_sources(data, normalizeAll, source_ratings, source_subtypes, ignore_subtypes)
+
+    states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+    sources = [s for st_list in source_types.values() for s in st_list if s in data]
+    W = np.array([data[s]['W'].iloc[0] for s in sources], dtype=float)
+    P, S_city, S_state, W = stack_configs(configs, sources, source_ratings, W=W)
+    locations, M = sweep_arrays(data, source_types, states, P, S_city, S_state, source_subtypes=None if ignore_subtypes else source_subtypes, W=W)
+
+    if filename is not None:
+        path = save_sweep(locations, M, filename, format)
+        if verbose:
+            print(f'Sweep of {len(configs)} configurations has been saved to {path}!')
+
+    return locations, M
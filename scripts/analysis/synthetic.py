@@ -0,0 +1,144 @@
+"""
+Synthetic data for benchmarking the GARDN-M model at scale.
+
+generate() writes a self-contained data tree (processed_data, sources, utils
+and outputs) with as many sources and cities as asked for, in every shape
+that assign_CompScore accepts:
+
+    state-level: State (full names) + Score, Rank or Processed
+    city-level:  City, State (abbreviations) + Score, Rank or Processed,
+                 with some state rows (empty City) mixed in like nationalEquityAtlas
+
+Cities are spread over the states, and larger (lower numbered) cities show
+up in more city-level sources, as in the real data. The source_ratings,
+source_types and source_subtypes files are generated to match, and so is a
+crosswalk of made-up populations, counties and metros for rollups.py.
+
+Usage:
+    python synthetic.py ROOT [--sources 200] [--cities 20000] [--seed 0]
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from paths import enter_root
+
+SOURCE_TYPES = ['social', 'race', 'gender', 'sexual_orientation', 'disabilities']
+KINDS = ['Score', 'Rank', 'Processed']
+
+
+def load_states():
+    """Full name and abbreviation of the 50 states and DC
+
+    Returns:
+        names: array of state names
+        abbrs: array of matching abbreviations, DC last
+    """
+    with open('./data/utils/statename_to_abbr.json', 'r') as f:
+        statename_to_abbr = json.load(f)
+
+    names = {}
+    for name, abbr in statename_to_abbr.items():
+        if len(abbr) == 2 and abbr not in ('AS', 'GU', 'PR', 'VI') and abbr not in names.values():
+            names[name] = abbr
+    names = sorted(names.items(), key=lambda item: item[1] == 'DC')
+
+    return np.array([n for n, a in names], dtype=object), np.array([a for n, a in names], dtype=object)
+
+
+def generate(root, n_sources = 200, n_cities = 20000, city_fraction = 0.3, seed = 0):
+    """Write a synthetic data tree for the GARDN-M model
+
+    Args:
+        root: directory to write data/ into
+        n_sources: number of sources
+        n_cities: number of distinct cities across all city-level sources
+        city_fraction: fraction of the sources that are city-level
+        seed: random seed, the same arguments always give the same files
+
+    Returns:
+        config: dictionary of the arguments, also saved as data/synthetic.json
+    """
+    rng = np.random.default_rng(seed)
+    names, abbrs = load_states()
+    statename_to_abbr = dict(zip(names, abbrs))
+
+    # cities: assigned to states roughly by size, city i is the i-th largest
+    city_state = abbrs[rng.choice(len(abbrs), n_cities, p=np.linspace(2, 1, len(abbrs)) / np.linspace(2, 1, len(abbrs)).sum())]
+    city_name = np.array([f'City {i:05d}' for i in range(n_cities)], dtype=object)
+    city_weight = 1 / np.arange(1, n_cities+1) ** 0.8
+    city_weight /= city_weight.sum()
+
+    for directory in ['processed_data', 'sources', 'utils', 'outputs']:
+        os.makedirs(os.path.join(root, 'data', directory), exist_ok=True)
+
+    source_ratings = {}
+    source_types = {st: [] for st in SOURCE_TYPES}
+    source_subtypes = {}
+    for i in range(n_sources):
+        source = f'synthetic_{i:04d}'
+        kind = KINDS[i % len(KINDS)]
+        if rng.random() < city_fraction:
+            size = int(min(n_cities, rng.integers(50, max(51, n_cities // 2))))
+            cities = np.sort(rng.choice(n_cities, size, replace=False, p=city_weight))
+            sdata = pd.DataFrame({'City': city_name[cities], 'State': city_state[cities]})
+            with_states = rng.random() < 0.3
+            if with_states:
+                sdata = pd.concat([pd.DataFrame({'City': '', 'State': abbrs}), sdata], ignore_index=True)
+        else:
+            keep = abbrs != 'DC' if kind == 'Rank' else np.ones(len(abbrs), dtype=bool) # state ranks are out of 50
+            sdata = pd.DataFrame({'State': names[keep]})
+
+        values = rng.normal(5, 2, len(sdata)).clip(0, 10)
+        if kind == 'Score':
+            sdata['Score'] = (values * 10).round(2)
+        elif kind == 'Rank':
+            sdata['Rank'] = np.argsort(np.argsort(-values)) + 1
+        else:
+            sdata['Processed'] = values.round(2)
+        sdata = sdata.sample(frac=1, random_state=rng.integers(2**31)).reset_index(drop=True)
+        sdata.to_csv(os.path.join(root, 'data', 'processed_data', f'{source}.csv'), index=False)
+
+        source_ratings[source] = [int(rng.integers(1, 6)), 1, 2]
+        source_type = SOURCE_TYPES[i % len(SOURCE_TYPES)]
+        source_types[source_type].append(source)
+        source_subtypes[source] = f'{source_type}{i // (3 * len(SOURCE_TYPES))}' # groups of three repeated sources of a source_type
+
+    # crosswalk of the rollups: a made-up population falling with the city number, counties of about 5 and metros of about 25 cities of a state
+    number = pd.Series(city_state).groupby(city_state).cumcount().values
+    crosswalk = pd.DataFrame({
+        'State': city_state,
+        'City': city_name,
+        'population': np.maximum(1000, 5e6 * city_weight / city_weight[0]).round().astype(int),
+        'county': [f'{s} County {n // 5:04d}' for s, n in zip(city_state, number)],
+        'metro': [f'{s} Metro {n // 25:03d}' if n < 500 else '' for s, n in zip(city_state, number)], # small cities of large states are rural
+    })
+    crosswalk.to_csv(os.path.join(root, 'data', 'utils', 'crosswalk.csv'), index=False)
+
+    for name, obj in [('sources/source_ratings', source_ratings), ('sources/source_types', source_types), ('sources/source_subtypes', source_subtypes), ('utils/statename_to_abbr', statename_to_abbr)]:
+        with open(os.path.join(root, 'data', f'{name}.json'), 'w') as f:
+            json.dump(obj, f, indent=6)
+
+    config = {'n_sources': n_sources, 'n_cities': n_cities, 'city_fraction': city_fraction, 'seed': seed}
+    with open(os.path.join(root, 'data', 'synthetic.json'), 'w') as f:
+        json.dump(config, f, indent=6)
+
+    return config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic GARDN-M data tree')
+    parser.add_argument('root', help='directory to write data/ into')
+    parser.add_argument('--sources', type=int, default=200)
+    parser.add_argument('--cities', type=int, default=20000)
+    parser.add_argument('--city-fraction', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    enter_root() # for statename_to_abbr.json
+    generate(root, args.sources, args.cities, args.city_fraction, args.seed)
@@ -0,0 +1,216 @@
+"""
+Lightweight tracing of the GARDN-M pipeline.
+
+Code is instrumented with spans:
+
+    with tracing.span('process', source=source, rows=len(sdata)) as sp:
+        ...
+        sp.set(rows=len(result))
+
+Every span records its wall time, CPU time (of the running thread), the
+attributes given to it and, when memory tracing is on, the peak memory
+allocated while it ran (tracemalloc, including nested spans). Spans are
+written as JSON lines, or as a Chrome trace (open in chrome://tracing or
+Perfetto) when the trace file ends in .json.
+
+Tracing is off unless enable() is called or the GARDNM_TRACE environment
+variable holds the trace file path (GARDNM_TRACE_MEMORY=1 adds memory). When
+off, span() returns a shared do-nothing object, so instrumented code only pays
+for one function call per span.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+class NullSpan:
+    """Stand-in for Span while tracing is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """One timed step, see span()"""
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """Add or update attributes, e.g. row counts that are only known at the end"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.parent = stack[-1] if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        if self.tracer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, peak)
+            tracemalloc.reset_peak()
+            self.base = self.peak = current
+        self.cpu = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.start
+        cpu = time.thread_time() - self.cpu
+        self.tracer.stack().pop()
+
+        record = {
+            'name': self.name,
+            'start': self.start - self.tracer.origin,
+            'wall': wall,
+            'cpu': cpu,
+            'depth': self.depth,
+            'parent': None if self.parent is None else self.parent.name,
+            'thread': threading.get_ident(),
+            **self.attrs,
+        }
+        if self.tracer.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = (self.peak - self.base) / 1e6
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+        if exc is not None:
+            record['error'] = repr(exc)
+        self.tracer.emit(record)
+
+        return False
+
+
+class Tracer:
+    """Collects spans and writes them to a trace file
+
+    Args:
+        path: trace file, .json for the Chrome trace format, anything else for JSON lines
+        memory: also record the peak memory of every span with tracemalloc
+    """
+
+    def __init__(self, path, memory = False):
+        self.path = os.path.abspath(path) # resolved now, the caller may change the working directory before the trace is written
+        self.chrome = path.endswith('.json')
+        self.memory = memory
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.events = []
+        self.file = None if self.chrome else open(self.path, 'a')
+        self.started_tracemalloc = memory and not tracemalloc.is_tracing() # a session of the caller is left to the caller
+        if self.started_tracemalloc:
+            tracemalloc.start()
+
+    def stack(self):
+        """Spans open in the current thread, innermost last"""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def emit(self, record):
+        with self.lock:
+            if self.chrome:
+                args = {k: v for k, v in record.items() if k not in ('name', 'start', 'wall', 'thread')}
+                self.events.append({'name': record['name'], 'ph': 'X', 'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6, 'pid': os.getpid(), 'tid': record['thread'], 'args': args})
+            else:
+                self.file.write(json.dumps(record, default=str) + '\n')
+
+    def flush(self):
+        """Write everything recorded so far to the trace file"""
+        with self.lock:
+            if self.chrome:
+                with open(self.path, 'w') as f:
+                    json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f, default=str)
+            else:
+                self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+
+_tracer = None
+
+
+def enable(path, memory = False):
+    """Start tracing to a file, replacing any tracing already on
+
+    Args:
+        path: trace file, .json for the Chrome trace format, anything else for JSON lines
+        memory: also record the peak memory of every span with tracemalloc (slower)
+    """
+    global _tracer
+    disable()
+    _tracer = Tracer(path, memory)
+
+
+def swap(tracer):
+    """Make a tracer the current one without closing the one it replaces
+
+    Args:
+        tracer: a Tracer, or None to turn tracing off
+
+    Returns:
+        previous: the tracer that was current, None if tracing was off, to swap back in later
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def disable():
+    """Stop tracing and write out the trace file"""
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+def flush():
+    """Write everything recorded so far, if tracing is on"""
+    if _tracer is not None:
+        _tracer.flush()
+
+
+def span(name, **attrs):
+    """Context manager timing one step of the pipeline
+
+    Args:
+        name: name of the step
+        attrs: attributes saved with the span, e.g. source, source_type or rows
+
+    Returns:
+        span: a Span, or NULL_SPAN when tracing is off
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, attrs)
+
+
+if os.environ.get('GARDNM_TRACE'):
+    enable(os.environ['GARDNM_TRACE'], memory=os.environ.get('GARDNM_TRACE_MEMORY', '') not in ('', '0'))
+    atexit.register(disable)
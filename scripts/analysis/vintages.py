@@ -0,0 +1,269 @@
+"""
+Multi-vintage (time-series) runs of the GARDN-M model.
+
+Dated vintages of a source are kept in an append-only store,
+
+    data/vintages/<source>/<year>.csv
+
+in the same format as data/processed_data/<source>.csv. A source without
+any vintage is taken from processed_data for every year. In a year where a
+source has no vintage of its own, its latest earlier vintage is carried
+forward for at most carry_forward years (None carries it forward for ever,
+0 never); before its first vintage, or past that limit, the source is
+missing that year, as a missing processed_data file would be.
+
+All the years that need computing are scored in one pass of the array
+engine: every (year, location) pair is a location of its own, so the
+locations x sources matrices of engine.py hold every year at once, and the
+states of each year only serve as the fallback of the cities of that year.
+The rankings of a year are cached under data/cache/vintages, keyed by the
+vintages it uses and the run options, so adding a vintage only computes the
+years it touches.
+
+The output is a long table with one row per year and location.
+"""
+
+import argparse
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import tracing
+from cache import file_hash, make_key, load_cached, store_cached
+from engine import combine_arrays, subrank_arrays
+from ingest import load_specs
+from main import load_config, output_name, process_source, subtype_sizes
+from names import load_name_index, resolve_source
+from paths import enter_root
+from writers import save_rankings
+
+VINTAGE_DIR = './data/vintages/'
+YEAR_SEPARATOR = '\x1e' # joins the year to the state of every row, so years never share a location
+
+
+def list_vintages(sources):
+    """Dated vintages of every source in the store
+
+    Args:
+        sources: list of sources
+
+    Returns:
+        vintages: dictionary of source -> dictionary of year -> path, only for sources with vintages
+    """
+    vintages = {}
+    for source in sources:
+        directory = os.path.join(VINTAGE_DIR, source)
+        if not os.path.isdir(directory):
+            continue
+        years = {int(f[:-4]): os.path.join(directory, f) for f in os.listdir(directory) if re.fullmatch(r'\d{4}\.csv', f)}
+        if years:
+            vintages[source] = dict(sorted(years.items()))
+
+    return vintages
+
+
+def add_vintage(source, year, path):
+    """Add a dated vintage of a source to the store
+
+    Args:
+        source: source name, as in source_ratings.json
+        year: year of the vintage
+        path: CSV in the format of data/processed_data
+
+    Returns:
+        path: where the vintage was stored
+
+    Raises:
+        FileExistsError: if the store already has this vintage, vintages are never replaced
+    """
+    directory = os.path.join(VINTAGE_DIR, source)
+    target = os.path.join(directory, f'{int(year):04d}.csv')
+    if os.path.exists(target):
+        raise FileExistsError(f'{target} already exists, vintages are append-only')
+    os.makedirs(directory, exist_ok=True)
+    shutil.copyfile(path, target)
+
+    return target
+
+
+def vintage_plan(vintages, sources, years, carry_forward = None):
+    """File that every source is read from in every year
+
+    Args:
+        vintages: output of list_vintages
+        sources: list of sources
+        years: list of years
+        carry_forward: number of years a vintage stays in use after its own year, None for no limit
+
+    Returns:
+        plan: dictionary of year -> dictionary of source -> path, leaving out the sources missing that year
+    """
+    plan = {}
+    for year in years:
+        plan[year] = {}
+        for source in sources:
+            if source not in vintages:
+                path = f'./data/processed_data/{source}.csv'
+                if os.path.exists(path):
+                    plan[year][source] = path
+                continue
+            earlier = [y for y in vintages[source] if y <= year]
+            if earlier and (carry_forward is None or year - earlier[-1] <= carry_forward):
+                plan[year][source] = vintages[source][earlier[-1]]
+
+    return plan
+
+
+def read_vintage(path, source, statename_to_abbr, names):
+    """Read one vintage of a source, with states abbreviated and place names resolved"""
+    sdata = pd.read_csv(path)
+    sdata['State'] = sdata['State'].replace(statename_to_abbr)
+    return resolve_source(sdata, source, names)
+
+
+def score_years(plan, years, source_ratings, source_types, source_subtypes, statename_to_abbr, names, normalizeAll, ignore_subtypes):
+    """Rankings of several years in one pass
+
+    Every vintage is read and processed once, however many years it is
+    carried forward to.
+
+    Args:
+        plan: output of vintage_plan
+        years: years to compute
+        source_ratings: dictionary of source -> ratings
+        source_types: dictionary of source_type -> list of sources
+        source_subtypes: dictionary of source -> subtype
+        statename_to_abbr: dictionary of state name -> abbreviation
+        names: place-name index from names.load_name_index
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+
+    Returns:
+        rankings: dictionary of year -> rankings DataFrame, as gardnm() computes them from that year's vintages
+    """
+    n_subtypes = None if ignore_subtypes else subtype_sizes(source_subtypes)
+    processed = {}
+    with tracing.span('2_process'):
+        for year in years:
+            for source, path in plan[year].items():
+                if (source, path) not in processed:
+                    sdata = read_vintage(path, source, statename_to_abbr, names)
+                    processed[(source, path)] = process_source(sdata, source, normalizeAll, source_ratings, source_subtypes, ignore_subtypes, n_subtypes)
+
+    # one frame per source with the rows of every year, the year prefixed to the state
+    data = {}
+    for source in source_ratings:
+        frames = []
+        for year in years:
+            if source in plan[year]:
+                sdata = processed[(source, plan[year][source])].copy()
+                sdata['State'] = f'{year}{YEAR_SEPARATOR}' + sdata['State'].astype(str)
+                frames.append(sdata)
+        if frames:
+            data[source] = pd.concat(frames, ignore_index=True)
+    if not data:
+        return {}
+
+    with tracing.span('3_subrank', years=len(years)):
+        states = np.unique(np.concatenate([sdata.State.values for sdata in data.values()]))
+        subrankings = subrank_arrays(data, source_types, states, source_subtypes=None if ignore_subtypes else source_subtypes)
+    with tracing.span('4_combine', years=len(years)):
+        combined = combine_arrays(subrankings, states, source_types)
+
+    parts = combined['State'].str.split(YEAR_SEPARATOR, n=1, expand=True)
+    combined['State'] = parts[1].values
+    rankings = {}
+    for year in years:
+        rankings[year] = combined[parts[0].values == str(year)].reset_index(drop=True)
+
+    return rankings
+
+
+def gardnm_vintages(
+    years = None,
+    carry_forward = None,
+    normalizeAll = True,
+    ignore_subtypes = True,
+    filename = 'gardnm',
+    output_format = 'csv',
+    cache = True,
+    verbose = False,
+):
+    """Calculation of GARDN-M coefficients for every year of the vintage store
+
+    Args:
+        years: years to rank, defaults to every year from the first to the last vintage in the store
+        carry_forward: number of years a vintage stays in use after its own year, None for no limit
+        normalizeAll: normalize raw data from every source to span the full 0-10 scale
+        ignore_subtypes: option to ignore the various subtypes in source_subtypes
+        filename: prefix for filename to use when saving this run, None to not save
+        output_format: 'csv', 'parquet', 'arrow' or 'sqlite', see writers.py
+        cache: reuse the rankings of the years whose vintages and options did not change
+        verbose: some extra print statements that may be useful when debugging
+
+    Returns:
+        rankings: long DataFrame with year, State, City, M, n and the M and n of every source_type
+    """
+    statename_to_abbr, source_ratings, source_types, source_subtypes = load_config()
+    names = load_name_index(statename_to_abbr, list(source_ratings))
+    vintages = list_vintages(source_ratings)
+    if years is None:
+        found = [year for source_years in vintages.values() for year in source_years]
+        if not found:
+            raise ValueError(f'No vintages found in {VINTAGE_DIR}, add some with add_vintage')
+        years = list(range(min(found), max(found) + 1))
+    plan = vintage_plan(vintages, list(source_ratings), years, carry_forward)
+
+    keys = {}
+    rankings = {}
+    for year in years:
+        keys[year] = make_key('vintages', [(source, file_hash(path)) for source, path in plan[year].items()],
+            source_ratings, source_types, source_subtypes, load_specs(), names['key'], normalizeAll, ignore_subtypes)
+        if cache:
+            rankings[year] = load_cached('vintages', str(year), keys[year])
+    todo = [year for year in years if rankings.get(year) is None]
+    if verbose:
+        print(f'Vintages: {len(years) - len(todo)} years reused, computing {todo}')
+
+    if todo:
+        computed = score_years(plan, todo, source_ratings, source_types, source_subtypes, statename_to_abbr, names, normalizeAll, ignore_subtypes)
+        for year in todo:
+            rankings[year] = computed.get(year)
+            if cache and rankings[year] is not None:
+                store_cached('vintages', str(year), keys[year], rankings[year])
+
+    frames = [frame.assign(year=year) for year, frame in rankings.items() if frame is not None]
+    series = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['year', 'State', 'City'])
+    series = series[['year'] + [c for c in series.columns if c != 'year']]
+
+    if filename is not None:
+        path = save_rankings(series, output_name(f'{filename}_vintages', normalizeAll), output_format)
+        if verbose:
+            print(f'Data has been saved to {path}!')
+    tracing.flush()
+
+    return series
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Store dated vintages of the sources and rank every year')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='add a vintage to the store')
+    add.add_argument('source')
+    add.add_argument('year', type=int)
+    add.add_argument('path', help='CSV in the format of data/processed_data, relative to the repository root')
+    run = commands.add_parser('run', help='rank every year')
+    run.add_argument('--years', type=int, nargs='*', default=None)
+    run.add_argument('--carry-forward', type=int, default=None, help='years a vintage stays in use, no limit by default')
+    run.add_argument('--format', default='csv', help='csv, parquet, arrow or sqlite')
+    run.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+    enter_root()
+
+    if args.command == 'add':
+        print(f'Vintage has been saved to {add_vintage(args.source, args.year, args.path)}')
+    else:
+        gardnm_vintages(args.years, args.carry_forward, output_format=args.format, cache=not args.no_cache, verbose=True)
@@ -0,0 +1,210 @@
+"""
+Output writers for the rankings.
+
+Every writer takes the rankings as an iterable of DataFrame chunks (all with
+the same columns, indexed by location ID) and writes them one at a time, so
+outputs computed chunk by chunk, as in outofcore.py, never have to be held
+in memory as a whole.
+
+    csv      the original format, the location ID as the unnamed first column
+    parquet  State and City dictionary-encoded, one row group per chunk (needs pyarrow)
+    arrow    Arrow IPC file, which pyarrow can memory-map and read without copying (needs pyarrow)
+    sqlite   a rankings table keyed by location, with indexes on (State, City) and City for point queries
+
+The formats other than csv store the location ID as a 'location' column.
+NumPy, pandas, pyarrow and sqlite3 are only imported by the functions that need
+them, so finding an output costs nothing.
+"""
+
+import os
+
+
+def chunked(rankings, chunk_size = 100_000):
+    """Split a DataFrame into chunks of rows
+
+    Args:
+        rankings: DataFrame
+        chunk_size: rows per chunk
+
+    Returns:
+        chunks: generator of DataFrames
+    """
+    for start in range(0, max(len(rankings), 1), chunk_size):
+        yield rankings.iloc[start:start+chunk_size]
+
+
+def write_csv(chunks, path):
+    """Write the chunks as one CSV, the header with the first chunk"""
+    mode = 'w'
+    for chunk in chunks:
+        chunk.to_csv(path, mode=mode, header=mode == 'w')
+        mode = 'a'
+
+
+def arrow_table(chunk, dictionary = True):
+    """Convert a chunk of rankings to an Arrow table with the location ID as a column
+
+    Args:
+        chunk: DataFrame indexed by location ID
+        dictionary: dictionary-encode State and City
+
+    Returns:
+        table: pyarrow Table
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    columns = {'location': pa.array(np.asarray(chunk.index, dtype=np.int64))}
+    for column in chunk.columns:
+        if column in ('State', 'City'):
+            values = pa.array(chunk[column].values.astype(str))
+            columns[column] = values.dictionary_encode() if dictionary else values
+        else:
+            columns[column] = pa.array(chunk[column].values)
+
+    return pa.table(columns)
+
+
+def write_parquet(chunks, path):
+    """Write the chunks as one Parquet file, one row group per chunk (needs pyarrow)"""
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for chunk in chunks:
+            table = arrow_table(chunk)
+            if writer is None:
+                schema = table.schema
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_arrow(chunks, path):
+    """Write the chunks as one Arrow IPC file, one record batch per chunk (needs pyarrow)
+
+    The IPC file format cannot change dictionaries between batches, so State
+    and City are plain strings here.
+    """
+    import pyarrow as pa
+
+    writer = None
+    try:
+        for chunk in chunks:
+            table = arrow_table(chunk, dictionary=False)
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(path, schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_sqlite(chunks, path, table = 'rankings'):
+    """Write the chunks to a fresh SQLite database, indexing State and City, when the rows have them, once all rows are in"""
+    import sqlite3
+
+    if os.path.exists(path):
+        os.remove(path)
+    columns = []
+    with sqlite3.connect(path) as connection:
+        for chunk in chunks:
+            chunk.to_sql(table, connection, if_exists='append', index=True, index_label='location')
+            columns = chunk.columns
+        if 'State' in columns and 'City' in columns:
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_state_city ON {table} (State, City)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_city ON {table} (City)')
+    connection.close()
+
+
+WRITERS = {
+    'csv': ('.csv', write_csv),
+    'parquet': ('.parquet', write_parquet),
+    'arrow': ('.arrow', write_arrow),
+    'sqlite': ('.sqlite', write_sqlite),
+}
+
+
+def output_path(name, format = 'csv'):
+    """Path in data/outputs of an output name, with the extension of the format
+
+    Raises:
+        ValueError: if the format is not one of WRITERS
+    """
+    if format not in WRITERS:
+        raise ValueError(f'Unknown output format {format}, expected one of {list(WRITERS)}')
+    return f'data/outputs/{name}{WRITERS[format][0]}'
+
+
+def output_name(filename, normalizeAll):
+    """Name of the rankings file of a run, without the extension
+
+    Args:
+        filename: prefix for filename to use when saving this run
+        normalizeAll: whether the run normalized the raw data
+
+    Returns:
+        filename: full name used in data/outputs
+    """
+    filename += '_algorithm_rework' # based on git commit for the moment
+
+    if normalizeAll:
+        filename += '_normalized'
+
+    return filename
+
+
+def save_rankings(rankings, name, format = 'csv', chunk_size = 100_000):
+    """Save rankings to data/outputs in one of the WRITERS formats
+
+    Args:
+        rankings: DataFrame indexed by location ID, or an iterable of such chunks
+        name: output name without extension, see output_name
+        format: 'csv', 'parquet', 'arrow' or 'sqlite'
+        chunk_size: rows written at once when rankings is a DataFrame
+
+    Returns:
+        path: where the rankings were saved
+    """
+    path = output_path(name, format)
+    chunks = chunked(rankings, chunk_size) if hasattr(rankings, 'iloc') else rankings
+    WRITERS[format][1](chunks, path)
+
+    return path
+
+
+def read_rankings(name, format = 'csv'):
+    """Read back rankings saved by save_rankings
+
+    Args:
+        name: output name without extension, see output_name
+        format: 'csv', 'parquet', 'arrow' or 'sqlite'
+
+    Returns:
+        rankings: DataFrame indexed by location ID, with '' for the City of state rows
+    """
+    import sqlite3
+    import pandas as pd
+
+    path = output_path(name, format)
+    if format == 'csv':
+        rankings = pd.read_csv(path, index_col=0)
+    elif format == 'sqlite':
+        with sqlite3.connect(path) as connection:
+            rankings = pd.read_sql_query('SELECT * FROM rankings', connection, index_col='location')
+        connection.close()
+    elif format == 'parquet':
+        rankings = pd.read_parquet(path).set_index('location')
+    else:
+        import pyarrow as pa
+
+        with pa.memory_map(path) as source:
+            rankings = pa.ipc.open_file(source).read_all().to_pandas().set_index('location')
+    rankings.index.name = None
+    for column in ('State', 'City'):
+        rankings[column] = rankings[column].astype(object).fillna('')
+
+    return rankings
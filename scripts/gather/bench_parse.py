@@ -0,0 +1,144 @@
+"""
+
+Benchmark of the table extraction used by the scrapers
+
+Compares parsing a full html.parser tree (the old approach) with the targeted
+parse_rows() extraction, using html.parser and lxml, and reports the parse
+time and peak memory per page.
+
+Usage:
+    python bench_parse.py                 # the saved HTML fixtures in fixtures/
+    python bench_parse.py page.html ...   # other saved pages
+    python bench_parse.py --synthetic     # large synthetic wallethub/move.org sized pages
+    python bench_parse.py --cached        # every page in the response cache
+
+"""
+
+import argparse
+import glob
+import os
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+import response_cache
+import utils
+from scrape_moveLgbtq import MOVE_ROWS
+from scrape_wallethub import WALLETHUB_TABLE
+
+
+# Small saved pages shaped like the scraped articles, so the benchmark runs offline
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def synthetic_page(kind, n_rows=200, padding=5000):
+    '''
+    Returns a large page with one ranking table buried in unrelated markup.
+
+    Parameters:
+    kind (str): 'wallethub' or 'move'.
+    n_rows (int): Number of table rows.
+    padding (int): Number of unrelated elements around the table.
+
+    Returns:
+    bytes: The HTML content of the page.
+    '''
+
+    filler = ''.join(f'<div class="card"><a href="/article/{i}">Article {i}</a><p>Some text {i}</p></div>' for i in range(padding))
+    if kind == 'wallethub':
+        rows = ''.join(f'<tr><td>{i}</td><td>State {i}</td><td>{100-i/3:.2f}</td></tr>' for i in range(1, n_rows+1))
+        table = f'<table class="cardhub-edu-table"><thead><tr><th>Rank</th><th>State</th><th>Score</th></tr></thead><tbody>{rows}</tbody></table>'
+    else:
+        rows = ''.join(f'<tr class="dynamic-table__row"><td>State {i}</td><td>{i}</td></tr>' for i in range(1, n_rows+1))
+        table = f'<table><tr class="dynamic-table__row"><td>Rank</td><td>State</td></tr>{rows}</table>'
+
+    return f'<html><head><title>{kind}</title></head><body>{filler}{table}{filler}</body></html>'.encode()
+
+
+def load_fixtures(paths=None, synthetic=False, cached=False):
+    '''
+    Returns the (name, content) pairs to benchmark, see the usage above.
+
+    Parameters:
+    paths (list): Saved HTML pages, defaults to every page in FIXTURE_DIRECTORY.
+    synthetic (bool): Benchmark large synthetic pages instead.
+    cached (bool): Benchmark every page in the response cache instead.
+
+    Returns:
+    list: (name, content) pairs.
+    '''
+
+    if synthetic:
+        return [('synthetic wallethub', synthetic_page('wallethub')), ('synthetic move', synthetic_page('move'))]
+    if cached:
+        return [(url, response_cache.read_body(entry['digest'])) for url, entry in response_cache.load_index().items()]
+
+    fixtures = []
+    for path in paths or sorted(glob.glob(os.path.join(FIXTURE_DIRECTORY, '*.html'))):
+        with open(path, 'rb') as f:
+            fixtures.append((path, f.read()))
+    return fixtures
+
+
+def measure(function, content, repeats=5):
+    '''
+    Returns the best time in seconds and the peak memory in bytes of function(content).
+    '''
+
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(content)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def main(fixtures, repeats=5):
+    '''
+    Runs the benchmark and prints one line per fixture and method.
+
+    Parameters:
+    fixtures (list): (name, content) pairs from load_fixtures.
+    repeats (int): Number of timed runs per method, the best is reported.
+    '''
+
+    for name, content in fixtures:
+        if b'cardhub-edu-table' in content:
+            strainer, row_filter, within = WALLETHUB_TABLE, None, 'tbody'
+            full = lambda c: BeautifulSoup(c, 'html.parser').find('table', class_='cardhub-edu-table').tbody.find_all('tr')
+        elif b'dynamic-table__row' in content:
+            strainer, row_filter, within = MOVE_ROWS, None, None
+            full = lambda c: BeautifulSoup(c, 'html.parser').find_all('tr', class_='dynamic-table__row')
+        else:
+            print(f'{name}: no known table, skipping')
+            continue
+
+        methods = {'full html.parser': full}
+        for parser in ['html.parser', 'lxml']:
+            if parser == 'lxml' and utils.TABLE_PARSER != 'lxml':
+                continue
+            methods[f'targeted {parser}'] = lambda c, parser=parser: utils.parse_rows(c, strainer, row_filter, within, parser)
+
+        print(f'{name} ({len(content)/1e6:.2f} MB)')
+        for method, function in methods.items():
+            seconds, peak = measure(function, content, repeats)
+            print(f'    {method:<22} {seconds*1000:8.1f} ms {peak/1e6:8.1f} MB peak')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the table extraction of the scrapers')
+    parser.add_argument('pages', nargs='*', help='saved HTML pages, defaults to the fixtures in fixtures/')
+    parser.add_argument('--synthetic', action='store_true', help='large synthetic pages instead of saved ones')
+    parser.add_argument('--cached', action='store_true', help='every page in the response cache instead of saved ones')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    main(load_fixtures(args.pages, args.synthetic, args.cached), args.repeats)
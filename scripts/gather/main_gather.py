@@ -3,22 +3,91 @@
 
 """
 This script manages all gathering of data.
+
+Every source in data/sources/sources.json that has a registered scraper (see
+registry.py) is scraped in parallel. A broken or slow site only fails its own
+source, and a run manifest with the status, timing and row count of every
+source is written next to the scraped data.
 """
 
-from scrape_moveLgbtq import scrape_movelgbtq
-from scrape_usnews import scrape_usnews
-from scrape_wallethub import scrape_wallethub_all
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+import json
+import os
+import time
+import traceback
+
+from registry import SCRAPERS, load_sources, run_scraper
+from utils import get_processed_data_directory
 
+# importing the scraper modules registers their sources
+import scrape_moveLgbtq
+import scrape_usnews
+import scrape_wallethub
 
-def main():
+
+def main(sources=None, timeout=300, max_workers=None):
     """
     Scrapes data from all sources and saves the results to CSV files in the scraped_data directory.
+
+    Parameters:
+    sources (list): Only scrape these sources, defaults to every source in sources.json.
+    timeout (float): Seconds a source may take before it is reported as timed out.
+    max_workers (int): Number of sources scraped at the same time, defaults to all of them.
+
+    Returns:
+    dict: The run manifest.
     """
-    scrape_movelgbtq()
-    scrape_usnews()
-    scrape_wallethub_all()
+    urls = load_sources()
+    if sources is not None:
+        urls = {source: url for source, url in urls.items() if source in sources}
+
+    manifest = {'started': datetime.now().isoformat(timespec='seconds'), 'sources': {}}
+    for source in urls:
+        if source not in SCRAPERS:
+            manifest['sources'][source] = {'status': 'no scraper'}
+    jobs = {source: url for source, url in urls.items() if source in SCRAPERS}
+    os.makedirs(get_processed_data_directory(), exist_ok=True)
+
+    started = {}
+    def job(source, url):
+        started[source] = time.monotonic()
+        return run_scraper(source, url)
+
+    start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=max_workers or max(len(jobs), 1))
+    futures = {executor.submit(job, source, url): source for source, url in jobs.items()}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            source = futures[future]
+            seconds = round(time.monotonic() - started[source], 3)
+            try:
+                rows = future.result()
+                manifest['sources'][source] = {'status': 'ok', 'seconds': seconds, 'rows': rows}
+            except Exception as error:
+                manifest['sources'][source] = {'status': 'error', 'seconds': seconds, 'error': repr(error), 'traceback': traceback.format_exc()}
+            print(f'{source}: {manifest["sources"][source]["status"]} ({seconds} s)')
+
+        # give up on sources that ran past their timeout, their threads are left to finish on their own
+        now = time.monotonic()
+        for future in [f for f in pending if futures[f] in started and now - started[futures[f]] > timeout]:
+            source = futures[future]
+            manifest['sources'][source] = {'status': 'timeout', 'seconds': round(now - started[source], 3)}
+            print(f'{source}: timeout ({timeout} s)')
+            pending.discard(future)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    manifest['seconds'] = round(time.monotonic() - start, 3)
+    manifest['sources'] = dict(sorted(manifest['sources'].items()))
+
+    save_path = os.path.join(get_processed_data_directory(), 'manifest.json')
+    with open(save_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,65 @@
+"""
+
+Registry of the scrapers for the sources in data/sources/sources.json
+
+Every scraper module registers a parser plugin for each source it handles.
+A plugin is called with the URL of its source from sources.json (plus any
+keyword arguments given at registration) and returns the number of rows it
+wrote to data/scraped_data.
+
+"""
+
+import json
+import os
+
+
+SCRAPERS = {}
+OUTPUTS = {}
+
+
+def register(source, function, output=None, **kwargs):
+    '''
+    Registers the scraper of a source.
+
+    Parameters:
+    source (str): The source name, as in sources.json.
+    function (callable): Called as function(url, **kwargs), returns the number of rows written.
+    output (str): The CSV file name the scraper writes, defaults to the csv_file_name keyword argument.
+    kwargs: Extra keyword arguments for this source, e.g. the CSV file name.
+    '''
+
+    SCRAPERS[source] = (function, kwargs)
+    OUTPUTS[source] = output or kwargs.get('csv_file_name')
+
+
+def scraped_file(source):
+    '''
+    Returns the name of the CSV file in data/scraped_data written by the scraper of a source, None if it is not known.
+    '''
+
+    return OUTPUTS.get(source)
+
+
+def run_scraper(source, url):
+    '''
+    Runs the registered scraper of a source.
+
+    Parameters:
+    source (str): The source name.
+    url (str): The URL of the source.
+
+    Returns:
+    int: The number of rows written.
+    '''
+
+    function, kwargs = SCRAPERS[source]
+    return function(url, **kwargs)
+
+
+def load_sources():
+    '''
+    Returns the dictionary of source name -> URL from sources.json.
+    '''
+
+    with open(os.path.abspath(f"{__file__}/../../../data/sources/sources.json"), 'r') as f:
+        return json.load(f)
@@ -0,0 +1,131 @@
+"""
+
+On-disk store of HTTP responses for the gathering scripts
+
+Bodies are saved gzip-compressed under data/cache/http/objects/, named by the
+SHA-256 of their content, so identical pages are only stored once. An index
+maps every URL to its latest body and to the ETag/Last-Modified validators
+needed for conditional requests.
+
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+_lock = threading.Lock()
+_index = None
+
+
+def get_cache_directory():
+    '''
+    Returns the path to the HTTP response cache directory.
+    '''
+
+    return os.path.abspath(f"{__file__}/../../../data/cache/http")
+
+
+def load_index():
+    '''
+    Returns the index of cached responses, reading it from disk on first use.
+
+    Returns:
+    dict: A dictionary mapping each URL to its digest, validators and fetch time.
+    '''
+    global _index
+
+    with _lock:
+        if _index is None:
+            try:
+                with open(os.path.join(get_cache_directory(), 'index.json'), 'r') as f:
+                    _index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                _index = {}
+        return _index
+
+
+def lookup(url):
+    '''
+    Returns the cache entry of a URL, or None if it was never stored.
+    '''
+
+    return load_index().get(url)
+
+
+def read_body(digest):
+    '''
+    Returns the stored body with the given digest.
+
+    Parameters:
+    digest (str): The SHA-256 hex digest of the body.
+
+    Returns:
+    bytes: The uncompressed body.
+    '''
+
+    with gzip.open(os.path.join(get_cache_directory(), 'objects', digest[:2], f'{digest}.gz'), 'rb') as f:
+        return f.read()
+
+
+def store(url, response):
+    '''
+    Stores the body and validators of a response.
+
+    Parameters:
+    url (str): The URL that was requested.
+    response (requests.Response): A successful response.
+
+    Returns:
+    dict: The new cache entry of the URL.
+    '''
+
+    body = response.content
+    digest = hashlib.sha256(body).hexdigest()
+    path = os.path.join(get_cache_directory(), 'objects', digest[:2], f'{digest}.gz')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+
+    entry = {
+        'digest': digest,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'fetched': time.time(),
+    }
+    update(url, entry)
+
+    return entry
+
+
+def update(url, entry):
+    '''
+    Sets the cache entry of a URL and writes the index to disk.
+    '''
+
+    index = load_index()
+    with _lock:
+        index[url] = entry
+        directory = get_cache_directory()
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'index.json.tmp'), 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(os.path.join(directory, 'index.json.tmp'), os.path.join(directory, 'index.json'))
+
+
+def conditional_headers(entry):
+    '''
+    Returns the headers for a conditional request revalidating a cache entry.
+    '''
+
+    headers = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
@@ -1,20 +1,25 @@
-import numpy as np
-from utils import get_soup, write_array_to_csv
+from bs4 import SoupStrainer
+from registry import register
+from utils import get_content, parse_rows, write_columns_to_csv
 
 
-def scrape_movelgbtq():
+# Only the rows of the ranking table are parsed
+MOVE_ROWS = SoupStrainer('tr', class_='dynamic-table__row')
+
+
+def scrape_movelgbtq(base_url='https://www.move.org/best-worst-states-start-lgbtq-family/'):
     '''
     Retrieves the equality rank of all 50 US states and saves the results to a CSV file.
-    '''
 
-    # url for the move.org website
-    base_url = 'https://www.move.org/best-worst-states-start-lgbtq-family/'
+    Parameters:
+    base_url (str): The URL of the move.org article.
 
-    # Get the parsed HTML content of the webpage
-    soup = get_soup(base_url)
+    Returns:
+    int: The number of rows written.
+    '''
 
-    # Find all table rows on the page
-    rows = soup.find_all('tr', class_='dynamic-table__row')
+    # Get the HTML content of the webpage and extract the cell values of the table rows
+    rows = parse_rows(get_content(base_url), MOVE_ROWS)
 
     # Find the starting row
     starting_row = find_starting_row(rows)
@@ -22,21 +27,13 @@ def scrape_movelgbtq():
     # Extract rank and state values
     rank, state = extract_rank_and_state(rows, starting_row)
 
-    # Convert to numpy arrays
-    rank_np = np.array(rank)
-    state_np = np.array(state)
-
-    # Combine into one array
-    equality_rank = np.stack((state_np, rank_np), axis=1)
-
     # Write the results to a CSV file
-    write_array_to_csv(equality_rank, 'move_stateRankingsEquality.csv')
+    return write_columns_to_csv({'State': state, 'Rank': rank}, 'move_stateRankingsEquality.csv')
 
 
 # Find the starting row where the first column value is 'Rank'
 def find_starting_row(rows):
-    for index, row in enumerate(rows):
-        values = [td.text for td in row.find_all('td')]
+    for index, values in enumerate(rows):
         if len(values) > 0 and values[0] == 'Rank':
             return index
     return None
@@ -44,18 +41,19 @@ def find_starting_row(rows):
 
 # Extract rank and state values from the table rows
 def extract_rank_and_state(rows, starting_row):
-    rank = ['Rank']
-    state = ['State']
-
-    for i, row in enumerate(rows[starting_row+1:], start=1):
-        values = [td.text for td in row.find_all('td')]
+    rank = []
+    state = []
 
+    for i, values in enumerate(rows[starting_row+1:], start=1):
         rank.append(i)
         state.append(values[0])
 
     return rank, state
 
 
+register('move_lgbtqFamily', scrape_movelgbtq, output='move_stateRankingsEquality.csv')
+
+
 if __name__ == '__main__':
 
-    scrape_movelgbtq()
\ No newline at end of file
+    scrape_movelgbtq()
@@ -1,18 +1,18 @@
 
-import requests
 from bs4 import BeautifulSoup
+from utils import fetch
 
-#! This isn't working. All my requests to usnews.com are timing out. It works for other sites though...
+#! Requests to usnews.com used to hang here. fetch() now gives up after a timeout and retries with backoff,
+#! so a slow site shows up as an error instead of a stuck script.
 
 def main():
     """
     """
 
-    # Make a request to the website
+    # Make a request to the website (headers are set in utils.HEADERS)
     url = '##### FILL THIS IN #####'
-    headers = {'##### FILL THIS IN #####'}
-       
-    response = requests.get(url, headers=headers)
+
+    response = fetch(url)
 
     # Parse the HTML content using BeautifulSoup
     soup = BeautifulSoup(response.content, 'html.parser')
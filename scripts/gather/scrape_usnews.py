@@ -5,7 +5,8 @@ When this code breaks, we probably need to change the "soup.find('span', {'data-
 
 """
 
-from utils import get_soup, write_array_to_csv
+from registry import register
+from utils import get_soup, get_soups, write_array_to_csv
 
 
 list_of_states = [
@@ -22,15 +23,9 @@ list_of_states = [
 ]
 
 
-def get_state_data(state):
+def get_state_url(state):
     '''
-    Returns the equality rank of a state, given the state name as a string.
-
-    Parameters:
-    state (str): The name of the state to look up.
-
-    Returns:
-    int: The equality rank of the state, as an integer, -1 if the equality rank is not found.
+    Returns the US News Best States URL of a state, given the state name as a string.
     '''
 
     # if there is a space in the state name, replace it with a dash
@@ -40,8 +35,19 @@ def get_state_data(state):
     # Base URL for the US News Best States website
     base_url = 'https://www.usnews.com/news/best-states/'
 
-    # Get the parsed HTML content of the webpage
-    soup = get_soup(base_url + state.lower())
+    return base_url + state.lower()
+
+
+def parse_state_rank(soup):
+    '''
+    Returns the equality rank found in the parsed HTML content of a state page.
+
+    Parameters:
+    soup (BeautifulSoup object): The parsed HTML content of the state page.
+
+    Returns:
+    int: The equality rank of the state, as an integer, -1 if the equality rank is not found.
+    '''
 
     # Extract the equality rank from the webpage
     equality_rank_span = soup.find('span', {'data-test-id': 'equality-rank'})
@@ -55,10 +61,30 @@ def get_state_data(state):
     return equality_rank
 
 
+def get_state_data(state):
+    '''
+    Returns the equality rank of a state, given the state name as a string.
+
+    Parameters:
+    state (str): The name of the state to look up.
+
+    Returns:
+    int: The equality rank of the state, as an integer, -1 if the equality rank is not found.
+    '''
+
+    # Get the parsed HTML content of the webpage
+    soup = get_soup(get_state_url(state))
+
+    return parse_state_rank(soup)
+
+
 def scrape_usnews():
     '''
     Retrieves the equality rank of all 50 US states and returns the results as a NumPy array.
 
+    The state pages are fetched concurrently over one pooled connection,
+    within the rate limit of usnews.com.
+
     Returns:
     numpy.ndarray: A NumPy array containing the state name and its equality rank for all 50 US states.
     '''
@@ -67,21 +93,34 @@ def scrape_usnews():
 
     results.append(['State', 'Rank'])
 
-    # Loop through all 50 states and get their equality rank
-    for i, state in enumerate(list_of_states):
-        equality_rank = get_state_data(state)
-        results.append([state, equality_rank])
+    # Get all 50 state pages and read their equality rank
+    soups = get_soups([get_state_url(state) for state in list_of_states])
+    for state, soup in zip(list_of_states, soups):
+        results.append([state, parse_state_rank(soup)])
 
-        # Print the progress counter
-        print(f'\rReading states: {i+1}/{len(list_of_states)}', end='')
-
-    print()
+    print(f'Read states: {len(list_of_states)}/{len(list_of_states)}')
 
     write_array_to_csv(results, 'usNews_stateRankingsEquality.csv')
 
     return results
 
 
+def scrape_usnews_source(url):
+    '''
+    Registry entry point of scrape_usnews.
+
+    The state pages are derived from the state names, so the rankings URL from sources.json is not used.
+
+    Returns:
+    int: The number of rows written.
+    '''
+
+    return len(scrape_usnews()) - 1
+
+
+register('usNews_stateRankingsEquality', scrape_usnews_source, output='usNews_stateRankingsEquality.csv')
+
+
 if __name__ == '__main__':
 
     scrape_usnews()
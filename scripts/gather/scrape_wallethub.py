@@ -1,85 +1,74 @@
-import numpy as np
-from utils import get_soup, write_array_to_csv
+from bs4 import SoupStrainer
+from registry import register
+from utils import get_content, parse_rows, write_columns_to_csv
 
 
-def scrape_wallethub_state_data(base_url, csv_file_name):
+# Only the ranking table of a wallethub article is parsed
+WALLETHUB_TABLE = SoupStrainer('table', class_='cardhub-edu-table')
+
+
+def parse_wallethub_table(content):
     '''
-    Retrieves the equality rank of all 50 US states from the given URL and saves the results to a CSV file.
+    Extracts the rankings from the HTML content of a wallethub article.
 
     Parameters:
-    base_url (str): The URL of the webpage containing the state equality rankings.
-    csv_file_name (str): The name of the CSV file to save the results to.
+    content (bytes): The HTML content of the webpage.
+
+    Returns:
+    rank (list): The rankings, as integers.
+    name (list): The state or city name of each ranking.
     '''
 
-    # Get the parsed HTML content of the webpage
-    soup = get_soup(base_url)
+    rank = []
+    name = []
 
-    # Find the table
-    table = soup.find("table", class_="cardhub-edu-table")
+    # Iterate over the rows of the table body and extract the names and rankings
+    for columns in parse_rows(content, WALLETHUB_TABLE, within='tbody'):
+        name.append(columns[1])
+        rank.append(int(columns[0]))
 
-    # Initialize lists to store state names and rankings
-    rank = ['Rank']
-    state = ['State']
+    return rank, name
 
-    # Find all rows in the table body
-    rows = table.tbody.find_all("tr")
 
-    # Iterate over the rows and extract the state names and rankings
-    for row in rows:
-        columns = row.find_all("td")
-        state.append(columns[1].text)
-        rank.append(int(columns[0].text))
+def scrape_wallethub_state_data(base_url, csv_file_name):
+    '''
+    Retrieves the equality rank of all 50 US states from the given URL and saves the results to a CSV file.
 
-    # Convert to numpy arrays
-    rank_np = np.array(rank)
-    state_np = np.array(state)
+    Parameters:
+    base_url (str): The URL of the webpage containing the state equality rankings.
+    csv_file_name (str): The name of the CSV file to save the results to.
 
-    # Combine into one array
-    equality_rank = np.stack((state_np, rank_np), axis=1)
+    Returns:
+    int: The number of rows written.
+    '''
+
+    # Get the HTML content of the webpage and extract the table
+    rank, state = parse_wallethub_table(get_content(base_url))
 
     # Write the results to a CSV file
-    write_array_to_csv(equality_rank, csv_file_name)
+    return write_columns_to_csv({'State': state, 'Rank': rank}, csv_file_name)
 
 
 def scrape_wallethub_city_data(base_url, csv_file_name):
     '''
-    Retrieves the equality rank of all 50 US states from the given URL and saves the results to a CSV file.
+    Retrieves the equality rank of all the cities from the given URL and saves the results to a CSV file.
 
     Parameters:
-    base_url (str): The URL of the webpage containing the state equality rankings.
+    base_url (str): The URL of the webpage containing the city equality rankings.
     csv_file_name (str): The name of the CSV file to save the results to.
-    '''
-
-    # Get the parsed HTML content of the webpage
-    soup = get_soup(base_url)
 
-    # Find the table
-    table = soup.find("table", class_="cardhub-edu-table")
-
-    # Initialize lists to store state names and rankings
-    rank = ['Rank']
-    city = ['City']
-    # Find all rows in the table body
-    rows = table.tbody.find_all("tr")
-
-    # Iterate over the rows and extract the city names and rankings
-    for row in rows:
-        columns = row.find_all("td")
-        city.append(columns[1].text)
-        rank.append(int(columns[0].text))
+    Returns:
+    int: The number of rows written.
+    '''
 
-    # Convert to numpy arrays
-    rank_np = np.array(rank)
-    city_np = np.array(city)
+    # Get the HTML content of the webpage and extract the table
+    rank, city = parse_wallethub_table(get_content(base_url))
 
     # Replace commas with semicolons in the city column
-    city_np = np.char.replace(city_np, ',', ';')
-
-    # Combine into one array
-    equality_rank = np.stack((city_np, rank_np), axis=1)
+    city = [c.replace(',', ';') for c in city]
 
     # Write the results to a CSV file
-    write_array_to_csv(equality_rank, csv_file_name)
+    return write_columns_to_csv({'City': city, 'Rank': rank}, csv_file_name)
 
 
 def scrape_wallethub_all():
@@ -104,6 +93,12 @@ def scrape_wallethub_all():
         scrape_wallethub_city_data(city_url, csv_file_name)
 
 
+register('wallethub_statesRacialEquality', scrape_wallethub_state_data, csv_file_name='wallethub_stateRankingsRacialEquity.csv')
+register('wallethub_racialIntegration', scrape_wallethub_state_data, csv_file_name='wallethub_stateRankingsRacialIntegration.csv')
+register('wallethub_womenEquity', scrape_wallethub_state_data, csv_file_name='wallethub_stateRankingsWomensRights.csv')
+register('wallethub_citiesDisabilities', scrape_wallethub_city_data, csv_file_name='wallethub_cityRankingsDisabilities.csv')
+
+
 if __name__ == '__main__':
 
-    scrape_wallethub_all()
\ No newline at end of file
+    scrape_wallethub_all()
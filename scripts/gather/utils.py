@@ -5,11 +5,251 @@ Useful functions for the gathering scripts
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import threading
 import time
 import csv
 import os
 
+import response_cache
+
+
+# Set the headers to simulate a browser request
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36'
+}
+
+# Default politeness per host: on average one request every half second
+RATE_PER_HOST = 2.0
+BURST_PER_HOST = 1
+
+# (connect, read) timeouts in seconds, and how often to retry a failed request
+TIMEOUT = (10, 30)
+RETRIES = 3
+BACKOFF = 1.0
+
+# Responses worth retrying, everything else is returned as is
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Keep every page in the on-disk response cache (see response_cache.py), and
+# in offline mode only replay pages from it without touching the network
+USE_CACHE = True
+OFFLINE = os.environ.get('GARDNM_OFFLINE', '') not in ('', '0')
+
+# Parser used for targeted table extraction, lxml is much faster when installed
+try:
+    import lxml
+    TABLE_PARSER = 'lxml'
+except ImportError:
+    TABLE_PARSER = 'html.parser'
+
+
+class TokenBucket:
+    '''
+    Blocking token bucket that limits how often requests are sent to one host.
+
+    Parameters:
+    rate (float): Tokens added per second.
+    burst (int): Maximum number of tokens that can be saved up.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Waits until a token is available and takes it.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_session = None
+_lock = threading.Lock()
+_buckets = {}
+_bucket_settings = {}
+
+
+def get_session():
+    '''
+    Returns the shared keep-alive session used for every request.
+
+    Returns:
+    requests.Session: A session with pooled connections and the browser headers set.
+    '''
+    global _session
+
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers.update(HEADERS)
+            adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def set_rate_limit(host, rate, burst=1):
+    '''
+    Sets the request rate allowed for one host.
+
+    Parameters:
+    host (str): The host name, e.g. 'wallethub.com'. Use None to change the default for every host.
+    rate (float): Requests per second.
+    burst (int): Number of requests that may be sent back to back.
+    '''
+    global RATE_PER_HOST, BURST_PER_HOST
+
+    with _lock:
+        if host is None:
+            RATE_PER_HOST, BURST_PER_HOST = rate, burst
+            _buckets.clear()
+        else:
+            _bucket_settings[host] = (rate, burst)
+            _buckets.pop(host, None)
+
+
+def get_bucket(url):
+    '''
+    Returns the token bucket of the host of a URL.
+    '''
+    host = urlsplit(url).hostname
+    with _lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(*_bucket_settings.get(host, (RATE_PER_HOST, BURST_PER_HOST)))
+        return _buckets[host]
+
+
+def fetch(url, headers=None, timeout=None, retries=None, backoff=None):
+    '''
+    Retrieves a webpage, politely and with retries.
+
+    Waits for the per-host rate limit before every attempt, and retries
+    connection errors, timeouts and temporary server errors with exponential
+    backoff.
+
+    Parameters:
+    url (str): The URL of the webpage to retrieve.
+    headers (dict): Extra headers for this request.
+    timeout (tuple): (connect, read) timeouts in seconds, defaults to TIMEOUT.
+    retries (int): Number of retries after the first attempt, defaults to RETRIES.
+    backoff (float): Seconds to wait before the first retry, doubled after every retry, defaults to BACKOFF.
+
+    Returns:
+    requests.Response: The response of the last attempt.
+    '''
+    timeout = TIMEOUT if timeout is None else timeout
+    retries = RETRIES if retries is None else retries
+    backoff = BACKOFF if backoff is None else backoff
+
+    session = get_session()
+    bucket = get_bucket(url)
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+        time.sleep(backoff * 2**attempt)
+
+
+def fetch_all(urls, max_workers=8, **kwargs):
+    '''
+    Retrieves many webpages concurrently.
+
+    Different hosts are fetched in parallel, while each host is still held to
+    its own rate limit.
+
+    Parameters:
+    urls (list): The URLs of the webpages to retrieve.
+    max_workers (int): Number of requests in flight at the same time.
+    kwargs: Passed on to fetch.
+
+    Returns:
+    list: The responses, in the same order as urls.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda url: fetch(url, **kwargs), urls))
+
+
+def set_offline(offline=True):
+    '''
+    Switches offline replay on or off.
+
+    In offline mode pages are only read from the response cache, so the
+    parsers can be rerun without any network access.
+    '''
+    global OFFLINE
+
+    OFFLINE = offline
+
+
+def get_content(url):
+    '''
+    Retrieves the body of a webpage, going through the response cache.
+
+    A cached page is revalidated with a conditional GET (ETag/Last-Modified),
+    so an unchanged page costs a 304 instead of a full download. In offline
+    mode the cached page is returned without any request.
+
+    Parameters:
+    url (str): The URL of the webpage to retrieve.
+
+    Returns:
+    bytes: The body of the webpage.
+    '''
+
+    if not USE_CACHE:
+        return fetch(url).content
+
+    entry = response_cache.lookup(url)
+    if OFFLINE:
+        if entry is None:
+            raise LookupError(f'{url} is not in the response cache, it cannot be replayed offline')
+        return response_cache.read_body(entry['digest'])
+
+    response = fetch(url, headers=response_cache.conditional_headers(entry))
+    if response.status_code == 304 and entry is not None:
+        response_cache.update(url, {**entry, 'fetched': time.time()})
+        return response_cache.read_body(entry['digest'])
+    if response.ok:
+        response_cache.store(url, response)
+    return response.content
+
+
+def get_contents(urls, max_workers=8):
+    '''
+    Retrieves the bodies of many webpages concurrently, see get_content.
+
+    Parameters:
+    urls (list): The URLs of the webpages to retrieve.
+    max_workers (int): Number of requests in flight at the same time.
+
+    Returns:
+    list: The body of each webpage, in the same order as urls.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(get_content, urls))
+
 
 def get_soup(url):
     '''
@@ -22,19 +262,56 @@ def get_soup(url):
     BeautifulSoup object: The parsed HTML content of the webpage.
     '''
 
-    # Set the headers to simulate a browser request
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36'
-    }
+    # Make a GET request to the website (or replay it from the response cache)
+    content = get_content(url)
 
-    # Sleep for half a second to avoid overloading the website
-    time.sleep(.5) 
+    # Parse the HTML content using BeautifulSoup
+    return BeautifulSoup(content, 'html.parser')
 
-    # Make a GET request to the website for the specified state
-    response = requests.get(url, headers=headers)
 
-    # Parse the HTML content using BeautifulSoup
-    return BeautifulSoup(response.content, 'html.parser')
+def get_soups(urls, max_workers=8):
+    '''
+    Retrieves and parses the HTML content of many webpages concurrently.
+
+    Parameters:
+    urls (list): The URLs of the webpages to retrieve and parse.
+    max_workers (int): Number of requests in flight at the same time.
+
+    Returns:
+    list: The parsed HTML content of each webpage, in the same order as urls.
+    '''
+    contents = get_contents(urls, max_workers=max_workers)
+    return [BeautifulSoup(content, 'html.parser') for content in contents]
+
+
+def parse_rows(content, strainer, row_filter=None, within=None, parser=None):
+    '''
+    Parses only the targeted part of a webpage and returns its table rows.
+
+    Only the elements matched by the strainer are turned into a tree, so the
+    rest of a large page is skipped instead of being built and thrown away.
+
+    Parameters:
+    content (bytes): The HTML content of the webpage.
+    strainer (SoupStrainer): Selects the table (or rows) to parse.
+    row_filter (dict): Attributes the <tr> elements must have, e.g. {'class': 'dynamic-table__row'}.
+    within (str): Only take the rows inside the first element with this tag, e.g. 'tbody'.
+    parser (str): The parser used by Beautiful Soup, defaults to TABLE_PARSER.
+
+    Returns:
+    list: One list of cell texts per <tr> element.
+
+    Raises:
+    ValueError: If within is given and the parsed part of the page has no such element, e.g. after a layout change.
+    '''
+
+    soup = BeautifulSoup(content, parser or TABLE_PARSER, parse_only=strainer)
+    if within is not None:
+        found = soup.find(within)
+        if found is None:
+            raise ValueError(f'No <{within}> element in the parsed part of the page, its layout may have changed')
+        soup = found
+    return [[td.text for td in row.find_all('td')] for row in soup.find_all('tr', attrs=row_filter or {})]
 
 
 def write_array_to_csv(results, csv_file_name):
@@ -58,6 +335,30 @@ def write_array_to_csv(results, csv_file_name):
             writer.writerow(row)
 
 
+def write_columns_to_csv(columns, csv_file_name):
+    '''
+    Writes typed columns to a CSV file, with the column names as the header.
+
+    Parameters:
+    columns (dict): A dictionary mapping each column name to a list of values, all the same length.
+    csv_file_name (str): The name of the CSV file to write the results to.
+
+    Returns:
+    int: The number of rows written, not counting the header.
+    '''
+
+    processed_data_directory = get_processed_data_directory()
+    save_path = os.path.join(processed_data_directory, csv_file_name)
+
+    # Open the CSV file for writing
+    with open(save_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*columns.values()))
+
+    return len(next(iter(columns.values()), []))
+
+
 def get_processed_data_directory():
     '''
     Returns the path to the processed data directory.
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the scripts import their siblings by name, as when they are run from their own directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ['scripts/gather', 'scripts/analysis']:
+    sys.path.insert(0, os.path.join(ROOT, directory))
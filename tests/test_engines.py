@@ -0,0 +1,105 @@
+"""
+Tests that the ways of computing the rankings agree, on a small synthetic data tree.
+
+The tree has fewer than 50 cities, so every city-level source covers every
+city: the pandas engine forward fills a city from the row sorted before it,
+which only agrees with the array engine falling back on the state then.
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+from engine import subtype_weights
+from outofcore import gardnm_outofcore
+from paths import ROOT
+from synthetic import generate
+from writers import read_rankings
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT) # for the state names of generate
+    generate(str(tmp_path), n_sources=30, n_cities=40, city_fraction=0.5)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def run(filename, normalizeAll = True, **options):
+    main.gardnm([], normalizeAll=normalizeAll, filename=filename, **options)
+    return read_rankings(main.output_name(filename, normalizeAll))
+
+
+def assert_same_rankings(left, right, exact = True):
+    # the counts come out as floats or integers depending on the engine, their values are what matters
+    pd.testing.assert_frame_equal(left, right, check_dtype=False, check_exact=exact, rtol=1e-12)
+
+
+def test_subtype_weights_count_the_sources_with_a_row():
+    nan = np.nan
+    PSW = np.array([
+        [1.0, 1.0, 1.0, 2.0],
+        [1.0, nan, 1.0, 2.0],
+        [nan, nan, 1.0, 2.0],
+    ])
+    W = np.array([1/3, 1/3, 1/3, 1]) # the first three sources share a subtype
+    groups = np.array([0, 0, 0, 1])
+
+    weights = PSW * subtype_weights(PSW, W, groups) # PSW with W = 1/k in place of W
+    np.testing.assert_allclose(weights, [
+        [3 * 1/3, 3 * 1/3, 3 * 1/3, 2.0],
+        [3 * 1/2, nan, 3 * 1/2, 2.0],
+        [nan, nan, 3.0, 2.0],
+    ])
+
+
+def test_engines_agree_with_subtypes(tree):
+    source_types, source_subtypes = main.load_config()[2:]
+    shared = [st for st, st_list in source_types.items() if len({source_subtypes[s] for s in st_list}) < len(st_list)]
+    assert shared # the tree has sources sharing a subtype
+
+    array = run('array', ignore_subtypes=False, engine='array')
+    # the engines apply W = 1/k in a different order of operations, which can change the last bit
+    assert_same_rankings(array, run('pandas', ignore_subtypes=False, engine='pandas'), exact=False)
+    assert not np.allclose(array['M'], run('ignored', engine='array')['M'])
+
+
+@pytest.mark.parametrize('normalizeAll', [True, False])
+def test_engines_agree(tree, normalizeAll):
+    assert_same_rankings(run('array', normalizeAll, engine='array'), run('pandas', normalizeAll, engine='pandas'))
+
+
+@pytest.mark.parametrize('engine', ['array', 'pandas'])
+def test_variants_match_separate_runs(tree, engine):
+    ratings = {'synthetic_0000': [1, 1, 2], 'synthetic_0005': [5, 1, 2]}
+    variants = [
+        {'filename': 'plain'},
+        {'filename': 'raw', 'normalizeAll': False},
+        {'filename': 'subtypes', 'ignore_subtypes': False},
+        {'filename': 'rated', 'source_ratings': ratings},
+    ]
+    main.gardnm_variants(variants, engine=engine)
+
+    def read(filename, normalizeAll = True):
+        return read_rankings(main.output_name(filename, normalizeAll))
+
+
+    assert_same_rankings(read('plain'), run('single', engine=engine))
+    assert_same_rankings(read('raw', False), run('single', False, engine=engine))
+    assert_same_rankings(read('subtypes'), run('single', ignore_subtypes=False, engine=engine))
+
+    path = tree / 'data' / 'sources' / 'source_ratings.json'
+    source_ratings = json.loads(path.read_text())
+    path.write_text(json.dumps({**source_ratings, **ratings}))
+    assert_same_rankings(read('rated'), run('single', engine=engine))
+    assert not np.allclose(read('rated')['M'], read('plain')['M'])
+
+
+@pytest.mark.parametrize('options', [{}, {'normalizeAll': False}, {'ignore_subtypes': False}])
+def test_outofcore_matches_gardnm(tree, options):
+    normalizeAll = options.get('normalizeAll', True)
+    gardnm_outofcore(filename='outofcore', chunk_size=16, dtype='float64', **options) # several chunks of cities
+    assert_same_rankings(read_rankings(main.output_name('outofcore', normalizeAll)), run('array', engine='array', **options))
@@ -0,0 +1,127 @@
+"""
+Tests of the fetch layer of scripts/gather/utils.py against a local stand-in server.
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import utils
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Answers every path with a short body and records when and over which connection it was asked
+
+    /flaky/<n>/<key>  503 for the first n requests of key, then 200
+    /slow             waits a second before answering
+    """
+
+    protocol_version = 'HTTP/1.1' # keep-alive, so pooled connections are reused
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, time.monotonic(), self.client_address[1]))
+            status = 200
+            if self.path.startswith('/flaky/'):
+                _, _, n, key = self.path.split('/')
+                server.counts[key] = server.counts.get(key, 0) + 1
+                status = 503 if server.counts[key] <= int(n) else 200
+        if self.path == '/slow':
+            time.sleep(1)
+        body = self.path.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.counts = {}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_limits(monkeypatch):
+    """Fast default limits and a fresh session and buckets for every test"""
+    monkeypatch.setattr(utils, '_session', None)
+    monkeypatch.setattr(utils, '_buckets', {})
+    monkeypatch.setattr(utils, '_bucket_settings', {})
+    monkeypatch.setattr(utils, 'RATE_PER_HOST', 1000.0)
+    monkeypatch.setattr(utils, 'BURST_PER_HOST', 1000)
+
+
+def url(server, path, host = '127.0.0.1'):
+    return f'http://{host}:{server.server_address[1]}{path}'
+
+
+def test_session_reuses_one_connection(server):
+    for i in range(5):
+        assert utils.fetch(url(server, f'/page/{i}')).text == f'/page/{i}'
+    assert len({port for _, _, port in server.requests}) == 1
+
+
+def test_fetch_all_keeps_order(server):
+    urls = [url(server, f'/page/{i}') for i in range(20)]
+    assert [r.text for r in utils.fetch_all(urls, max_workers=8)] == [f'/page/{i}' for i in range(20)]
+
+
+def test_rate_limit_spaces_requests_to_one_host(server):
+    utils.set_rate_limit('127.0.0.1', 10, 1)
+    utils.fetch_all([url(server, f'/page/{i}') for i in range(5)], max_workers=5)
+    times = sorted(t for _, t, _ in server.requests)
+    assert len(times) == 5
+    assert times[-1] - times[0] >= 0.35 # four gaps of 0.1 s, with some slack for the clock
+
+
+def test_rate_limits_are_per_host(server):
+    utils.set_rate_limit('127.0.0.1', 4, 1)
+    utils.set_rate_limit('localhost', 4, 1)
+    urls = [url(server, f'/a/{i}', '127.0.0.1') for i in range(4)] + [url(server, f'/b/{i}', 'localhost') for i in range(4)]
+    start = time.monotonic()
+    utils.fetch_all(urls, max_workers=8)
+    elapsed = time.monotonic() - start
+    # each host needs 0.75 s for its four requests; one shared limit would need 1.75 s
+    assert 0.6 <= elapsed < 1.5
+    for prefix in ('/a/', '/b/'):
+        times = sorted(t for path, t, _ in server.requests if path.startswith(prefix))
+        assert min(b - a for a, b in zip(times, times[1:])) >= 0.2
+
+
+def test_retries_temporary_errors(server):
+    response = utils.fetch(url(server, '/flaky/2/x'), backoff=0.01)
+    assert response.status_code == 200
+    assert server.counts['x'] == 3
+
+
+def test_gives_up_after_the_last_retry(server):
+    response = utils.fetch(url(server, '/flaky/10/y'), retries=2, backoff=0.01)
+    assert response.status_code == 503
+    assert server.counts['y'] == 3
+
+
+def test_retries_timeouts_then_raises(server):
+    with pytest.raises(requests.Timeout):
+        utils.fetch(url(server, '/slow'), timeout=(1, 0.2), retries=1, backoff=0.01)
+    assert sum(path == '/slow' for path, _, _ in server.requests) == 2
+
+
+def test_backoff_doubles(server):
+    start = time.monotonic()
+    utils.fetch(url(server, '/flaky/2/z'), backoff=0.1)
+    assert time.monotonic() - start >= 0.3 # 0.1 s, then 0.2 s
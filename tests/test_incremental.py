@@ -0,0 +1,99 @@
+"""
+Tests that editing one source only recomputes that source, on a small synthetic data tree.
+"""
+
+import pandas as pd
+import pytest
+
+import ingest
+import main
+import names
+from paths import ROOT
+from synthetic import generate
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT) # for the state names of generate
+    generate(str(tmp_path), n_sources=12, n_cities=300, city_fraction=0.5)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def count_calls(monkeypatch, module, name, argument = 0):
+    """Record one argument of every call of a function"""
+    calls = []
+    function = getattr(module, name)
+    def counted(*args, **kwargs):
+        calls.append(args[argument] if len(args) > argument else None)
+        return function(*args, **kwargs)
+    monkeypatch.setattr(module, name, counted)
+    return calls
+
+
+def edit(tree, source, column = None, value = None, city = None):
+    """Change one value, or the name of the first city, of a source"""
+    path = tree / 'data' / 'processed_data' / f'{source}.csv'
+    sdata = pd.read_csv(path, dtype=object)
+    if city is not None:
+        sdata.loc[sdata['City'].notna() & (sdata['City'] != ''), 'City'] = city
+    else:
+        column = next(c for c in ['Score', 'Rank', 'Processed'] if c in sdata)
+        sdata.loc[0, column] = str(float(sdata.loc[0, column]) + 1)
+    sdata.to_csv(path, index=False)
+
+
+def test_value_edit_recomputes_one_source(tree, monkeypatch):
+    main.load_cached_sources(True, True)
+    processed = count_calls(monkeypatch, main, 'process_source', argument=1)
+    built = count_calls(monkeypatch, names, 'build_name_index')
+
+    edit(tree, 'synthetic_0003')
+    main.load_cached_sources(True, True)
+    assert built == []
+    assert processed == ['synthetic_0003']
+
+
+def test_value_edit_reparses_one_source(tree, monkeypatch):
+    statename_to_abbr, source_ratings = main.load_config()[:2]
+    sources = list(source_ratings)
+    index = names.load_name_index(statename_to_abbr, sources)
+    first = ingest.load_ingested(statename_to_abbr, sources, index)
+    parsed = count_calls(monkeypatch, ingest, 'ingest_source')
+
+    edit(tree, 'synthetic_0003')
+    index = names.load_name_index(statename_to_abbr, sources)
+    second = ingest.load_ingested(statename_to_abbr, sources, index)
+    assert parsed == ['synthetic_0003']
+    assert second['key'] != first['key']
+    assert not second['table'].equals(first['table'])
+
+    fresh = ingest.load_ingested(statename_to_abbr, sources, index, cache=False)
+    pd.testing.assert_frame_equal(second['table'], fresh['table'])
+
+
+def test_name_edit_rebuilds_the_index(tree, monkeypatch):
+    statename_to_abbr, source_ratings = main.load_config()[:2]
+    sources = list(source_ratings)
+    before = names.load_name_index(statename_to_abbr, sources)
+    built = count_calls(monkeypatch, names, 'build_name_index')
+
+    city_source = next(s for s in sources if 'City' in pd.read_csv(tree / 'data' / 'processed_data' / f'{s}.csv', nrows=0))
+    edit(tree, city_source, city='Renamed City')
+    after = names.load_name_index(statename_to_abbr, sources)
+    assert len(built) == 1
+    assert after['key'] != before['key']
+    assert 'Renamed City' in set(after['city'])
+
+
+def test_reused_table_does_not_repeat_its_report(tree, capsys):
+    statename_to_abbr, source_ratings = main.load_config()[:2]
+    sources = list(source_ratings)
+    index = names.load_name_index(statename_to_abbr, sources)
+    ingest.load_ingested(statename_to_abbr, sources, index)
+    assert 'no ingest spec, inferred' in capsys.readouterr().out
+
+    ingest.load_ingested(statename_to_abbr, sources, index)
+    assert 'WARNING' not in capsys.readouterr().out
+    ingest.load_ingested(statename_to_abbr, sources, index, verbose=True)
+    assert 'no ingest spec, inferred' in capsys.readouterr().out
@@ -0,0 +1,53 @@
+"""
+Tests of the table extraction of the scrapers on the saved fixtures of scripts/gather/fixtures.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import bench_parse
+import utils
+from scrape_moveLgbtq import MOVE_ROWS, extract_rank_and_state, find_starting_row
+from scrape_wallethub import parse_wallethub_table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fixture(name):
+    with open(os.path.join(bench_parse.FIXTURE_DIRECTORY, name), 'rb') as f:
+        return f.read()
+
+
+def test_wallethub_table():
+    rank, name = parse_wallethub_table(fixture('wallethub_womenEquity.html'))
+    expected = pd.read_csv(os.path.join(ROOT, 'data/processed_data/wallethub_womenEquity.csv')).sort_values('Score', ascending=False)
+    assert name == list(expected['State'])
+    assert rank == list(range(1, len(expected) + 1))
+
+
+def test_move_rows():
+    rows = utils.parse_rows(fixture('move_lgbtqFamily.html'), MOVE_ROWS)
+    rank, state = extract_rank_and_state(rows, find_starting_row(rows))
+    expected = pd.read_csv(os.path.join(ROOT, 'data/processed_data/move_lgbtqFamily.csv')).sort_values('Rank')
+    assert state == list(expected['State'])
+    assert rank == list(range(1, len(expected) + 1)) # the scraper numbers the rows, ties included
+
+
+def test_missing_table_is_a_clear_error():
+    content = fixture('wallethub_womenEquity.html').replace(b'cardhub-edu-table', b'renamed-table')
+    with pytest.raises(ValueError, match='tbody'):
+        parse_wallethub_table(content)
+
+
+def test_targeted_parse_matches_full_parse():
+    for parser in ['html.parser', utils.TABLE_PARSER]:
+        content = fixture('wallethub_womenEquity.html')
+        full = [[td.text for td in tr.find_all('td')] for tr in utils.BeautifulSoup(content, 'html.parser').find('table', class_='cardhub-edu-table').tbody.find_all('tr')]
+        assert utils.parse_rows(content, bench_parse.WALLETHUB_TABLE, within='tbody', parser=parser) == full
+
+
+def test_bench_parse_defaults_to_the_fixtures():
+    names = [os.path.basename(name) for name, _ in bench_parse.load_fixtures()]
+    assert names == ['move_lgbtqFamily.html', 'wallethub_womenEquity.html']
@@ -0,0 +1,65 @@
+"""
+Tests of what the pipeline rebuilds, on a small synthetic data tree.
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import pipeline
+from paths import ROOT
+from synthetic import generate
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT) # for the state names of generate
+    generate(str(tmp_path), n_sources=12, n_cities=300, city_fraction=0.5)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def rebuilt(status):
+    return sorted(name for name, s in status.items() if s == 'rebuilt')
+
+
+def source_type_of(source):
+    return next(st for st, sources in pipeline.read_config()['source_types'].items() if source in sources)
+
+
+def test_second_run_is_up_to_date(tree):
+    pipeline.run(pipeline.build_graph(), verbose=False)
+    status = pipeline.run(pipeline.build_graph(), verbose=False)
+    assert set(status.values()) == {'up to date'}
+
+
+def test_value_edit_rebuilds_one_chain(tree, monkeypatch):
+    source = 'synthetic_0003'
+
+    def reprocess(scraped, path):
+        sdata = pd.read_csv(path, dtype=object)
+        column = next(c for c in ['Score', 'Rank', 'Processed'] if c in sdata)
+        sdata.loc[0, column] = str(float(sdata.loc[0, column]) + 1)
+        sdata.to_csv(path, index=False)
+
+    monkeypatch.setitem(pipeline.PROCESSORS, source, reprocess)
+    pipeline.run(pipeline.build_graph(), verbose=False)
+    names = open(os.path.join(pipeline.PIPELINE_DIR, 'names.pkl'), 'rb').read()
+
+    status = pipeline.run(pipeline.build_graph(), force={f'process:{source}'}, verbose=False)
+    assert rebuilt(status) == sorted([f'process:{source}', f'score:{source}', f'subrank:{source_type_of(source)}', 'rankings'])
+    assert status['names'] == 'unchanged'
+    assert open(os.path.join(pipeline.PIPELINE_DIR, 'names.pkl'), 'rb').read() == names
+
+
+def test_name_edit_rebuilds_the_index(tree):
+    pipeline.run(pipeline.build_graph(), verbose=False)
+    path = './data/processed_data/synthetic_0003.csv'
+    sdata = pd.read_csv(path, dtype=object)
+    sdata.loc[0, 'State'] = 'Nowhere'
+    sdata.to_csv(path, index=False)
+
+    status = pipeline.run(pipeline.build_graph(), verbose=False)
+    assert status['names'] == 'rebuilt'
+    assert status['score:synthetic_0003'] == 'rebuilt'
@@ -0,0 +1,46 @@
+"""
+Tests of the request handling of scripts/analysis/server.py, without building a model.
+"""
+
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from server import Handler
+
+
+@pytest.fixture
+def connection():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.daemon_threads = True
+    httpd.service = SimpleNamespace(model={'source_ratings': {}})
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    connection = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+    yield connection
+    connection.close()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(connection, path, body):
+    connection.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@pytest.mark.parametrize('body', ['[]', '"x"', '3', 'null', '{"source_ratings": []}', '{"W": "x"}', 'not json',
+    '{"n": null}', '{"locations": 5}', '{"source_ratings": {"x": {"a": 1}}}', '{"W": {"x": "1"}}', '{"level": 3}',
+    '{"locations": [["GA"]]}'])
+def test_bad_score_bodies_get_400(connection, body):
+    status, reply = post(connection, '/score', body)
+    assert status == 400
+    assert reply['error'].startswith('Bad query')
+
+
+def test_connection_survives_a_bad_body(connection):
+    assert post(connection, '/score', '[]')[0] == 400
+    assert post(connection, '/nowhere', '{}')[0] == 404
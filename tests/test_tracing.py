@@ -0,0 +1,64 @@
+"""
+Tests of the tracing of gardnm() in scripts/analysis/main.py.
+"""
+
+import json
+import tracemalloc
+
+import pytest
+
+import main
+import tracing
+from paths import ROOT
+
+
+@pytest.fixture(autouse=True)
+def in_root(tmp_path, monkeypatch):
+    """Run from the repository root, without writing the rankings"""
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(main, 'save_rankings', lambda rankings, name, format: str(tmp_path / name))
+
+
+def test_memory_trace(tmp_path):
+    path = tmp_path / 'trace.jsonl'
+    main.gardnm(cities_to_print=[], trace=str(path), trace_memory=True)
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert {'1_load', '3_subrank', '4_combine', '5_save'} <= {r['name'] for r in records}
+    assert all('peak_mb' in r for r in records)
+    assert not tracing.is_enabled()
+
+
+def test_tracing_stops_when_a_stage_fails(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('stage failed')
+    monkeypatch.setattr(main, 'process_sources', fail)
+
+    path = tmp_path / 'trace.jsonl'
+    with pytest.raises(RuntimeError):
+        main.gardnm(cities_to_print=[], trace=str(path))
+    assert not tracing.is_enabled()
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [r['error'] for r in records if r['name'] == '2_process'] == ["RuntimeError('stage failed')"]
+
+
+def test_caller_tracemalloc_is_left_on(tmp_path):
+    tracemalloc.start()
+    try:
+        main.gardnm(cities_to_print=[], trace=str(tmp_path / 'trace.jsonl'), trace_memory=True)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_run_trace_gives_back_the_tracing_already_on(tmp_path):
+    outer = tmp_path / 'outer.jsonl'
+    tracing.enable(str(outer)) # as with GARDNM_TRACE
+    try:
+        main.gardnm(cities_to_print=[], trace=str(tmp_path / 'run.jsonl'))
+        assert tracing.is_enabled()
+        with tracing.span('after'):
+            pass
+    finally:
+        tracing.disable()
+    assert [json.loads(line)['name'] for line in outer.read_text().splitlines()] == ['after']
+    assert '5_save' in (tmp_path / 'run.jsonl').read_text()